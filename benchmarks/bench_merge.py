@@ -0,0 +1,207 @@
+"""Benchmark merge against synthetic source libraries and a fake destination library
+
+Runs the same merge engine as the merge command but with synthetic source libraries
+(see merge_photos_libraries.source.generate_synthetic_library) and an in-memory destination (FakePhotosBackend) so it runs anywhere, including Linux CI.
+Reports photos merged per second, calls to the destination library per photo and
+bytes of merge records written to the merge database.
+
+    python benchmarks/bench_merge.py --size 1000 --size 10000 --size 100000
+
+Use --library to keep the generated libraries so later runs merge the same photos.
+
+Use --max-calls-per-photo to fail (exit status 1) if a change adds calls to Photos.
+
+Use --checkpoint journal to record progress in a merge journal instead of the SQLite
+merge database.
+"""
+
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+import click
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from merge_photos_libraries.backend import FakePhotosBackend
+from merge_photos_libraries.cli import merge_photos
+from merge_photos_libraries.journal import MergeJournal
+from merge_photos_libraries.mergedb import MergeDB
+from merge_photos_libraries.source import SyntheticSource, generate_synthetic_library
+
+
+def synthetic_source(library_dir, size, seed):
+    """Return SyntheticSource of size photos in library_dir, generating it if needed """
+    path = pathlib.Path(library_dir) / f"synthetic-{size}-{seed}"
+    if path.exists():
+        return SyntheticSource(path)
+    click.echo(f"Generating synthetic library of {size} photos at {path}")
+    return generate_synthetic_library(path, size, seed=seed)
+
+
+def run_benchmark(
+    src,
+    size,
+    latency,
+    import_batch_size,
+    export_workers,
+    prefetch_depth,
+    checkpoint="sqlite",
+):
+    """Merge photos from src into a FakePhotosBackend, returns dict of results """
+    src_photos = src.photos()
+    dest = FakePhotosBackend(latency=latency)
+    dest.open("Synthetic.photoslibrary")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mergedb_class = MergeJournal if checkpoint == "journal" else MergeDB
+        mergedb = mergedb_class(
+            pathlib.Path(tmpdir) / "bench.osxphotos_merge.db",
+            "Source.photoslibrary",
+            "Synthetic.photoslibrary",
+            flush_count=50,
+            flush_interval=30,
+        )
+        start = time.perf_counter()
+        with open(os.devnull, "w") as fp:
+            merge_photos(
+                src_photos,
+                dest,
+                mergedb,
+                export_workers=export_workers,
+                prefetch_depth=prefetch_depth,
+                import_batch_size=import_batch_size,
+                progress_file=fp,
+                albums=src.album_index(),
+            )
+        mergedb.close()
+        elapsed = time.perf_counter() - start
+    calls = sum(dest.calls.values()) - dest.calls["open"]
+    return {
+        "size": size,
+        "seconds": round(elapsed, 3),
+        "photos_per_sec": round(size / elapsed, 1),
+        "calls_per_photo": round(calls / size, 4),
+        "calls": dict(dest.calls),
+        "checkpoint_bytes": mergedb.bytes_written,
+        "imported": len(dest.photos),
+    }
+
+
+@click.command()
+@click.option(
+    "--size",
+    "sizes",
+    metavar="N",
+    type=click.IntRange(min=1),
+    multiple=True,
+    help="Number of photos in the synthetic source library; may be repeated. "
+    "Default: 1000 and 10000.",
+)
+@click.option(
+    "--library",
+    "library_dir",
+    type=click.Path(file_okay=False),
+    help="Directory to keep generated synthetic libraries in so they can be reused "
+    "between runs. Default: generate into a temporary directory.",
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Seed for generating synthetic libraries.",
+)
+@click.option(
+    "--latency",
+    type=float,
+    default=0,
+    show_default=True,
+    help="Seconds added to every call to the fake destination library.",
+)
+@click.option(
+    "--import-batch-size", type=click.IntRange(min=1), default=50, show_default=True
+)
+@click.option(
+    "--export-workers", type=click.IntRange(min=1), default=2, show_default=True
+)
+@click.option(
+    "--prefetch",
+    "prefetch_depth",
+    type=click.IntRange(min=1),
+    default=100,
+    show_default=True,
+)
+@click.option(
+    "--checkpoint",
+    type=click.Choice(["sqlite", "journal"]),
+    default="sqlite",
+    show_default=True,
+    help="Record merge progress in a SQLite merge database or a merge journal.",
+)
+@click.option(
+    "--max-calls-per-photo",
+    type=float,
+    help="Exit with status 1 if any run makes more calls to the destination per photo.",
+)
+@click.option(
+    "--json", "json_file", type=click.Path(), help="Write results to JSON file."
+)
+def bench(
+    sizes,
+    library_dir,
+    seed,
+    latency,
+    import_batch_size,
+    export_workers,
+    prefetch_depth,
+    checkpoint,
+    max_calls_per_photo,
+    json_file,
+):
+    """Benchmark merge with synthetic libraries """
+    tmpdir = None if library_dir else tempfile.TemporaryDirectory()
+    library_dir = library_dir or tmpdir.name
+    results = []
+    for size in sizes or (1000, 10000):
+        src = synthetic_source(library_dir, size, seed)
+        result = run_benchmark(
+            src,
+            size,
+            latency,
+            import_batch_size,
+            export_workers,
+            prefetch_depth,
+            checkpoint,
+        )
+        if result["imported"] != size:
+            click.echo(f"{size}: imported {result['imported']} photos", err=True)
+            sys.exit(1)
+        click.echo(
+            f"{size:>8} photos: {result['photos_per_sec']:>9} photos/sec, "
+            f"{result['calls_per_photo']:>7} calls/photo, "
+            f"{result['checkpoint_bytes']:>11} checkpoint bytes"
+        )
+        results.append(result)
+    if tmpdir:
+        tmpdir.cleanup()
+
+    if json_file:
+        with open(json_file, "w") as fd:
+            json.dump(results, fd, indent=2)
+
+    if max_calls_per_photo is not None:
+        over = [r for r in results if r["calls_per_photo"] > max_calls_per_photo]
+        for r in over:
+            click.echo(
+                f"{r['size']} photos: {r['calls_per_photo']} calls/photo exceeds {max_calls_per_photo}",
+                err=True,
+            )
+        if over:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    bench()
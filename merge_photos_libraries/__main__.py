@@ -1,6 +1,6 @@
 """Command line interface for merge-photos-libraries"""
 
-from .cli import merge
+from .cli import cli
 
 if __name__ == "__main__":
-    merge()  # pylint: disable=no-value-for-parameter
+    cli()  # pylint: disable=no-value-for-parameter
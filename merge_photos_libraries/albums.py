@@ -0,0 +1,101 @@
+"""Cache of albums and folders in the destination library """
+
+from .utils import noop
+
+
+class AlbumRegistry:
+    """Resolve destination albums by folder path and title without querying Photos each time
+
+    The registry is built from the destination library's existing folders and albums
+    the first time an album is requested and is updated as albums are created.
+    Albums are keyed by (tuple of folder names, album title).
+
+    Args:
+        dest: PhotosBackend for the destination library
+        verbose: optional function to print verbose output
+    """
+
+    def __init__(self, dest, verbose=None):
+        self._dest = dest
+        self.verbose = verbose or noop
+        self._albums = None
+        self._folders = None
+
+    def _load(self):
+        """Read all folders and albums from the destination library """
+        self._folders = self._dest.folders()
+        self._albums = self._dest.albums(folders=self._folders)
+        self.verbose(
+            f"Found {len(self._albums)} albums in {len(self._folders)} folders in destination library"
+        )
+
+    def __len__(self):
+        if self._albums is None:
+            self._load()
+        return len(self._albums)
+
+    def folder(self, folder_names):
+        """Return destination folder for path folder_names, creating it if needed """
+        if self._folders is None:
+            self._load()
+        path = tuple(folder_names)
+        if path not in self._folders:
+            # make_folders silently ignores existing folders (like os.makedirs)
+            self.verbose(f"Adding folder {'/'.join(path)}")
+            self._folders[path] = self._dest.make_folders(path)
+        return self._folders[path]
+
+    def album(self, folder_names, title):
+        """Return destination album title in folder path folder_names, creating it if needed
+
+        Args:
+            folder_names: list of folder names from top level down; empty for a top level album
+            title: album title
+        """
+        if self._albums is None:
+            self._load()
+        key = (tuple(folder_names or ()), title)
+        if key not in self._albums:
+            folder = self.folder(key[0]) if key[0] else None
+            self.verbose(f"Creating album: {title}")
+            self._albums[key] = self._dest.create_album(title, folder=folder)
+        return self._albums[key]
+
+
+def add_planned_albums(dest, albums, mergedb, chunk_size=500):
+    """Add destination photos to albums as planned in the merge database
+
+    Photos are added to each album in chunks of chunk_size with one call per chunk.
+    Each album is then read back to verify its contents; missing photos are
+    added once more. Photos verified in the album are marked added in mergedb so an
+    interrupted album phase resumes where it left off.
+
+    Args:
+        dest: PhotosBackend for the destination library
+        albums: AlbumRegistry for the destination library
+        mergedb: MergeDB holding the album plan
+        chunk_size: maximum number of photos to add to an album in one call
+
+    Returns:
+        dict of (tuple of folder names, album title): list of destination uuids
+        that could not be added to the album
+    """
+    failed = {}
+    for (folder_names, title), uuids in mergedb.album_plan().items():
+        album = albums.album(folder_names, title)
+        albums.verbose(f"Adding {len(uuids)} photos to album {title}")
+        missing = uuids
+        for _ in range(2):
+            for start in range(0, len(missing), chunk_size):
+                chunk = missing[start : start + chunk_size]
+                dest.add(album, [dest.photo(uuid) for uuid in chunk])
+            present = set(dest.album_uuids(album))
+            missing = [uuid for uuid in uuids if uuid not in present]
+            if not missing:
+                break
+        mergedb.mark_album_added(
+            folder_names, title, [uuid for uuid in uuids if uuid in present]
+        )
+        if missing:
+            failed[(folder_names, title)] = missing
+    return failed
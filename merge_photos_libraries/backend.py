@@ -0,0 +1,415 @@
+"""Destination library backends: Photos via photoscript or an in-memory fake """
+
+# merge talks to the destination library only through a PhotosBackend so the
+# merge can be profiled and load-tested without Photos (e.g. on Linux)
+
+import abc
+import collections
+import contextlib
+import time
+import uuid as uuidlib
+
+from .metadata import METADATA_DEFAULTS, metadata_applescript, same_value
+
+DestPhoto = collections.namedtuple("DestPhoto", ["uuid", "id", "filename"])
+DestPhoto.__doc__ = (
+    """A photo in the destination library; filename may be None if not known """
+)
+
+# import files and return {id, filename} for each imported item with a single call
+IMPORT_APPLESCRIPT = """
+on import_photos(filenames, skip_duplicate_check)
+    set file_list to {}
+    repeat with f in filenames
+        copy (POSIX file f) to the end of file_list
+    end repeat
+    tell application "Photos"
+        set items_ to import file_list skip check duplicates skip_duplicate_check
+        if items_ = missing value then
+            return {}
+        end if
+        set result_ to {}
+        repeat with item_ in items_
+            copy {id of item_, filename of item_} to end of result_
+        end repeat
+        return result_
+    end tell
+end import_photos
+"""
+
+# add photos to an album and list the photos in an album with a single call each;
+# photoscript's Album.add queries Photos again for every photo added
+ALBUM_APPLESCRIPT = """
+on album_add(album_id, photo_ids)
+    tell application "Photos"
+        set items_ to {}
+        repeat with photo_id in photo_ids
+            copy media item id photo_id to end of items_
+        end repeat
+        add items_ to album id album_id
+    end tell
+end album_add
+
+on album_photo_ids(album_id)
+    tell application "Photos"
+        set result_ to {}
+        repeat with item_ in (media items of album id album_id)
+            copy id of item_ to end of result_
+        end repeat
+        return result_
+    end tell
+end album_photo_ids
+"""
+
+PHOTO_ID_SUFFIX = "/L0/001"
+""" suffix photoscript adds to a uuid to get the Photos 5+ media item id """
+
+# AppleScript errors raised when Photos is busy or not responding:
+# -1712 AppleEvent timed out, -600 application isn't running,
+# -609 connection is invalid (e.g. Photos crashed)
+BUSY_APPLESCRIPT_ERRORS = (-1712, -600, -609)
+
+# a timed out import may still complete in Photos so only errors raised before
+# Photos received the import are safe to retry
+BUSY_IMPORT_APPLESCRIPT_ERRORS = (-600, -609)
+
+
+class PhotosBusyError(Exception):
+    """Photos was busy or not responding and the call had no effect; it can be retried """
+
+
+class PhotosBackend(abc.ABC):
+    """Interface to the destination library used by merge
+
+    Every method that talks to Photos counts one call in self.calls, keyed by method name.
+    Folders and albums returned by a backend are opaque handles only passed back to
+    the same backend.
+    Methods raise PhotosBusyError if Photos failed to respond and the call can be retried.
+    """
+
+    def __init__(self):
+        self.calls = collections.Counter()
+
+    @abc.abstractmethod
+    def open(self, library_path):
+        """Open the destination library """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def import_photos(self, photo_paths, skip_duplicate_check=False):
+        """Import files at photo_paths, returns list of DestPhoto for imported photos """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def photo(self, uuid):
+        """Return DestPhoto for an existing photo with uuid without calling Photos """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def folders(self):
+        """Return dict of tuple of folder names: folder for every folder in the library """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def albums(self, folders=None):
+        """Return dict of (tuple of folder names, album title): album for every album
+
+        Args:
+            folders: optional dict returned by folders() to avoid reading the folders again
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def album(self, title, folder=None):
+        """Return album named title in folder (top level if None) or None if not found """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def make_folders(self, folder_names):
+        """Return folder at path folder_names, creating any missing folders """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def create_album(self, title, folder=None):
+        """Create album named title in folder (top level if None) and return it """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add(self, album, photos):
+        """Add list of DestPhoto photos to album """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def album_uuids(self, album):
+        """Return list of uuids of photos in album """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_metadata(self, items):
+        """Set metadata for photos
+
+        Args:
+            items: list of (DestPhoto, dict of metadata field: value)
+
+        Returns:
+            list with the names of the fields written for each photo; fields whose
+            value was already set are not written
+        """
+        raise NotImplementedError
+
+
+class PhotoscriptBackend(PhotosBackend):
+    """Destination library in Photos, driven with photoscript and AppleScript """
+
+    def __init__(self):
+        super().__init__()
+        self._library = None
+        self._id_suffix = PHOTO_ID_SUFFIX
+        self._import_script = None
+        self._album_script = None
+
+    def open(self, library_path):
+        # photoscript and py-applescript are only available on MacOS
+        import photoscript
+        from applescript import AppleScript
+
+        self._library = photoscript.PhotosLibrary()
+        self.calls["open"] += 1
+        self._library.open(library_path)
+        self._library.hide()
+        if float(self._library.version) < 5.0:
+            self._id_suffix = ""
+        self._import_script = AppleScript(IMPORT_APPLESCRIPT)
+        self._album_script = AppleScript(ALBUM_APPLESCRIPT)
+
+    @contextlib.contextmanager
+    def _busy(self, errors=BUSY_APPLESCRIPT_ERRORS):
+        """Raise PhotosBusyError for AppleScript errors in errors """
+        from applescript import ScriptError
+
+        try:
+            yield
+        except ScriptError as e:
+            if e.number in errors:
+                raise PhotosBusyError(str(e)) from e
+            raise
+
+    def import_photos(self, photo_paths, skip_duplicate_check=False):
+        self.calls["import_photos"] += 1
+        with self._busy(BUSY_IMPORT_APPLESCRIPT_ERRORS):
+            imported = self._import_script.call(
+                "import_photos", [str(p) for p in photo_paths], skip_duplicate_check
+            )
+        return [
+            DestPhoto(photo_id.split("/")[0], photo_id, filename)
+            for photo_id, filename in imported or []
+        ]
+
+    def photo(self, uuid):
+        return DestPhoto(uuid, f"{uuid}{self._id_suffix}", None)
+
+    def folders(self):
+        folders = {}
+        self.calls["folders"] += 1
+        with self._busy():
+            pending = [((f.name,), f) for f in self._library.folders(top_level=True)]
+            while pending:
+                path, folder = pending.pop()
+                folders.setdefault(path, folder)
+                self.calls["folders"] += 1
+                pending.extend((path + (f.name,), f) for f in folder.subfolders)
+        return folders
+
+    def albums(self, folders=None):
+        self.calls["albums"] += 1
+        with self._busy():
+            albums = {((), a.name): a for a in self._library.albums(top_level=True)}
+        folders = self.folders() if folders is None else folders
+        with self._busy():
+            for path, folder in folders.items():
+                self.calls["albums"] += 1
+                for album in folder.albums:
+                    albums.setdefault((path, album.name), album)
+        return albums
+
+    def album(self, title, folder=None):
+        self.calls["album"] += 1
+        with self._busy():
+            if folder is None:
+                return self._library.album(title, top_level=True)
+            return folder.album(title)
+
+    def make_folders(self, folder_names):
+        self.calls["make_folders"] += 1
+        with self._busy():
+            return self._library.make_folders(list(folder_names))
+
+    def create_album(self, title, folder=None):
+        # a timed out create may still complete so only retry if it never started
+        self.calls["create_album"] += 1
+        with self._busy(BUSY_IMPORT_APPLESCRIPT_ERRORS):
+            return self._library.create_album(title, folder=folder)
+
+    def add(self, album, photos):
+        self.calls["add"] += 1
+        with self._busy():
+            self._album_script.call("album_add", album.id, [p.id for p in photos])
+
+    def album_uuids(self, album):
+        self.calls["album_uuids"] += 1
+        with self._busy():
+            photo_ids = self._album_script.call("album_photo_ids", album.id)
+        return [photo_id.split("/")[0] for photo_id in photo_ids or []]
+
+    def set_metadata(self, items):
+        from applescript import AppleScript
+
+        self.calls["set_metadata"] += 1
+        script = AppleScript(
+            metadata_applescript([(photo.id, metadata) for photo, metadata in items])
+        )
+        with self._busy():
+            return script.run()
+
+
+class FakeAlbum:
+    """Album in a FakePhotosBackend """
+
+    def __init__(self, name):
+        self.name = name
+        self.uuids = []
+
+
+class FakeFolder:
+    """Folder in a FakePhotosBackend """
+
+    def __init__(self, name):
+        self.name = name
+        self.albums = []
+        self.subfolders = []
+
+
+class FakePhotosBackend(PhotosBackend):
+    """In-memory destination library for tests and benchmarks
+
+    Imports each group of files sharing a stem (RAW+JPEG pair, Live Photo) as a
+    single photo like Photos does.
+
+    Args:
+        latency: seconds added to every call that would talk to Photos, or dict of
+            method name: seconds for per-call latency
+        failures: optional dict of method name: number of calls to that method that
+            fail with PhotosBusyError before calls succeed, to simulate a busy Photos
+
+    Attributes:
+        photos: dict of uuid: dict of photo properties
+        root: FakeFolder holding the top level albums and folders
+    """
+
+    METADATA_DEFAULTS = METADATA_DEFAULTS
+
+    def __init__(self, latency=0, failures=None):
+        super().__init__()
+        self._latency = latency
+        self._failures = dict(failures or {})
+        self.library_path = None
+        self.photos = {}
+        self.root = FakeFolder(None)
+
+    def _call(self, name):
+        self.calls[name] += 1
+        latency = (
+            self._latency.get(name, 0)
+            if isinstance(self._latency, dict)
+            else self._latency
+        )
+        if latency:
+            time.sleep(latency)
+        if self._failures.get(name):
+            self._failures[name] -= 1
+            raise PhotosBusyError(f"Photos is busy ({name})")
+
+    def open(self, library_path):
+        self._call("open")
+        self.library_path = library_path
+
+    def import_photos(self, photo_paths, skip_duplicate_check=False):
+        self._call("import_photos")
+        stems = {}
+        for path in photo_paths:
+            name = str(path).replace("\\", "/").split("/")[-1]
+            stems.setdefault(name.rsplit(".", 1)[0], name)
+        imported = []
+        for filename in stems.values():
+            uuid = str(uuidlib.uuid4()).upper()
+            self.photos[uuid] = dict(self.METADATA_DEFAULTS, filename=filename)
+            imported.append(DestPhoto(uuid, f"{uuid}{PHOTO_ID_SUFFIX}", filename))
+        return imported
+
+    def photo(self, uuid):
+        return DestPhoto(uuid, f"{uuid}{PHOTO_ID_SUFFIX}", None)
+
+    def folders(self):
+        self._call("folders")
+        folders = {}
+        pending = [((f.name,), f) for f in self.root.subfolders]
+        while pending:
+            path, folder = pending.pop()
+            folders.setdefault(path, folder)
+            pending.extend((path + (f.name,), f) for f in folder.subfolders)
+        return folders
+
+    def albums(self, folders=None):
+        self._call("albums")
+        albums = {((), a.name): a for a in self.root.albums}
+        folders = self.folders() if folders is None else folders
+        for path, folder in folders.items():
+            for album in folder.albums:
+                albums.setdefault((path, album.name), album)
+        return albums
+
+    def album(self, title, folder=None):
+        self._call("album")
+        folder = folder or self.root
+        return next((a for a in folder.albums if a.name == title), None)
+
+    def make_folders(self, folder_names):
+        self._call("make_folders")
+        folder = self.root
+        for name in folder_names:
+            subfolder = next((f for f in folder.subfolders if f.name == name), None)
+            if subfolder is None:
+                subfolder = FakeFolder(name)
+                folder.subfolders.append(subfolder)
+            folder = subfolder
+        return folder
+
+    def create_album(self, title, folder=None):
+        self._call("create_album")
+        album = FakeAlbum(title)
+        (folder or self.root).albums.append(album)
+        return album
+
+    def add(self, album, photos):
+        self._call("add")
+        for photo in photos:
+            if photo.uuid in self.photos and photo.uuid not in album.uuids:
+                album.uuids.append(photo.uuid)
+
+    def album_uuids(self, album):
+        self._call("album_uuids")
+        return list(album.uuids)
+
+    def set_metadata(self, items):
+        self._call("set_metadata")
+        written = []
+        for photo, metadata in items:
+            properties = self.photos[photo.uuid]
+            fields = [
+                f
+                for f, value in metadata.items()
+                if not same_value(f, value, properties[f])
+            ]
+            properties.update({f: metadata[f] for f in fields})
+            written.append(fields)
+        return written
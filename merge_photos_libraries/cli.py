@@ -3,26 +3,49 @@
 # Currently working:
 # * places photos into correct albums and folder structure
 # * sets title, description, keywords, location, favorite
+# * imports RAW+JPEG pairs and Live Photos with their companion files so Photos
+#   keeps them together as one photo
 # Limitations:
-# * doesn't currently handle Live Photos or RAW+JPEG pairs
 # * only merges the most recent version of the photo (edit history is lost)
 # * very limited error handling
 # * doesn't merge Person In Image
+# * --update can't delete the earlier import of a re-imported photo, it's added to
+#   REPLACED_ALBUM instead
 
-# TODO: add --update (currently it skips updated)
-
+import collections
 import datetime
+import itertools
 import json
 import os
 import pathlib
+import signal
 import sqlite3
-import tempfile
+import sys
+import time
 
 import click
-import osxphotos
-import photoscript
 
+from .albums import AlbumRegistry, add_planned_albums
+from .backend import PhotoscriptBackend
+from .fingerprint import FingerprintIndex
+from .importer import ImportBatch
+from .journal import MergeJournal
 from .mergedb import MergeDB, MergeDBInMemory
+from .metadata import KeywordTable, MetadataWriter, metadata_delta, photo_metadata
+from .metrics import NULL_METRICS, Metrics, TimedBackend
+from .pipeline import interleave, prefetch
+from .plan import MergePlan
+from .preflight import PreflightManifest, preflight
+from .source import (
+    AlbumIndex,
+    OsxPhotosSource,
+    StreamingPhotosSource,
+    library_fingerprint,
+    library_photo_count,
+)
+from .staging import StagedPhoto, StagingArea, predict_strategy
+from .throttle import Throttle, ThrottledBackend
+from .verify import VerifyReport, verify_merge
 from ._version import __version__
 
 CLI_COLOR_ERROR = "red"
@@ -31,6 +54,51 @@ CLI_COLOR_WARNING = "yellow"
 VERBOSE = False
 """ global flag for verbose_ function """
 
+MERGEDB_FLUSH_COUNT = 50
+""" commit merge records to the merge database in groups of this many photos """
+
+MERGEDB_FLUSH_INTERVAL = 30
+""" commit merge records to the merge database at least this often (seconds) """
+
+ALBUM_ADD_CHUNK_SIZE = 500
+""" maximum number of photos added to an album with a single call to Photos """
+
+SOURCE_PAGE_SIZE = 500
+""" number of photos read from the source database at a time with --stream """
+
+REPLACED_ALBUM = "Replaced by merge"
+""" album the earlier import of a photo re-imported by --update is added to so it
+can be reviewed and deleted; photos can't be deleted with AppleScript """
+
+WATCH_INTERVAL = 60
+""" seconds between checks for changes to the source libraries with --watch """
+
+CHECKPOINT_FORMATS = ("sqlite", "journal")
+""" ways merge progress can be recorded (see --checkpoint) """
+
+MergeSource = collections.namedtuple(
+    "MergeSource",
+    [
+        "photos",
+        "mergedb",
+        "reconciled",
+        "count",
+        "albums",
+        "updated",
+        "refresh",
+        "metadata",
+    ],
+    defaults=(None, None, False, None),
+)
+MergeSource.__doc__ = """Photos to merge from one source library: iterable of source
+photos, MergeDB for the source, dict of source uuid: destination uuids of reconciled
+in-flight photos, number of photos, optional AlbumIndex of the source (if None,
+albums are read from each photo's album_info), optional dict of source uuid: merge
+record of photos already merged that changed since (see --update) and whether the
+photos in it only have their metadata and albums written again (see repair) and
+optional dict of source uuid: metadata to write instead of the photo's own (see
+execute) """
+
 
 def verbose_(*args, **kwargs):
     """Print output if flag set """
@@ -46,186 +114,1608 @@ def verbose_(*args, **kwargs):
         click.echo(*styled_args, **kwargs)
 
 
-@click.command()
-@click.argument("src_library", metavar="SOURCE", nargs=1, type=click.Path(exists=True))
-@click.argument(
-    "dest_library", metavar="DESTINATION", nargs=-1, type=click.Path(exists=True)
+def src_photo_path(src_photo):
+    """Return path to the version of src_photo that will be merged (edited if it has adjustments) """
+    return src_photo.path_edited if src_photo.hasadjustments else src_photo.path
+
+
+def export_filename(src_photo):
+    """Return the filename a source photo is exported and imported as """
+    path = src_photo_path(src_photo)
+    return pathlib.Path(src_photo.original_filename).stem + pathlib.Path(path).suffix
+
+
+def original_files(src_photo):
+    """Return list of paths of the original files for src_photo: the original plus
+    any Live Photo video and RAW image """
+    companions = [src_photo.path_live_photo, src_photo.path_raw]
+    return [src_photo.path] + [path for path in companions if path]
+
+
+def merged_files(src_photo):
+    """Return list of paths of the files merged for src_photo: the edited version if
+    it has adjustments, otherwise its original files; empty if the photo is missing """
+    path = src_photo_path(src_photo)
+    if not path:
+        return []
+    return [path] if src_photo.hasadjustments else original_files(src_photo)
+
+
+def pixels_changed(src_photo, merge_record):
+    """Return True if the image (or video) merged for src_photo changed since
+    merge_record was recorded: it was edited, its edit was reverted or a file merged
+    for it was written after the merge """
+    path = src_photo_path(src_photo)
+    if not path:
+        return False
+    if "edited" in merge_record and merge_record["edited"] != bool(
+        src_photo.hasadjustments
+    ):
+        return True
+    if not merge_record.get("date"):
+        return False
+    merged = datetime.datetime.fromisoformat(merge_record["date"]).timestamp()
+    files = [path] + [p for p in (src_photo.path_live_photo, src_photo.path_raw) if p]
+    return any(os.path.getmtime(f) > merged for f in files if os.path.exists(f))
+
+
+def export_photo(src_photo, staging):
+    """Stage src_photo in StagingArea staging for import; unedited originals are
+    linked (or cloned or copied), edited photos are exported
+
+    Returns:
+        StagedPhoto; the caller is responsible for calling its cleanup();
+        if staging fails, the StagedPhoto has no files
+    """
+    filename = export_filename(src_photo)
+    if src_photo.hasadjustments:
+        return staging.export(
+            src_photo, filename, edited=True, live_photo=True, raw_photo=True
+        )
+    try:
+        return staging.link(original_files(src_photo), filename)
+    except OSError as e:
+        verbose_(f"Error staging {filename} ({src_photo.uuid}): {e}")
+        return StagedPhoto([], {})
+
+
+def checkpointed(photos, mergedb, chunk_size):
+    """Yield photos from iterable photos, marking each chunk of chunk_size photos
+    in-flight in mergedb before the first photo of the chunk is yielded """
+    photos = iter(photos)
+    while True:
+        chunk = list(itertools.islice(photos, chunk_size))
+        if not chunk:
+            return
+        mergedb.mark_inflight([p.uuid for p in chunk])
+        yield from chunk
+
+
+def reconcile_inflight(inflight, candidates, dest_library):
+    """Find in-flight photos from an interrupted merge that were already imported
+
+    Args:
+        inflight: dict of source uuid: time photo was marked in-flight
+        candidates: source photos with uuids in inflight
+        dest_library: path to the destination library
+
+    Returns:
+        dict of source uuid: list of destination uuids for photos found in the
+        destination library with the exported filename and added after the photo
+        was marked in-flight
+    """
+    import osxphotos
+
+    candidates = list(candidates)
+    if not candidates:
+        return {}
+
+    dest_db = osxphotos.PhotosDB(dbfile=str(dest_library))
+    dest_by_filename = {}
+    for photo in dest_db.photos():
+        dest_by_filename.setdefault(photo.original_filename.lower(), []).append(photo)
+
+    reconciled = {}
+    for src_photo in candidates:
+        if not src_photo_path(src_photo):
+            continue
+        filename = export_filename(src_photo).lower()
+        matches = [
+            photo.uuid
+            for photo in dest_by_filename.get(filename, [])
+            if photo.date_added.timestamp() >= inflight[src_photo.uuid]
+        ]
+        if matches:
+            reconciled[src_photo.uuid] = matches
+    return reconciled
+
+
+def fingerprint_index(dest_library):
+    """Return FingerprintIndex of the originals in the destination library, cached
+    next to the merge database and updated with any photos added since last time """
+    import osxphotos
+
+    index = FingerprintIndex(
+        dest_library.parent / f"{dest_library.stem}.osxphotos_fingerprint.db",
+        verbose=verbose_,
+    )
+    dest_db = osxphotos.PhotosDB(dbfile=str(dest_library))
+    index.update((photo.uuid, photo.path) for photo in dest_db.photos())
+    return index
+
+
+def _sigterm_handler(signum, frame):
+    """Exit on SIGTERM so pending merge records are flushed on the way out """
+    sys.exit(128 + signum)
+
+
+def _merge_options(func):
+    """Add the options shared by the merge and execute commands to func """
+    options = [
+        click.option("--verbose", "-V", is_flag=True, help="Print verbose output."),
+        click.option("--dry-run", is_flag=True, help="Dry run, don't actually import."),
+        click.option(
+            "--export-workers",
+            metavar="N",
+            type=click.IntRange(min=1),
+            default=2,
+            show_default=True,
+            help="Number of threads exporting photos from the source library "
+            "while photos are imported into the destination library.",
+        ),
+        click.option(
+            "--prefetch",
+            "prefetch_depth",
+            metavar="N",
+            type=click.IntRange(min=1),
+            default=4,
+            show_default=True,
+            help="Maximum number of photos exported ahead of the import.",
+        ),
+        click.option(
+            "--import-batch-size",
+            metavar="N",
+            type=click.IntRange(min=1),
+            default=1,
+            show_default=True,
+            help="Import up to N photos into the destination library with a single call to Photos. "
+            "--prefetch should be at least N for the export to keep up with the import.",
+        ),
+        STREAM_OPTION,
+        PERSON_KEYWORD_OPTION,
+        click.option(
+            "--preflight/--no-preflight",
+            default=True,
+            show_default=True,
+            help="Check the files of every photo to merge (present, not empty, readable, "
+            "a type Photos imports and with their RAW and Live Photo companions) before "
+            "importing anything; photos that fail are reported and set aside. "
+            "Photos that passed are cached next to the merge database and only checked "
+            "again if their file changes.",
+        ),
+        click.option(
+            "--checkpoint",
+            type=click.Choice(CHECKPOINT_FORMATS),
+            help="How to record merge progress: in a SQLite merge database or in a "
+            "compact, append-only journal for very large merges. "
+            "Default is the destination's existing journal if it has one, otherwise sqlite.",
+        ),
+        click.option(
+            "--journal-snapshots",
+            is_flag=True,
+            help="With the journal, also keep each photo's full merge record "
+            "(filenames, staging and metadata) instead of just its progress.",
+        ),
+        click.option(
+            "--retries",
+            metavar="N",
+            type=click.IntRange(min=0),
+            default=3,
+            show_default=True,
+            help="Retry calls to Photos up to N times, with a randomized exponential backoff, "
+            "if Photos is busy or not responding.",
+        ),
+        click.option(
+            "--target-latency",
+            metavar="SECONDS",
+            type=click.FloatRange(min=0, min_open=True),
+            help="Shrink the import batch when calls to Photos take longer than SECONDS and "
+            "grow it again, up to --import-batch-size, while they're faster.",
+        ),
+        click.option(
+            "--metrics",
+            "show_metrics",
+            is_flag=True,
+            help="Time each stage of the merge (export, import, metadata, albums, merge database "
+            "writes and every call to Photos) and print a summary line periodically.",
+        ),
+        click.option(
+            "--metrics-out",
+            metavar="FILE",
+            type=click.Path(dir_okay=False, writable=True),
+            help="Write stage timings and counters to FILE periodically; "
+            "CSV if FILE ends with .csv, otherwise JSON lines. Implies --metrics.",
+        ),
+        click.option(
+            "--metrics-interval",
+            metavar="SECONDS",
+            type=click.FloatRange(min=1),
+            default=60,
+            show_default=True,
+            help="How often to print and write metrics with --metrics or --metrics-out.",
+        ),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+LIBRARIES_ARGUMENT = click.argument(
+    "libraries",
+    metavar="SOURCE... [DESTINATION]",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True),
 )
+
+STREAM_OPTION = click.option(
+    "--stream",
+    is_flag=True,
+    help="Read the source library page by page from its database instead of loading "
+    "it all up front; keeps memory use flat for very large libraries. "
+    "Requires a Photos 5 or later source library.",
+)
+
+PERSON_KEYWORD_OPTION = click.option(
+    "--person-keyword",
+    is_flag=True,
+    help='Add a keyword "People/NAME" to each photo for every named person in it, '
+    "as persons themselves can't be merged.",
+)
+
+UPDATE_OPTION = click.option(
+    "--update",
+    is_flag=True,
+    help="Also update photos already merged that changed in the source library since "
+    "the last --update: their metadata and albums are written again and edited photos "
+    f'are re-imported (the earlier import is added to album "{REPLACED_ALBUM}"). '
+    "Only photos changed since the last --update are read.",
+)
+
+WATCH_OPTION = click.option(
+    "--watch",
+    is_flag=True,
+    help="Keep running and merge, as with --update, whenever a source library "
+    f"changes; the libraries are checked every {WATCH_INTERVAL} seconds.",
+)
+
+SKIP_EXISTING_OPTION = click.option(
+    "--skip-existing",
+    is_flag=True,
+    help="Skip source photos whose content is already in the destination library, "
+    "e.g. when merging a library that overlaps the destination. "
+    "Destination photos are fingerprinted once and cached next to the merge database.",
+)
+
+
+@click.group()
+@click.version_option(version=__version__)
+def cli():
+    """Merge Apple Photos libraries """
+
+
+@cli.command()
+@LIBRARIES_ARGUMENT
+@SKIP_EXISTING_OPTION
+@UPDATE_OPTION
+@WATCH_OPTION
+@_merge_options
+def merge(libraries, skip_existing, update, watch, **options):
+    """Merge photos libraries
+
+    Merges one or more SOURCE libraries into DESTINATION in a single pass; the last
+    library is the destination unless only one library is given, in which case
+    the destination is the last library opened in Photos.
+    """
+    src_libraries, dest_library = parse_libraries(libraries)
+    while True:
+        merged = run_merge(
+            src_libraries,
+            dest_library,
+            skip_existing=skip_existing,
+            update=update or watch,
+            **options,
+        )
+        if not watch:
+            if not merged:
+                click.echo(
+                    "Nothing to merge: source libraries unchanged since the last merge"
+                )
+            return
+        verbose_(f"Waiting {WATCH_INTERVAL} seconds for changes")
+        time.sleep(WATCH_INTERVAL)
+
+
+@cli.command()
+@LIBRARIES_ARGUMENT
+@click.option(
+    "--plan",
+    "plan_file",
+    metavar="FILE",
+    required=True,
+    type=click.Path(dir_okay=False, writable=True),
+    help="File to write the plan to.",
+)
+@STREAM_OPTION
+@SKIP_EXISTING_OPTION
+@PERSON_KEYWORD_OPTION
 @click.option("--verbose", "-V", is_flag=True, help="Print verbose output.")
-@click.option("--dry-run", is_flag=True, help="Dry run, don't actually import.")
-@click.pass_context
-def merge(ctx, src_library, dest_library, verbose, dry_run):
-    """Merge photos libraries """
+def plan(libraries, plan_file, stream, skip_existing, person_keyword, verbose):
+    """Plan a merge without importing anything
+
+    Reads SOURCE libraries once and writes the photos that merge would import into
+    DESTINATION to a plan file, with the staging strategy, albums, metadata to write
+    and estimated bytes for each photo. Use execute to import the photos in a plan.
+    """
     global VERBOSE
     VERBOSE = verbose
 
-    if not dest_library:
-        dest_library = osxphotos.utils.get_last_library_path()
-    else:
-        # dest_library is a tuple due to nargs=-1
-        dest_library = dest_library[0]
+    src_libraries, dest_library = parse_libraries(libraries)
+    mergedb = open_mergedb(src_libraries[0], dest_library, read_only=True)
+    existing = None
+    if skip_existing:
+        verbose_(f"Fingerprinting destination library {dest_library}")
+        existing = fingerprint_index(dest_library)
 
-    dest_library = pathlib.Path(dest_library).expanduser()
-    src_library = pathlib.Path(src_library).expanduser()
+    merge_plan = MergePlan(src_libraries, dest_library)
+    keywords = KeywordTable(person_keyword)
+    try:
+        for index, src_library in enumerate(src_libraries):
+            verbose_(f"Planning merge of {src_library}")
+            merge_plan.set_source_state(src_library)
+            src = open_source(src_library, stream)
+            src_mergedb = mergedb.for_source(src_library) if index else mergedb
+            imported = src_mergedb.imported_uuids()
+            try:
+                albums = src.album_index()
+                with click.progressbar(
+                    src.photos(), length=len(src.uuids()), label=str(src_library)
+                ) as bar:
+                    for src_photo in bar:
+                        plan_photo(
+                            merge_plan,
+                            index,
+                            src_photo,
+                            imported,
+                            existing,
+                            albums,
+                            keywords,
+                        )
+            finally:
+                src.close()
+    finally:
+        mergedb.close()
+        if existing is not None:
+            existing.close()
+
+    merge_plan.save(plan_file)
+    summary = merge_plan.summary()
+    click.echo(
+        f"Planned {summary['photos']} photos ({summary['bytes']} bytes) "
+        f"in {summary['albums']} albums; skipped {summary['skipped']}"
+    )
 
-    if src_library.samefile(dest_library):
+
+@cli.command()
+@click.option(
+    "--plan",
+    "plan_file",
+    metavar="FILE",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Plan file written by the plan command.",
+)
+@click.option(
+    "--shard",
+    metavar="I/N",
+    callback=lambda ctx, param, value: parse_shard(value),
+    help="Only import shard I of N (1 <= I <= N) equal, contiguous parts of the plan, "
+    "e.g. to spread a merge over several nights.",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Execute the plan even if a source library changed since it was planned.",
+)
+@_merge_options
+def execute(plan_file, shard, force, dry_run, **options):
+    """Import the photos in a merge plan
+
+    Only the photos in the plan are read from the source libraries and they're
+    added to the albums and given the metadata in the plan. Photos already imported
+    (e.g. by another shard) are skipped. Refuses to run if a source library changed
+    since it was planned, unless --force is given. With --dry-run the plan (or shard)
+    is summarized without opening any library.
+    """
+    try:
+        merge_plan = MergePlan.load(plan_file)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--plan")
+    rows = merge_plan.shard(*shard) if shard else range(len(merge_plan))
+    if dry_run:
+        click.echo(json.dumps(merge_plan.summary(rows), indent=2))
+        return
+    planned = merge_plan.planned_sources(rows)
+    src_libraries = [pathlib.Path(src) for src in merge_plan.sources if src in planned]
+    if not src_libraries:
+        click.echo("Nothing to import")
+        return
+    changed = merge_plan.changed_sources([str(src) for src in src_libraries])
+    for src_library in changed:
         click.secho(
-            f"src_library and dest_library cannot be the same", fg=CLI_COLOR_ERROR
+            f"Source library {src_library} changed since it was planned",
+            fg=CLI_COLOR_WARNING if force else CLI_COLOR_ERROR,
+        )
+    if changed and not force:
+        click.secho(
+            "Plan the merge again or use --force to execute the plan anyway",
+            fg=CLI_COLOR_ERROR,
         )
         raise click.Abort()
+    run_merge(
+        src_libraries,
+        pathlib.Path(merge_plan.destination),
+        planned=planned,
+        dry_run=False,
+        **options,
+    )
 
-    verbose_(f"Opening source library {src_library}")
-    src = osxphotos.PhotosDB(dbfile=str(src_library))
-    src_photos = src.photos()
 
-    verbose_(f"Opening destination library {dest_library}")
-    mergedb_path = dest_library.parent / f"{dest_library.stem}.osxphotos_merge.db"
+@cli.command()
+@LIBRARIES_ARGUMENT
+@click.option(
+    "--report",
+    "report_file",
+    metavar="FILE",
+    required=True,
+    type=click.Path(dir_okay=False, writable=True),
+    help="File to write the mismatch report to (JSON).",
+)
+@click.option(
+    "--person-keyword",
+    is_flag=True,
+    help='Expect a keyword "People/NAME" for every named person in a photo, '
+    "for a merge run with --person-keyword.",
+)
+@click.option("--verbose", "-V", is_flag=True, help="Print verbose output.")
+def verify(libraries, report_file, person_keyword, verbose):
+    """Verify a merge
 
-    if dry_run:
-        mergedb = MergeDBInMemory(
-            mergedb_path,
-            source_library=src_library,
-            destination_library=dest_library,
-            verbose=verbose_,
+    Checks every photo in the SOURCE libraries was merged into DESTINATION (or
+    skipped) and that each destination photo recorded in the merge database exists
+    with the title, description, favorite, keywords, location and albums of its
+    source photo. Both libraries are read directly from their databases, without
+    Photos, and nothing is written to them. Mismatches are written to a JSON report
+    that repair can use; exits with status 1 if there are any.
+    """
+    global VERBOSE
+    VERBOSE = verbose
+
+    src_libraries, dest_library = parse_libraries(libraries)
+    report = VerifyReport(src_libraries, dest_library)
+    mergedb = open_mergedb(src_libraries[0], dest_library, read_only=True)
+    opened = []
+    dest = None
+    try:
+        for index, src_library in enumerate(src_libraries):
+            src = open_source(src_library, stream=True)
+            opened.append((src, mergedb.for_source(src_library) if index else mergedb))
+        dest = open_source(dest_library, stream=True)
+        verify_merge(
+            opened, dest, report, person_keyword=person_keyword, verbose=verbose_
+        )
+    except ValueError as e:
+        click.secho(str(e), fg=CLI_COLOR_ERROR)
+        raise click.Abort()
+    finally:
+        for src, src_mergedb in opened:
+            src.close()
+            if src_mergedb is not mergedb:
+                src_mergedb.close()
+        mergedb.close()
+        if dest is not None:
+            dest.close()
+
+    report.save(report_file)
+    summary = report.summary()
+    click.echo(
+        f"Verified {summary['source_photos']} source photos and "
+        f"{summary['destination_photos']} destination photos: "
+        f"{len(report)} mismatches {summary['mismatches']}"
+    )
+    if report:
+        sys.exit(1)
+
+
+@cli.command()
+@LIBRARIES_ARGUMENT
+@click.option(
+    "--report",
+    "report_file",
+    metavar="FILE",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Repair the mismatches in a report written by verify rather than the failed "
+    "and interrupted photos recorded in the merge database.",
+)
+@_merge_options
+def repair(libraries, report_file, dry_run, **options):
+    """Repair a merge
+
+    Re-runs only the stage of the merge that didn't complete for each photo from the
+    SOURCE libraries: photos that failed to export or import, or were in-flight when
+    a merge was interrupted, are imported, and with --report, photos with the wrong
+    metadata or missing from albums have their metadata and albums written again.
+    Photos are batched as in a merge and albums left unfinished are added. With
+    --dry-run the photos to repair are counted without opening either library.
+    """
+    report = None
+    if report_file:
+        try:
+            report = VerifyReport.load(report_file)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--report")
+    src_libraries, dest_library = parse_libraries(libraries)
+    if report is not None and report.destination != str(dest_library):
+        raise click.BadParameter(
+            f"report is for destination {report.destination}", param_hint="--report"
         )
+
+    mergedb = open_mergedb(
+        src_libraries[0],
+        dest_library,
+        checkpoint=options["checkpoint"],
+        read_only=dry_run,
+    )
+    only = {}
+    refresh = {}
+    albums_pending = False
+    try:
+        for index, src_library in enumerate(src_libraries):
+            src_mergedb = mergedb.for_source(src_library) if index else mergedb
+            imports, updates = repair_targets(
+                src_mergedb, src_library, report, reset=not dry_run
+            )
+            click.echo(
+                f"Repairing {src_library}: {len(imports)} photos to import, "
+                f"{len(updates)} to write metadata and albums for"
+            )
+            if imports or updates:
+                only[str(src_library)] = imports | updates
+                refresh[str(src_library)] = updates
+            albums_pending = albums_pending or bool(src_mergedb.album_plan())
+            if src_mergedb is not mergedb:
+                src_mergedb.close()
+    finally:
+        mergedb.close()
+
+    if dry_run:
+        return
+    if not only and not albums_pending:
+        click.echo("Nothing to repair")
+        return
+    run_merge(
+        src_libraries,
+        dest_library,
+        only=only,
+        repair=refresh,
+        dry_run=False,
+        **options,
+    )
+
+
+def parse_libraries(libraries):
+    """Return list of source library paths and destination library path from the
+    SOURCE... [DESTINATION] arguments """
+    if len(libraries) == 1:
+        from osxphotos.utils import get_last_library_path
+
+        src_libraries = libraries
+        dest_library = get_last_library_path()
     else:
-        mergedb = MergeDB(
-            mergedb_path,
+        src_libraries = libraries[:-1]
+        dest_library = libraries[-1]
+
+    dest_library = pathlib.Path(dest_library).expanduser()
+    # a source given more than once is only merged once
+    src_libraries = list(
+        dict.fromkeys(pathlib.Path(src).expanduser() for src in src_libraries)
+    )
+
+    for src_library in src_libraries:
+        if src_library.samefile(dest_library):
+            click.secho(
+                f"src_library and dest_library cannot be the same", fg=CLI_COLOR_ERROR
+            )
+            raise click.Abort()
+    return src_libraries, dest_library
+
+
+def parse_shard(value):
+    """Return (index, count) for a --shard value I/N or None if value is None """
+    if value is None:
+        return None
+    try:
+        index, count = (int(n) for n in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("must be I/N, e.g. 1/4", param_hint="--shard")
+    if not 1 <= index <= count:
+        raise click.BadParameter(
+            "I must be between 1 and N, e.g. 1/4", param_hint="--shard"
+        )
+    return index, count
+
+
+def mergedb_path(dest_library):
+    """Return path to the merge database for dest_library """
+    return dest_library.parent / f"{dest_library.stem}.osxphotos_merge.db"
+
+
+def preflight_path(dest_library):
+    """Return path to the pre-flight manifest for dest_library """
+    return dest_library.parent / f"{dest_library.stem}.osxphotos_preflight.db"
+
+
+def journal_path(dest_library):
+    """Return path to the merge journal for dest_library """
+    return dest_library.parent / f"{dest_library.stem}.osxphotos_merge.journal"
+
+
+def open_mergedb(
+    src_library,
+    dest_library,
+    checkpoint=None,
+    read_only=False,
+    journal_snapshots=False,
+    **kwargs,
+):
+    """Return MergeDB recording the merge of src_library into dest_library
+
+    Args:
+        checkpoint: one of CHECKPOINT_FORMATS; default is the journal if dest_library
+            has one, otherwise sqlite
+        read_only: if True, nothing is written (e.g. for a dry run)
+        journal_snapshots: if True, the journal keeps full merge records
+        kwargs: passed to MergeDB
+    """
+    if checkpoint is None:
+        checkpoint = "journal" if journal_path(dest_library).exists() else "sqlite"
+    if checkpoint == "journal":
+        return MergeJournal(
+            journal_path(dest_library),
             source_library=src_library,
             destination_library=dest_library,
             verbose=verbose_,
+            snapshots=journal_snapshots,
+            read_only=read_only,
+            **kwargs,
         )
+    mergedb_class = MergeDBInMemory if read_only else MergeDB
+    return mergedb_class(
+        mergedb_path(dest_library),
+        source_library=src_library,
+        destination_library=dest_library,
+        verbose=verbose_,
+        **kwargs,
+    )
+
+
+def open_source(src_library, stream):
+    """Return PhotosSource for src_library; StreamingPhotosSource if stream """
+    verbose_(f"Opening source library {src_library}")
+    if stream:
+        return StreamingPhotosSource(src_library, page_size=SOURCE_PAGE_SIZE)
+    return OsxPhotosSource(src_library)
+
+
+def plan_photo(merge_plan, source, src_photo, imported, existing, albums, keywords):
+    """Add src_photo to MergePlan merge_plan unless it's already imported (uuid in set
+    imported), missing or, if FingerprintIndex existing is given, in the destination
+    library; its albums are read from the source's AlbumIndex albums and its keywords
+    interned in KeywordTable keywords """
+    if src_photo.uuid in imported:
+        merge_plan.skip("imported")
+        return
+    path = src_photo_path(src_photo)
+    if not path:
+        merge_plan.skip("missing")
+        return
+    if existing is not None and existing.find(path):
+        merge_plan.skip("existing")
+        return
+    try:
+        nbytes = sum(os.path.getsize(f) for f in merged_files(src_photo))
+    except OSError:
+        merge_plan.skip("missing")
+        return
+    merge_plan.add(
+        source,
+        src_photo.uuid,
+        export_filename(src_photo),
+        "export" if src_photo.hasadjustments else predict_strategy(path),
+        nbytes,
+        albums.photo_albums(src_photo.uuid),
+        metadata_delta(photo_metadata(src_photo, keywords)),
+    )
+
 
-    dest = photoscript.PhotosLibrary()
+def run_merge(
+    src_libraries,
+    dest_library,
+    only=None,
+    planned=None,
+    skip_existing=False,
+    update=False,
+    repair=None,
+    verbose=False,
+    dry_run=False,
+    export_workers=2,
+    prefetch_depth=4,
+    import_batch_size=1,
+    stream=False,
+    person_keyword=False,
+    preflight=True,
+    retries=3,
+    target_latency=None,
+    show_metrics=False,
+    metrics_out=None,
+    metrics_interval=60,
+    checkpoint=None,
+    journal_snapshots=False,
+):
+    """Merge src_libraries into dest_library with the options of the merge command
+
+    Args:
+        only: optional dict of source library path (str): set of uuids to merge,
+            e.g. the photos to repair; default is all photos
+        planned: optional dict of source library path (str): plan.PlannedSource
+            for merging the photos in a plan; only the planned photos are read and
+            they're given the planned albums and metadata
+        repair: optional dict of source library path (str): set of uuids of photos
+            already imported whose metadata and albums are written again; they must
+            be in only too
+
+    Returns:
+        False if there was nothing to merge as no source library changed since a
+        merge that left nothing to do, otherwise True
+    """
+    global VERBOSE
+    VERBOSE = verbose
+
+    if planned is not None:
+        only = {src_library: source.uuids for src_library, source in planned.items()}
+    metrics = NULL_METRICS
+    if show_metrics or metrics_out:
+        metrics = Metrics(
+            path=metrics_out,
+            interval=metrics_interval,
+            report=lambda line: click.echo(line, err=True),
+        )
+
+    # fingerprint the sources before reading them so a change made while merging
+    # is picked up by the next merge
+    source_states = {
+        src_library: (
+            library_fingerprint(src_library),
+            library_photo_count(src_library),
+        )
+        for src_library in src_libraries
+    }
+    mergedb = open_mergedb(
+        src_libraries[0],
+        dest_library,
+        checkpoint=checkpoint,
+        read_only=dry_run,
+        journal_snapshots=journal_snapshots,
+        flush_count=MERGEDB_FLUSH_COUNT,
+        flush_interval=MERGEDB_FLUSH_INTERVAL,
+        metrics=metrics,
+    )
+    if only is None and sources_unchanged(mergedb, source_states, update):
+        mergedb.close()
+        metrics.close()
+        return False
+    signal.signal(signal.SIGTERM, _sigterm_handler)
+
+    verbose_(f"Opening destination library {dest_library}")
+
+    dest = PhotoscriptBackend()
     dest.open(dest_library)
-    dest.hide()
 
-    verbose_(f"Merging {len(src_photos)} photos from {src_library} to {dest_library}")
+    existing = None
+    if skip_existing:
+        verbose_(f"Fingerprinting destination library {dest_library}")
+        existing = fingerprint_index(dest_library)
+
+    manifest = PreflightManifest(preflight_path(dest_library)) if preflight else None
+    sources = []
+    opened = []
+    high_water = {}
     # send progress bar output to /dev/null if verbose to hide the progress bar
     fp = open(os.devnull, "w") if verbose else None
-    with click.progressbar(src_photos, file=fp) as bar:
-        for src_photo in bar:
-            if mergedb.get(src_photo.uuid, imported=True):
-                verbose_(
-                    f"Skipping previously imported photo {src_photo.original_filename} ({src_photo.uuid})"
+    try:
+        for src_library in src_libraries:
+            src = open_source(src_library, stream)
+            src_mergedb = mergedb.for_source(src_library) if opened else mergedb
+            opened.append((src, src_mergedb))
+            changes = None
+            if update:
+                since = src_mergedb.high_water()
+                verbose_(f"Reading photos changed in {src_library}")
+                changes = src.modification_dates(since)
+                high_water[src_library] = max(changes.values(), default=since)
+            elif repair is not None:
+                changes = dict.fromkeys(repair.get(str(src_library), ()), 0.0)
+            sources.append(
+                open_merge_source(
+                    src,
+                    src_mergedb,
+                    src_library,
+                    dest_library,
+                    only=None if only is None else only.get(str(src_library), set()),
+                    planned=None if planned is None else planned.get(str(src_library)),
+                    changes=changes,
+                    refresh=repair is not None,
+                    manifest=manifest,
+                    dry_run=dry_run,
                 )
-                continue
+            )
+
+        merge_sources(
+            sources,
+            dest,
+            existing=existing,
+            dry_run=dry_run,
+            export_workers=export_workers,
+            prefetch_depth=prefetch_depth,
+            import_batch_size=import_batch_size,
+            progress_file=fp,
+            metrics=metrics,
+            retries=retries,
+            target_latency=target_latency,
+            person_keyword=person_keyword,
+        )
+        if only is None and not dry_run:
+            for (src, src_mergedb), source, src_library in zip(
+                opened, sources, src_libraries
+            ):
+                if (
+                    update
+                    and update_complete(source)
+                    and high_water[src_library] is not None
+                ):
+                    src_mergedb.set_high_water(high_water[src_library])
+                # a merge without --update leaves changed photos behind so it can
+                # only mark a source done if --update isn't used with it
+                if (update or src_mergedb.high_water() is None) and merge_complete(
+                    src, src_mergedb
+                ):
+                    src_mergedb.set_source_state(*source_states[src_library])
+    finally:
+        if fp is not None:
+            fp.close()
+        # close the MergeDB that owns the connection after the views sharing it
+        for src, src_mergedb in opened:
+            src.close()
+            if src_mergedb is not mergedb:
+                src_mergedb.close()
+        mergedb.close()
+        if existing is not None:
+            existing.close()
+        if manifest is not None:
+            manifest.close()
+        metrics.close()
+    return True
+
+
+def sources_unchanged(mergedb, source_states, update=False):
+    """Return True if MergeDB mergedb recorded every source library in source_states
+    (dict of source library path: (fingerprint, photo count)) with the same
+    fingerprint and photo count when a merge left nothing to do; with update, the
+    source must have been merged with --update before too """
+    for src_library, state in source_states.items():
+        src_mergedb = mergedb.for_source(src_library)
+        recorded = src_mergedb.source_state()
+        if update and src_mergedb.high_water() is None:
+            verbose_(f"Source library {src_library} not merged with --update before")
+            return False
+        if recorded is None:
+            verbose_(f"No complete merge of source library {src_library} recorded")
+            return False
+        if recorded != state:
+            verbose_(f"Source library {src_library} changed since the last merge")
+            return False
+        verbose_(f"Source library {src_library} unchanged since the last merge")
+    return True
 
-            merge_record = {
+
+def merge_complete(src, mergedb):
+    """Return True if every photo in PhotosSource src was imported or skipped (missing
+    or already in the destination library) according to mergedb and every album was
+    added, i.e. merging src again would do nothing until it changes """
+    imported = mergedb.imported_uuids()
+    for uuid in src.uuids():
+        if uuid in imported:
+            continue
+        record = mergedb.get(uuid)
+        if not record or not record[0].get("skipped"):
+            return False
+    return not mergedb.inflight_uuids() and not mergedb.album_plan()
+
+
+def open_merge_source(
+    src,
+    mergedb,
+    src_library,
+    dest_library,
+    only=None,
+    planned=None,
+    changes=None,
+    refresh=False,
+    manifest=None,
+    dry_run=False,
+):
+    """Return MergeSource for the photos in PhotosSource src not yet merged into the
+    destination library according to mergedb, reconciling in-flight photos from an
+    interrupted merge; only photos with uuids in set only are merged if given;
+    if plan.PlannedSource planned is given, only its photos are read from src and
+    they're given its albums and metadata;
+    photos already merged with uuids in changes (dict of uuid: modification time,
+    see PhotosSource.modification_dates) are updated, or if refresh only have their
+    metadata and albums written again; if PreflightManifest manifest
+    is given, photos that fail the pre-flight check are set aside (see
+    preflight_source) """
+    imported = mergedb.imported_uuids()
+    if planned is not None:
+        # the plan lists the photos to merge so src needn't be scanned for them
+        src_uuids = list(planned.uuids)
+    elif only is None:
+        src_uuids = src.uuids()
+    else:
+        src_uuids = [u for u in src.uuids() if u in only]
+    pending = {uuid for uuid in src_uuids if uuid not in imported}
+    updated = {}
+    for uuid in changes or ():
+        if uuid in imported:
+            updated[uuid] = mergedb.get(uuid)[0]
+    if imported:
+        verbose_(
+            f"Skipping {len(src_uuids) - len(pending) - len(updated)} previously imported photos from {src_library}"
+        )
+    if updated:
+        verbose_(f"Updating {len(updated)} changed photos from {src_library}")
+
+    inflight = {
+        uuid: marked
+        for uuid, marked in mergedb.inflight_uuids().items()
+        if uuid in pending
+    }
+    reconciled = {}
+    if inflight:
+        verbose_(
+            f"Found {len(inflight)} in-flight photos from an interrupted merge, reconciling"
+        )
+        reconciled = reconcile_inflight(
+            inflight, src.photos(uuids=inflight), dest_library
+        )
+        verbose_(
+            f"Found {len(reconciled)} in-flight photos already in destination library"
+        )
+
+    if manifest is not None:
+        pending -= set(
+            preflight_source(
+                src,
+                pending - set(reconciled),
+                mergedb,
+                src_library,
+                manifest,
+                full_scan=changes is None and planned is None,
+                dry_run=dry_run,
+            )
+        )
+
+    if planned is not None:
+        albums = planned.albums
+    else:
+        verbose_(f"Reading albums from {src_library}")
+        albums = src.album_index()
+
+    verbose_(f"Merging {len(pending)} photos from {src_library} to {dest_library}")
+    if changes is not None or planned is not None:
+        # read only the photos to merge or update rather than every photo
+        photos = src.photos(uuids=pending | set(updated))
+    else:
+        photos = (p for p in src.photos() if p.uuid in pending)
+    return MergeSource(
+        photos,
+        mergedb,
+        reconciled,
+        len(pending) + len(updated),
+        albums,
+        updated,
+        refresh,
+        None if planned is None else planned.metadata,
+    )
+
+
+def preflight_source(
+    src, uuids, mergedb, src_library, manifest, full_scan=True, dry_run=False
+):
+    """Check the files of the photos in PhotosSource src with uuids in set uuids
+    before any is merged (see preflight.preflight) and record the photos that fail in
+    mergedb unless dry_run: missing photos are skipped, as the import loop does, and
+    the rest recorded as export errors so they're retried by the next merge
+
+    Args:
+        full_scan: if True, read every photo in src rather than just those in uuids,
+            which is quicker when most photos are to be merged
+
+    Returns:
+        dict of uuid: problem for the photos that failed
+    """
+    if not uuids:
+        return {}
+    verbose_(f"Pre-flight check of {len(uuids)} photos from {src_library}")
+    photos = (
+        (p for p in src.photos() if p.uuid in uuids)
+        if full_scan
+        else src.photos(uuids=uuids)
+    )
+    report = preflight(((p.uuid, merged_files(p)) for p in photos), manifest=manifest)
+    verbose_(
+        f"Pre-flight checked {report.checked} photos ({report.cached} unchanged since "
+        f"the last check): {report.bytes} bytes to stage, {len(report.problems)} set aside"
+    )
+    for src_photo in src.photos(uuids=report.problems) if report.problems else ():
+        problem = report.problems[src_photo.uuid]
+        path = src_photo_path(src_photo)
+        click.secho(
+            f"Setting aside photo {src_photo.original_filename} ({src_photo.uuid}) "
+            f"that failed the pre-flight check: {problem}",
+            fg=CLI_COLOR_WARNING,
+        )
+        if dry_run:
+            continue
+        mergedb.upsert(
+            {
                 "src_uuid": src_photo.uuid,
                 "src_original_filename": src_photo.original_filename,
+                "src_path": path,
                 "version": __version__,
                 "date": datetime.datetime.now().isoformat(),
                 "imported": False,
-                "skipped": False,
+                "skipped": not path,
+                "export_error": bool(path),
+                "preflight": problem,
             }
-            path = src_photo.path_edited if src_photo.hasadjustments else src_photo.path
-            merge_record["src_path"] = path
-            if not path:
-                click.secho(
-                    f"Skipping missing photo {src_photo.original_filename} ({src_photo.uuid})",
-                    fg=CLI_COLOR_WARNING,
+        )
+    return report.problems
+
+
+def repair_targets(mergedb, src_library, report=None, reset=False):
+    """Return the photos from src_library to repair the merge of as (set of uuids
+    of photos to import, set of uuids of imported photos to write metadata and
+    albums for)
+
+    Args:
+        mergedb: MergeDB the merge of src_library is recorded in
+        src_library: path to the source library
+        report: optional VerifyReport to take the photos from; default is photos
+            whose export or import failed and photos in-flight when a merge was
+            interrupted, according to mergedb
+        reset: if True, photos report found missing from the destination library
+            are recorded in mergedb as not imported so they're imported again
+    """
+    imports = set()
+    updates = set()
+    if report is None:
+        for record in mergedb.records():
+            if not record.get("imported") and (
+                record.get("export_error") or record.get("import_error")
+            ):
+                imports.add(record["src_uuid"])
+        imports.update(mergedb.inflight_uuids())
+        return imports, updates
+
+    missing = set()
+    for mismatch in report.mismatches:
+        if mismatch["source"] != str(src_library):
+            continue
+        if mismatch["stage"] == "import":
+            imports.add(mismatch["src_uuid"])
+            if mismatch["kind"] == "missing":
+                missing.add(mismatch["src_uuid"])
+        else:
+            updates.add(mismatch["src_uuid"])
+    if reset:
+        for uuid in missing:
+            mergedb.upsert({"src_uuid": uuid, "imported": False})
+    return imports, updates - imports
+
+
+def update_complete(source):
+    """Return True if every photo of MergeSource source changed since the last
+    --update was updated, i.e. none failed to re-import """
+    for uuid in source.updated or ():
+        record = source.mergedb.get(uuid)
+        if record and (record[0].get("import_error") or record[0].get("export_error")):
+            return False
+    return True
+
+
+def merge_photos(
+    src_photos,
+    dest,
+    mergedb,
+    reconciled=None,
+    existing=None,
+    dry_run=False,
+    export_workers=1,
+    prefetch_depth=1,
+    import_batch_size=1,
+    progress_file=None,
+    count=None,
+    metrics=None,
+    retries=3,
+    target_latency=None,
+    albums=None,
+    person_keyword=False,
+):
+    """Merge source photos into the destination library
+
+    Args:
+        src_photos: list or iterable of source photos (e.g. PhotoInfo) from a PhotosSource
+        dest: PhotosBackend for the destination library, already open
+        mergedb: MergeDB to record the merge in
+        reconciled: optional dict of source uuid: destination uuids for in-flight
+            photos from an interrupted merge that are already in the destination library
+        existing: optional FingerprintIndex of the destination library; source photos
+            whose content is already in the destination library are skipped
+        dry_run: if True, don't import anything
+        export_workers: number of threads exporting photos ahead of the import
+        prefetch_depth: maximum number of photos exported ahead of the import
+        import_batch_size: number of photos to import with a single call to Photos
+        progress_file: file to write the progress bar to; default is stdout
+        count: number of photos in src_photos, for the progress bar; required if
+            src_photos is an iterator
+        metrics: optional Metrics to record stage timings in
+        retries: maximum number of times a call to dest is retried if Photos is busy
+        target_latency: if set, adapt the import batch size (up to import_batch_size)
+            to keep import and metadata calls to dest under this many seconds
+        albums: optional AlbumIndex of the source library (see PhotosSource.album_index);
+            default is to read albums from each photo's album_info
+        person_keyword: if True, add a keyword for each named person in a photo
+    """
+    source = MergeSource(
+        src_photos,
+        mergedb,
+        reconciled or {},
+        len(src_photos) if count is None else count,
+        albums,
+    )
+    merge_sources(
+        [source],
+        dest,
+        existing=existing,
+        dry_run=dry_run,
+        export_workers=export_workers,
+        prefetch_depth=prefetch_depth,
+        import_batch_size=import_batch_size,
+        progress_file=progress_file,
+        metrics=metrics,
+        retries=retries,
+        target_latency=target_latency,
+        person_keyword=person_keyword,
+    )
+
+
+def merge_sources(
+    sources,
+    dest,
+    existing=None,
+    dry_run=False,
+    export_workers=1,
+    prefetch_depth=1,
+    import_batch_size=1,
+    progress_file=None,
+    metrics=None,
+    retries=3,
+    target_latency=None,
+    person_keyword=False,
+):
+    """Merge photos from several source libraries into the destination library in a
+    single pass
+
+    Photos are taken from each source in turn so photos from one source are exported
+    while photos from another are imported. Imports are batched across sources and
+    albums with the same folder path and title in different sources are merged into
+    a single destination album.
+
+    Args:
+        sources: list of MergeSource
+        dest: PhotosBackend for the destination library, already open
+        existing: optional FingerprintIndex of the destination library; source photos
+            whose content is already in the destination library (or was imported
+            earlier in the merge) are skipped
+        dry_run: if True, don't import anything
+        export_workers: number of threads exporting photos ahead of the import
+        prefetch_depth: maximum number of photos exported ahead of the import
+        import_batch_size: number of photos to import with a single call to Photos
+        progress_file: file to write the progress bar to; default is stdout
+        metrics: optional Metrics to record stage timings in; calls to dest are
+            timed too
+        retries: maximum number of times a call to dest is retried if Photos is busy
+        target_latency: if set, adapt the import batch size (up to import_batch_size)
+            to keep import and metadata calls to dest under this many seconds
+        person_keyword: if True, add a keyword for each named person in a photo
+    """
+    metrics = metrics or NULL_METRICS
+    if metrics.enabled:
+        dest = TimedBackend(dest, metrics)
+    throttle = Throttle(target_latency, import_batch_size) if target_latency else None
+    dest = ThrottledBackend(dest, throttle=throttle, retries=retries)
+    staging = StagingArea()
+
+    def export_job(item):
+        """export photo in a worker thread if it will be imported """
+        index, src_photo = item
+        path = src_photo_path(src_photo)
+        if src_photo.uuid in sources[index].reconciled or not path:
+            return None
+        if metadata_only(sources[index], src_photo):
+            return None
+        if existing is not None:
+            with metrics.timer("dedupe"):
+                matches = existing.find(path)
+            if matches:
+                return StagedPhoto([], {}, existing=matches)
+        if dry_run:
+            return None
+        if not metrics.enabled:
+            return export_photo(src_photo, staging)
+        start = time.perf_counter()
+        staged = export_photo(src_photo, staging)
+        nbytes = sum(os.path.getsize(f) for f in staged.files)
+        metrics.record("export", time.perf_counter() - start, nbytes)
+        for strategy in staged.strategies.values():
+            metrics.increment(f"staged.{strategy}")
+        return staged
+
+    photos = interleave(
+        [checkpointed(s.photos, s.mergedb, MERGEDB_FLUSH_COUNT) for s in sources]
+    )
+    exports = prefetch(photos, export_job, workers=export_workers, depth=prefetch_depth)
+    batch = ImportBatch(import_batch_size)
+    metadata_writer = MetadataWriter(dest.set_metadata, batch_size=import_batch_size)
+    keywords = KeywordTable(person_keyword)
+    updated = []
+
+    def record_updated():
+        """write the metadata of updated photos, then record them """
+        with metrics.timer("metadata"):
+            metadata_writer.flush()
+        metrics.increment("updated", len(updated))
+        for merge_record, mergedb in updated:
+            mergedb.upsert(merge_record)
+        updated.clear()
+
+    def import_pending():
+        """import the batch and adjust the batch size to the throttle """
+        import_batch(dest, batch, metadata_writer, keywords, existing, metrics)
+        if throttle and batch.size != throttle.batch_size:
+            verbose_(f"Import batch size {throttle.batch_size}")
+            batch.size = metadata_writer.batch_size = throttle.batch_size
+
+    try:
+        with click.progressbar(
+            exports, length=sum(s.count for s in sources), file=progress_file
+        ) as bar:
+            for (index, src_photo), export_future in bar:
+                metrics.tick()
+                source = sources[index]
+                previous = (
+                    source.updated.get(src_photo.uuid) if source.updated else None
                 )
-                merge_record["skipped"] = True
-                mergedb.upsert(merge_record)
-                continue
-
-            # export photo to temp file and rename to original_filename
-            # handling of RAW+JPEG pairs, Live photos, etc. left as exercise for the reader
-            # RAW+JPEG pairs will be correctly handled if imported like this:
-            # dest.import_photos(["/Users/rhet/Desktop/export/IMG_1994.JPG", "/Users/rhet/Desktop/export/IMG_1994.cr2"])
-            # Live Photos will be correctly handled if imported like this:
-            # dest.import_photos(["/Users/rhet/Desktop/export/IMG_3259.HEIC","/Users/rhet/Desktop/export/IMG_3259.mov"])
-            ext = pathlib.Path(path).suffix
-            dest_file = pathlib.Path(src_photo.original_filename).stem + ext
-            verbose_(f"Importing photo {dest_file} ({src_photo.uuid})")
-            with tempfile.TemporaryDirectory() as tmpdir:
-                # get right suffix for original or edited file
-                if not dry_run:
-                    exported = src_photo.export(
-                        tmpdir,
-                        dest_file,
-                        edited=src_photo.hasadjustments,
-                        live_photo=True,
-                        raw_photo=True,
+                # PhotoInfo isn't thread safe so wait for the export job first
+                export_result = export_future.result()
+                if metadata_only(source, src_photo):
+                    verbose_(
+                        f"Updating metadata for {src_photo.original_filename} ({src_photo.uuid})"
                     )
-                    if not exported:
-                        click.secho(
-                            f"Error exporting photo {src_photo.original_filename} ({src_photo.uuid})",
-                            fg=CLI_COLOR_ERROR,
-                        )
-                        merge_record["export_error"] = True
-                        mergedb.upsert(merge_record)
-
+                    if dry_run:
                         continue
-
-                    merge_record["exported"] = [
-                        str(pathlib.Path(f).name) for f in exported
+                    merge_record = updated_record(src_photo, previous)
+                    dest_photos = [dest.photo(uuid) for uuid in previous["import_uuid"]]
+                    finish_photo(
+                        src_photo,
+                        dest_photos,
+                        merge_record,
+                        source,
+                        metadata_writer,
+                        keywords,
+                    )
+                    updated.append((merge_record, source.mergedb))
+                    if len(updated) >= batch.size:
+                        record_updated()
+                    continue
+                merge_record = stage_photo(
+                    src_photo,
+                    export_result,
+                    source.mergedb,
+                    source.reconciled,
+                    dry_run,
+                    previous=previous,
+                )
+                if not merge_record:
+                    continue
+                if src_photo.uuid in source.reconciled:
+                    dest_photos = [
+                        dest.photo(uuid) for uuid in source.reconciled[src_photo.uuid]
                     ]
-                    dest_photos = dest.import_photos(
-                        exported, skip_duplicate_check=True
+                    finish_photo(
+                        src_photo,
+                        dest_photos,
+                        merge_record,
+                        source,
+                        metadata_writer,
+                        keywords,
                     )
-                    if not dest_photos:
-                        click.secho(
-                            f"Error importing photo {src_photo.original_filename} ({src_photo.uuid})",
-                            fg=CLI_COLOR_ERROR,
-                        )
-                        merge_record["import_error"] = True
-                        mergedb.upsert(merge_record)
-                        continue
+                    metadata_writer.flush()
+                    source.mergedb.upsert(merge_record)
+                    continue
+                staged = export_result
+                if not batch.accepts(staged.files):
+                    import_pending()
+                batch.add(
+                    (index, src_photo.uuid),
+                    staged.files,
+                    (src_photo, merge_record, staged, source),
+                )
+                if batch.full:
+                    import_pending()
+            import_pending()
+            record_updated()
+        if not dry_run:
+            verbose_(f"Metadata writes: {metadata_writer.summary()}")
+            verbose_(f"Keyword vocabulary: {len(keywords)} keywords")
+            with metrics.timer("albums"):
+                add_albums(dest, [s.mergedb for s in sources])
+    finally:
+        exports.close()
+        staging.cleanup()
 
-                    merge_record["import_uuid"] = [p.uuid for p in dest_photos]
-                    folder_albums = src_photo.render_template("{folder_album,}")
-                    folder_albums = (
-                        folder_albums[0] if folder_albums[0][0] != "" else []
-                    )
-                    merge_record["metadata"] = {
-                        "favorite": src_photo.favorite,
-                        "description": src_photo.description,
-                        "title": src_photo.title,
-                        "keywords": src_photo.keywords,
-                        "folder_albums": folder_albums,
-                        "persons": src_photo.persons,
-                    }
-                    for dest_photo in dest_photos:
-                        verbose_(f"Setting metadata for {dest_photo.filename}")
-                        dest_photo.favorite = src_photo.favorite
-                        dest_photo.description = src_photo.description
-                        dest_photo.title = src_photo.title
-                        if src_photo.persons:
-                            #TODO: this should be a --person-keyword flag
-                            # add keywords for each person
-                            # dest_photo.keywords = src_photo.keywords + [
-                            #     f"People/{p}" for p in src_photo.persons
-                            # ]
-                            dest_photo.keywords = src_photo.keywords
-                        else:
-                            dest_photo.keywords = src_photo.keywords
-                        if src_photo.location[0]:
-                            dest_photo.location = src_photo.location
-
-                        for album in src_photo.album_info:
-                            if album.folder_names:
-                                # make_folders silently ignores existing folders (like os.makedirs)
-                                verbose_(
-                                    f"Adding folder {'/'.join(album.folder_names)}"
-                                )
-                                folder = dest.make_folders(album.folder_names)
-                                dest_album = folder.album(album.title)
-                                if not dest_album:
-                                    # album doesn't exist
-                                    verbose_(f"Creating album: {album.title}")
-                                    dest_album = folder.create_album(album.title)
-                            else:
-                                dest_album = dest.album(album.title)
-                                if not dest_album:
-                                    dest_album = dest.create_album(album.title)
-                            verbose_(
-                                f"Adding {dest_photo.filename} to album {album.title}"
-                            )
-                            dest_album.add([dest_photo])
-                    merge_record["imported"] = True
-                    mergedb.upsert(merge_record)
-
-    if fp is not None:
-        fp.close()
+
+def metadata_only(source, src_photo):
+    """Return True if src_photo from MergeSource source is a photo merged before that
+    changed since (see --update) but only needs its metadata updated, or whose
+    metadata and albums are being repaired """
+    previous = source.updated.get(src_photo.uuid) if source.updated else None
+    return previous is not None and (
+        source.refresh or not pixels_changed(src_photo, previous)
+    )
+
+
+def updated_record(src_photo, previous):
+    """Return merge record for updating src_photo merged before as recorded in merge
+    record previous; clears any error left from an earlier merge """
+    merge_record = {
+        "src_uuid": src_photo.uuid,
+        "version": __version__,
+        "date": datetime.datetime.now().isoformat(),
+    }
+    for field in ("export_error", "import_error"):
+        if previous.get(field):
+            merge_record[field] = False
+    return merge_record
+
+
+def failed_record(merge_record):
+    """Return merge record to write for a photo that failed to export or import;
+    a photo being re-imported by --update only records the error and keeps its
+    earlier import """
+    if not merge_record.get("replaced_uuid"):
+        return merge_record
+    return {
+        field: value
+        for field, value in merge_record.items()
+        if field in ("src_uuid", "export_error", "import_error", "retries")
+    }
+
+
+def stage_photo(src_photo, export_result, mergedb, reconciled, dry_run, previous=None):
+    """Create the merge record for a source photo and check it's ready to import
+
+    Args:
+        src_photo: PhotoInfo for the source photo
+        export_result: StagedPhoto from export_photo or None if not exported
+        mergedb: MergeDB to record the merge in
+        reconciled: dict of source uuid: destination uuids for reconciled in-flight photos
+        dry_run: if True, don't import anything
+        previous: merge record of the photo if it was merged before and is being
+            re-imported by --update
+
+    Returns:
+        merge record dict if photo should be imported (or reconciled), otherwise None;
+        photos that are skipped or fail to export are recorded in mergedb
+    """
+    merge_record = {
+        "src_uuid": src_photo.uuid,
+        "src_original_filename": src_photo.original_filename,
+        "version": __version__,
+        "date": datetime.datetime.now().isoformat(),
+        "imported": False,
+        "skipped": False,
+    }
+    if previous is not None:
+        merge_record.update(updated_record(src_photo, previous))
+        merge_record["replaced_uuid"] = previous["import_uuid"]
+    path = src_photo_path(src_photo)
+    merge_record["src_path"] = path
+    if not path:
+        click.secho(
+            f"Skipping missing photo {src_photo.original_filename} ({src_photo.uuid})",
+            fg=CLI_COLOR_WARNING,
+        )
+        merge_record["skipped"] = True
+        mergedb.upsert(merge_record)
+        return None
+
+    dest_file = export_filename(src_photo)
+    if src_photo.uuid in reconciled:
+        verbose_(f"Reconciling in-flight photo {dest_file} ({src_photo.uuid})")
+        if dry_run:
+            return None
+        merge_record["reconciled"] = True
+        return merge_record
+
+    if export_result is not None and export_result.existing:
+        verbose_(
+            f"Skipping photo {dest_file} ({src_photo.uuid}) already in destination library"
+        )
+        merge_record["skipped"] = True
+        merge_record["existing_uuid"] = export_result.existing
+        mergedb.upsert(merge_record)
+        return None
+
+    # stage photo (link or export) in the staging area as original_filename
+    # RAW+JPEG pairs will be correctly handled if imported like this:
+    # dest.import_photos(["/Users/rhet/Desktop/export/IMG_1994.JPG", "/Users/rhet/Desktop/export/IMG_1994.cr2"])
+    # Live Photos will be correctly handled if imported like this:
+    # dest.import_photos(["/Users/rhet/Desktop/export/IMG_3259.HEIC","/Users/rhet/Desktop/export/IMG_3259.mov"])
+    verbose_(f"Importing photo {dest_file} ({src_photo.uuid})")
+    if dry_run:
+        return None
+    if not export_result.files:
+        click.secho(
+            f"Error exporting photo {src_photo.original_filename} ({src_photo.uuid})",
+            fg=CLI_COLOR_ERROR,
+        )
+        merge_record["export_error"] = True
+        mergedb.upsert(failed_record(merge_record))
+        export_result.cleanup()
+        return None
+
+    merge_record["exported"] = [str(pathlib.Path(f).name) for f in export_result.files]
+    merge_record["staging"] = export_result.strategies
+    return merge_record
+
+
+def import_batch(
+    dest, batch, metadata_writer, keywords, existing=None, metrics=NULL_METRICS
+):
+    """Import all photos in batch into ThrottledBackend dest, then set metadata (with
+    keywords interned in KeywordTable keywords) and plan albums for each; merge
+    records are written once the metadata for the whole batch is written and record
+    how many calls had to be retried;
+    imported photos are added to FingerprintIndex existing if given """
+    if not batch:
+        return
+    verbose_(f"Importing batch of {len(batch)} photos")
+    retry_count = dest.retry_count
+    try:
+        with metrics.timer("import"):
+            imported, unmatched = batch.import_photos(dest)
+    finally:
+        for _, _, (_, _, staged, _) in batch.items:
+            staged.cleanup()
+        batch.clear()
+    import_retries = dest.retry_count - retry_count
+    retry_count = dest.retry_count
+    for photo in unmatched:
+        click.secho(
+            f"Warning: could not match imported photo {photo.filename} ({photo.uuid}) to a source photo",
+            fg=CLI_COLOR_WARNING,
+        )
+    finished = []
+    for _, (src_photo, merge_record, _, source), dest_photos in imported:
+        if not dest_photos:
+            click.secho(
+                f"Error importing photo {src_photo.original_filename} ({src_photo.uuid})",
+                fg=CLI_COLOR_ERROR,
+            )
+            merge_record["import_error"] = True
+            if import_retries:
+                merge_record["retries"] = import_retries
+            source.mergedb.upsert(failed_record(merge_record))
+            metrics.increment("import_errors")
+            continue
+        finish_photo(
+            src_photo, dest_photos, merge_record, source, metadata_writer, keywords
+        )
+        finished.append((merge_record, source.mergedb))
+        if existing is not None:
+            existing.add(dest_photos[0].uuid, src_photo_path(src_photo))
+    with metrics.timer("metadata"):
+        metadata_writer.flush()
+    metrics.increment("imported", len(finished))
+    retries = import_retries + dest.retry_count - retry_count
+    metrics.increment("retries", retries)
+    for merge_record, mergedb in finished:
+        if retries:
+            merge_record["retries"] = retries
+        mergedb.upsert(merge_record)
+
+
+def add_albums(dest, mergedbs):
+    """Add imported photos to their albums as planned in each MergeDB in mergedbs """
+    verbose_("Adding photos to albums")
+    albums = AlbumRegistry(dest, verbose=verbose_)
+    failed = {}
+    for mergedb in mergedbs:
+        for album, uuids in add_planned_albums(
+            dest, albums, mergedb, chunk_size=ALBUM_ADD_CHUNK_SIZE
+        ).items():
+            failed.setdefault(album, []).extend(uuids)
+    for (folder_names, title), uuids in failed.items():
+        album_path = "/".join(folder_names + (title,))
+        click.secho(
+            f"Error adding {len(uuids)} photos to album {album_path}",
+            fg=CLI_COLOR_ERROR,
+        )
+
+
+def finish_photo(
+    src_photo, dest_photos, merge_record, source, metadata_writer, keywords
+):
+    """Queue metadata for the destination photos imported from src_photo (as planned
+    if source has planned metadata), with its keywords interned in KeywordTable
+    keywords, and plan their album membership in the MergeDB of MergeSource source;
+    the caller must flush metadata_writer then record merge_record """
+    merge_record["import_uuid"] = [p.uuid for p in dest_photos]
+    merge_record["edited"] = bool(src_photo.hasadjustments)
+    if merge_record.get("replaced_uuid"):
+        source.mergedb.plan_album([], REPLACED_ALBUM, merge_record["replaced_uuid"])
+    albums = source.albums
+    if albums is None:
+        albums = AlbumIndex.from_photos([src_photo])
+    folder_albums = albums.folder_albums(src_photo.uuid)
+    merge_record["metadata"] = {
+        "favorite": src_photo.favorite,
+        "description": src_photo.description,
+        "title": src_photo.title,
+        "keywords": src_photo.keywords,
+        "folder_albums": folder_albums,
+        "persons": src_photo.persons,
+    }
+    if source.metadata is not None and src_photo.uuid in source.metadata:
+        metadata = source.metadata[src_photo.uuid]
+    else:
+        metadata = photo_metadata(src_photo, keywords)
+    dest_file = export_filename(src_photo)
+    for dest_photo in dest_photos:
+        verbose_(f"Setting metadata for {dest_file} ({dest_photo.uuid})")
+        metadata_writer.write(dest_photo, metadata)
+
+    for folder_names, title in albums.photo_albums(src_photo.uuid):
+        source.mergedb.plan_album(folder_names, title, [p.uuid for p in dest_photos])
+    merge_record["imported"] = True
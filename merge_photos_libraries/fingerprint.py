@@ -0,0 +1,265 @@
+"""Content fingerprint index of the photos in the destination library """
+
+# Used by --skip-existing to find source photos whose content is already in the
+# destination library (e.g. merging a second source that overlaps the destination
+# or re-merging after the merge database was lost).
+# Each destination original is fingerprinted by its size and a hash of its first and
+# last PARTIAL_HASH_SIZE bytes; a hash of the whole file is only computed when a
+# source photo matches both, and is then cached too.
+# The index is cached in a SQLite database next to the merge database and updated
+# incrementally: only files that are new or whose size or mtime changed are hashed.
+# Files are read with mmap and hashed in a process pool.
+
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import pathlib
+import sqlite3
+import threading
+
+from .utils import noop
+
+PARTIAL_HASH_SIZE = 64 * 1024
+""" number of bytes hashed from each end of a file for the partial hash """
+
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+""" number of bytes fed to the hash at a time for the full hash """
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprint (
+    path TEXT PRIMARY KEY,
+    uuid TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    partial TEXT NOT NULL,
+    full TEXT
+);
+"""
+
+
+def _hash(data):
+    return hashlib.blake2b(data, digest_size=16)
+
+
+def file_hash(path, full=False):
+    """Return hex digest of the first and last PARTIAL_HASH_SIZE bytes of the file at
+    path, or of the whole file if full is True """
+    with open(path, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if not size:
+            return _hash(b"").hexdigest()
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if full:
+                digest = _hash(b"")
+                for offset in range(0, size, HASH_BLOCK_SIZE):
+                    digest.update(data[offset : offset + HASH_BLOCK_SIZE])
+                return digest.hexdigest()
+            if size <= 2 * PARTIAL_HASH_SIZE:
+                return _hash(data[:]).hexdigest()
+            digest = _hash(data[:PARTIAL_HASH_SIZE])
+            digest.update(data[-PARTIAL_HASH_SIZE:])
+            return digest.hexdigest()
+
+
+def _stat_and_hash(path):
+    """Return (size, mtime, partial hash) for path or None if it can't be read;
+    run in a worker process """
+    try:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns, file_hash(path)
+    except OSError:
+        return None
+
+
+class FingerprintIndex:
+    """Index of destination library originals by content
+
+    Args:
+        dbpath: path to the SQLite database the index is cached in
+        workers: number of processes hashing files; if 1, files are hashed in the
+            calling thread
+        verbose: optional function to print verbose output
+
+    find() may be called from several threads at once.
+    """
+
+    def __init__(self, dbpath, workers=None, verbose=None):
+        self._dbpath = pathlib.Path(dbpath)
+        self.verbose = verbose or noop
+        self._workers = workers or os.cpu_count() or 1
+        self._executor = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self._dbpath), check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        # path: [uuid, size, mtime, partial, full]
+        self._files = {
+            row[0]: list(row[1:])
+            for row in self._conn.execute(
+                "SELECT path, uuid, size, mtime, partial, full FROM fingerprint"
+            )
+        }
+        self._by_size = None
+        self._full_hashes = {}
+
+    def _map(self, func, items):
+        """Return list of func(item) for items, using the process pool if enabled """
+        if self._workers == 1 or len(items) < 2:
+            return [func(item) for item in items]
+        return list(self._pool().map(func, items, chunksize=16))
+
+    def _submit(self, func, *args):
+        """Run func(*args) in the process pool if enabled and return the result """
+        if self._workers == 1:
+            return func(*args)
+        return self._pool().submit(func, *args).result()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self._workers
+                )
+            return self._executor
+
+    def update(self, photos):
+        """Bring the index up to date with the destination library
+
+        Args:
+            photos: iterable of (uuid, path) for every original in the destination
+                library; files no longer in photos are removed from the index
+
+        Returns:
+            number of files hashed
+        """
+        current = {str(path): uuid for uuid, path in photos if path}
+        stale = [path for path in self._files if path not in current]
+        changed = []
+        for path, uuid in current.items():
+            entry = self._files.get(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append(path)
+                continue
+            if (
+                entry is None
+                or entry[0] != uuid
+                or entry[1] != stat.st_size
+                or entry[2] != stat.st_mtime_ns
+            ):
+                changed.append(path)
+
+        for path in stale:
+            self._files.pop(path, None)
+        self.verbose(f"Fingerprinting {len(changed)} destination photos")
+        rows = []
+        for path, result in zip(changed, self._map(_stat_and_hash, changed)):
+            if result is None:
+                self._files.pop(path, None)
+                stale.append(path)
+                continue
+            size, mtime, partial = result
+            self._files[path] = [current[path], size, mtime, partial, None]
+            rows.append((path, current[path], size, mtime, partial, None))
+
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM fingerprint WHERE path = ?", [(p,) for p in stale]
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO fingerprint VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+        self._by_size = None
+        return len(changed)
+
+    def add(self, uuid, path):
+        """Add the file at path, just imported as destination photo uuid, to the index
+        for the rest of the merge; it's not saved as the destination library's own
+        copy is fingerprinted by the next update() """
+        try:
+            stat = os.stat(path)
+            partial = file_hash(path)
+        except OSError:
+            return
+        with self._lock:
+            self._files[str(path)] = [
+                uuid,
+                stat.st_size,
+                stat.st_mtime_ns,
+                partial,
+                None,
+            ]
+            if self._by_size is not None:
+                self._by_size.setdefault(stat.st_size, []).append(str(path))
+
+    def __len__(self):
+        return len(self._files)
+
+    def find(self, path):
+        """Return list of uuids of destination photos with the same content as the
+        file at path; empty list if there are none or the file can't be read """
+        with self._lock:
+            if self._by_size is None:
+                self._by_size = {}
+                for file_path, entry in self._files.items():
+                    self._by_size.setdefault(entry[1], []).append(file_path)
+            candidates = list(self._by_size.get(self._size(path), []))
+        if not candidates:
+            return []
+        try:
+            partial = file_hash(path)
+        except OSError:
+            return []
+        # add() changes the index from the main thread, so work on copies of the
+        # entries taken under the lock
+        with self._lock:
+            entries = [
+                (p, list(self._files[p])) for p in candidates if p in self._files
+            ]
+        entries = [(p, entry) for p, entry in entries if entry[3] == partial]
+        if not entries:
+            return []
+
+        try:
+            full = self._submit(file_hash, path, True)
+        except OSError:
+            return []
+        matches = []
+        for candidate, entry in entries:
+            if entry[4] is None:
+                try:
+                    entry[4] = self._submit(file_hash, candidate, True)
+                except OSError:
+                    continue
+                with self._lock:
+                    # another thread may have hashed it or add() replaced it meanwhile
+                    current = self._files.get(candidate)
+                    if current is not None and current[:4] == entry[:4]:
+                        if current[4] is None:
+                            current[4] = entry[4]
+                            self._full_hashes[candidate] = entry[4]
+            if entry[4] == full:
+                matches.append(entry[0])
+        return matches
+
+    @staticmethod
+    def _size(path):
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return None
+
+    def close(self):
+        """Save full hashes computed by find() and shut down the process pool """
+        with self._lock:
+            full_hashes, self._full_hashes = self._full_hashes, {}
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE fingerprint SET full = ? WHERE path = ?",
+                [(full, path) for path, full in full_hashes.items()],
+            )
+        self._conn.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
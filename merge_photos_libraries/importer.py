@@ -0,0 +1,84 @@
+"""Import exported photos into the destination library in batches """
+
+import pathlib
+
+
+def file_key(filename):
+    """Key used to map an imported photo back to the files it was imported from;
+    RAW+JPEG pairs and Live Photos share a stem and import as a single photo """
+    return pathlib.Path(filename).stem.lower()
+
+
+class ImportBatch:
+    """Exported files for one or more source photos to import with a single import_photos call
+
+    Every source photo in a batch must have a distinct file_key so the imported photos
+    can be mapped back to their source photo by filename.
+
+    Args:
+        size: maximum number of source photos in the batch
+    """
+
+    def __init__(self, size=1):
+        if size < 1:
+            raise ValueError("size must be >= 1")
+        self.size = size
+        self.items = []
+        self._keys = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def full(self):
+        """True if the batch has reached its size """
+        return len(self.items) >= self.size
+
+    def accepts(self, exported):
+        """Return True if files in exported can be added without a filename collision """
+        return not self.full and not any(file_key(f) in self._keys for f in exported)
+
+    def add(self, key, exported, item=None):
+        """Add exported files for source photo with key (e.g. uuid) to the batch
+
+        Args:
+            key: unique key for the source photo, e.g. uuid
+            exported: list of exported files for the source photo
+            item: optional object to return with the key when the batch is imported
+        """
+        if not self.accepts(exported):
+            raise ValueError(f"exported files for {key} can't be added to batch")
+        for filename in exported:
+            self._keys[file_key(filename)] = key
+        self.items.append((key, exported, item))
+
+    def clear(self):
+        """Remove all items from the batch """
+        self.items = []
+        self._keys = {}
+
+    def import_photos(self, dest):
+        """Import all files in the batch into dest with a single import_photos call
+
+        Args:
+            dest: PhotosBackend for the destination library
+
+        Returns:
+            tuple of (imported, unmatched) where imported is a list of
+            (key, item, list of destination photos) in the order photos were added
+            and unmatched is a list of destination photos that couldn't be mapped
+            back to a source photo
+        """
+        files = [str(f) for _, exported, _ in self.items for f in exported]
+        dest_photos = (
+            dest.import_photos(files, skip_duplicate_check=True) if files else []
+        )
+        by_key = {key: [] for key, _, _ in self.items}
+        unmatched = []
+        for photo in dest_photos or []:
+            key = self._keys.get(file_key(photo.filename))
+            if key is None:
+                unmatched.append(photo)
+            else:
+                by_key[key].append(photo)
+        return [(key, item, by_key[key]) for key, _, item in self.items], unmatched
@@ -0,0 +1,892 @@
+"""Append-only binary journal to checkpoint merge progress """
+
+# An alternative to the SQLite merge database for very large merges.
+# Every change to a merge record is appended to the journal as a fixed-width
+# record: library paths, versions and album names are interned in a string table,
+# uuids are stored as 16 bytes, flags as bits and the date as an integer. The rest
+# of a merge record (filenames, staging, metadata, ...) is only kept, as a JSON
+# snapshot in a separate file, if snapshots are asked for.
+# The latest state of each photo is kept in an index sorted by (source, destination,
+# uuid) that is mmap-loaded on open, so only records appended since the index was
+# last written are replayed. Superseded records are dropped by compaction, which
+# rewrites the journal once they outnumber the live records.
+#
+# Files in the journal directory:
+#   journal: JOURNAL_HEADER (magic, generation) followed by RECORDs
+#   strings: interned strings, each a 4-byte length followed by UTF-8
+#   snapshots.<generation>: JSON snapshots, each a 4-byte length followed by UTF-8
+#   sources: JSON list of the source state and high-water mark of each (source,
+#       destination), see MergeDB.set_source_state; rewritten whenever it changes
+#   index: INDEX_HEADER (magic, generation, journal bytes covered, number of entries,
+#       superseded records) followed by INDEX_ENTRYs
+
+import datetime
+import json
+import mmap
+import os
+import pathlib
+import struct
+import time
+import uuid as uuidlib
+
+from .mergedb import MergeDB
+from .utils import noop
+
+JOURNAL_MAGIC = b"MPLJRNL1"
+INDEX_MAGIC = b"MPLINDX1"
+
+JOURNAL_HEADER = struct.Struct("<8sQ")
+INDEX_HEADER = struct.Struct("<8sQQQQ")
+
+RECORD = struct.Struct("<BBHIIIqQ16s16s")
+""" kind, flags, retries, source, destination, version or album (string ids), date or
+in-flight time (microseconds), snapshot (offset + 1 or 0), source uuid,
+destination uuid """
+
+INDEX_ENTRY = struct.Struct(">II16sBxxxqq")
+""" source, destination, source uuid, flags, in-flight time, offset of the latest merge
+record (-1 if none); big-endian so entries sort by their first KEY_SIZE bytes """
+
+KEY_SIZE = 24
+LENGTH = struct.Struct("<I")
+
+KIND_MERGE = 1
+KIND_INFLIGHT = 2
+KIND_ALBUM_PLAN = 3
+KIND_ALBUM_ADDED = 4
+
+FLAGS = {
+    "imported": 1,
+    "skipped": 2,
+    "reconciled": 4,
+    "export_error": 8,
+    "import_error": 16,
+    "edited": 64,
+}
+""" merge record fields stored as flags """
+
+FLAG_EXISTING = 32
+""" destination uuid of the record is existing_uuid rather than import_uuid """
+
+FIXED_FIELDS = set(FLAGS) | {
+    "src",
+    "dest",
+    "src_uuid",
+    "version",
+    "date",
+    "retries",
+    "import_uuid",
+    "existing_uuid",
+}
+""" merge record fields stored in the fixed-width record """
+
+COMPACT_MIN_RECORDS = 100_000
+""" don't compact until at least this many records are superseded """
+
+EPOCH = datetime.datetime(1970, 1, 1)
+NO_UUID = bytes(16)
+
+
+def pack_uuid(uuid):
+    """Return uuid string as 16 bytes """
+    try:
+        return uuidlib.UUID(uuid).bytes
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError(f"{uuid!r} is not a UUID; the merge journal only stores UUIDs")
+
+
+def unpack_uuid(data):
+    """Return upper case uuid string (like Photos uuids) for 16 bytes data """
+    h = data.hex().upper()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def journal_files(path):
+    """Return dict of name: path of the files of the journal in directory path """
+    path = pathlib.Path(path)
+    return {name: path / name for name in ("journal", "strings", "index", "sources")}
+
+
+class JournalStore:
+    """Files of a merge journal, shared by the MergeJournal of each source library
+
+    Args:
+        path: journal directory; created if it doesn't exist unless read_only
+        read_only: if True, no files are written
+        verbose: function to print verbose output
+        compact_min: don't compact until at least this many records are superseded
+    """
+
+    def __init__(self, path, read_only=False, verbose=None, compact_min=None):
+        self.path = pathlib.Path(path)
+        self.read_only = read_only
+        self.verbose = verbose or noop
+        self.compact_min = COMPACT_MIN_RECORDS if compact_min is None else compact_min
+        self.files = journal_files(self.path)
+        self.strings = [""]
+        self._string_ids = {"": 0}
+        self.overlay = {}
+        self.live = 0
+        self.superseded = 0
+        self._journal = None
+        self._strings = None
+        self._snapshots = None
+        self._index_fd = None
+        self.index = None
+        self.index_count = 0
+        self.generation = 0
+        self.end = JOURNAL_HEADER.size
+        self.sources = []
+        if self.files["sources"].exists():
+            with open(self.files["sources"], "r") as fd:
+                self.sources = json.load(fd)
+        if not self.files["journal"].exists():
+            if read_only:
+                return
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self.files["journal"], "wb") as fd:
+                fd.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, 0))
+        self._open()
+
+    def _open(self):
+        mode = "rb" if self.read_only else "r+b"
+        self.strings = [""]
+        self._string_ids = {"": 0}
+        if self.files["strings"].exists():
+            with open(self.files["strings"], "rb") as fd:
+                data = fd.read()
+            pos = 0
+            while pos + LENGTH.size <= len(data):
+                (length,) = LENGTH.unpack_from(data, pos)
+                if pos + LENGTH.size + length > len(data):
+                    break
+                value = data[pos + LENGTH.size : pos + LENGTH.size + length]
+                self._string_ids[value.decode()] = len(self.strings)
+                self.strings.append(value.decode())
+                pos += LENGTH.size + length
+            if pos != len(data) and not self.read_only:
+                # drop a string only partly written when a merge was interrupted
+                os.truncate(self.files["strings"], pos)
+        if not self.read_only:
+            self._strings = open(self.files["strings"], "ab")
+
+        self._journal = open(self.files["journal"], mode)
+        magic, self.generation = JOURNAL_HEADER.unpack(
+            self._journal.read(JOURNAL_HEADER.size)
+        )
+        if magic != JOURNAL_MAGIC:
+            raise ValueError(f"{self.path} is not a merge journal")
+        size = os.fstat(self._journal.fileno()).st_size
+        self.end = size - (size - JOURNAL_HEADER.size) % RECORD.size
+        if self.end != size and not self.read_only:
+            # drop a record only partly written when a merge was interrupted
+            self._journal.truncate(self.end)
+        snapshots = self.path / f"snapshots.{self.generation}"
+        if snapshots.exists() or not self.read_only:
+            self._snapshots = open(snapshots, mode if snapshots.exists() else "w+b")
+
+        start = self._load_index()
+        if start < self.end:
+            self.verbose(
+                f"Replaying {(self.end - start) // RECORD.size} merge journal records"
+            )
+            with mmap.mmap(
+                self._journal.fileno(), self.end, access=mmap.ACCESS_READ
+            ) as data:
+                for offset in range(start, self.end, RECORD.size):
+                    self._apply(RECORD.unpack_from(data, offset), offset)
+
+    def source_state(self, source, destination):
+        """Return dict of values recorded by set_source_state() for source and
+        destination libraries (empty if none) """
+        for state in self.sources:
+            if state["src"] == source and state["dest"] == destination:
+                return state
+        return {}
+
+    def set_source_state(self, source, destination, **values):
+        """Record values (e.g. fingerprint and photos, see MergeDB.set_source_state)
+        for source library merged into destination library; the sources file is
+        replaced in one step """
+        state = self.source_state(source, destination)
+        if not state:
+            state = {"src": source, "dest": destination}
+            self.sources.append(state)
+        state.update(values, updated=time.time())
+        if self.read_only:
+            return
+        tmp = self.files["sources"].with_name("sources.tmp")
+        with open(tmp, "w") as fd:
+            json.dump(self.sources, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp, self.files["sources"])
+
+    def _load_index(self):
+        """mmap the index if it matches the journal; returns journal offset to replay from """
+        self.index = None
+        self.index_count = 0
+        if not self.files["index"].exists():
+            return JOURNAL_HEADER.size
+        self._index_fd = open(self.files["index"], "rb")
+        header = self._index_fd.read(INDEX_HEADER.size)
+        if len(header) == INDEX_HEADER.size:
+            magic, generation, covered, count, superseded = INDEX_HEADER.unpack(header)
+            size = INDEX_HEADER.size + count * INDEX_ENTRY.size
+            if (
+                magic == INDEX_MAGIC
+                and generation == self.generation
+                and covered <= self.end
+                and os.fstat(self._index_fd.fileno()).st_size == size
+            ):
+                if count:
+                    self.index = mmap.mmap(
+                        self._index_fd.fileno(), 0, access=mmap.ACCESS_READ
+                    )
+                self.index_count = count
+                self.live = count
+                self.superseded = superseded
+                return covered
+        self.verbose("Merge journal index is out of date, replaying the journal")
+        self._index_fd.close()
+        self._index_fd = None
+        return JOURNAL_HEADER.size
+
+    def _index_key(self, n):
+        pos = INDEX_HEADER.size + n * INDEX_ENTRY.size
+        return self.index[pos : pos + KEY_SIZE]
+
+    def _bisect(self, key):
+        """Return position of the first index entry with key >= key """
+        lo, hi = 0, self.index_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._index_key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def state(self, key):
+        """Return [flags, in-flight time, offset of latest merge record] for key or
+        None if there's no record for key """
+        state = self.overlay.get(key)
+        if state is not None or not self.index_count:
+            return state
+        n = self._bisect(key)
+        if n < self.index_count and self._index_key(n) == key:
+            entry = INDEX_ENTRY.unpack_from(
+                self.index, INDEX_HEADER.size + n * INDEX_ENTRY.size
+            )
+            return list(entry[3:])
+        return None
+
+    def states(self, prefix):
+        """Yield (key, flags, in-flight time, offset) for every photo whose key starts
+        with prefix (source and destination ids) """
+        for n in range(self._bisect(prefix), self.index_count):
+            pos = INDEX_HEADER.size + n * INDEX_ENTRY.size
+            key = self.index[pos : pos + KEY_SIZE]
+            if not key.startswith(prefix):
+                break
+            if key not in self.overlay:
+                yield (key,) + INDEX_ENTRY.unpack_from(self.index, pos)[3:]
+        for key, state in self.overlay.items():
+            if key.startswith(prefix):
+                yield (key,) + tuple(state)
+
+    def _apply(self, record, offset):
+        """Update the state of the photo a record appended at offset is for """
+        kind, flags, _, src, dest, _, when, _, src_uuid, _ = record
+        if kind in (KIND_MERGE, KIND_INFLIGHT):
+            key = struct.pack(">II", src, dest) + src_uuid
+            state = self.state(key)
+            if state is None:
+                self.live += 1
+                state = [0, 0, -1]
+            else:
+                self.superseded += 1
+            if kind == KIND_MERGE:
+                state = [flags, 0, offset]
+            else:
+                state = [state[0], when, state[2]]
+            self.overlay[key] = state
+        elif kind == KIND_ALBUM_ADDED:
+            self.superseded += 2
+
+    def intern(self, value):
+        """Return id of string value in the string table, adding it if needed;
+        returns (id, bytes written) """
+        string_id = self._string_ids.get(value)
+        if string_id is not None:
+            return string_id, 0
+        string_id = self._string_ids[value] = len(self.strings)
+        self.strings.append(value)
+        if self.read_only:
+            return string_id, 0
+        data = value.encode()
+        self._strings.write(LENGTH.pack(len(data)) + data)
+        self._strings.flush()
+        return string_id, LENGTH.size + len(data)
+
+    def add_snapshot(self, value):
+        """Append JSON snapshot value; returns (reference for RECORD, bytes written) """
+        if self.read_only:
+            return 0, 0
+        data = value.encode()
+        self._snapshots.seek(0, os.SEEK_END)
+        offset = self._snapshots.tell()
+        self._snapshots.write(LENGTH.pack(len(data)) + data)
+        return offset + 1, LENGTH.size + len(data)
+
+    def snapshot(self, reference):
+        """Return snapshot string for reference from add_snapshot() """
+        self._snapshots.flush()
+        self._snapshots.seek(reference - 1)
+        (length,) = LENGTH.unpack(self._snapshots.read(LENGTH.size))
+        return self._snapshots.read(length).decode()
+
+    def append(self, records, durable=False):
+        """Append packed records to the journal; if durable, sync them to disk
+        before returning; returns list of record numbers """
+        if self.read_only or not records:
+            return []
+        # strings and snapshots are written before the records referring to them
+        for fd in (self._strings, self._snapshots):
+            if fd is not None:
+                fd.flush()
+                if durable:
+                    os.fsync(fd.fileno())
+        start = self.end
+        self._journal.seek(start)
+        self._journal.write(b"".join(records))
+        self._journal.flush()
+        if durable:
+            os.fsync(self._journal.fileno())
+        self.end = start + len(records) * RECORD.size
+        numbers = []
+        for i, data in enumerate(records):
+            offset = start + i * RECORD.size
+            self._apply(RECORD.unpack(data), offset)
+            numbers.append((offset - JOURNAL_HEADER.size) // RECORD.size + 1)
+        return numbers
+
+    def read(self, offset):
+        """Return RECORD tuple at journal offset """
+        self._journal.seek(offset)
+        return RECORD.unpack(self._journal.read(RECORD.size))
+
+    def albums(self, prefix=None):
+        """Return dict of (source, destination, album id, destination uuid bytes) for
+        album plan records not marked added, optionally only those whose source and
+        destination ids match prefix, in the order planned """
+        planned = {}
+        if self._journal is None or self.end == JOURNAL_HEADER.size:
+            return planned
+        src_dest = struct.unpack(">II", prefix) if prefix else None
+        with mmap.mmap(
+            self._journal.fileno(), self.end, access=mmap.ACCESS_READ
+        ) as data:
+            for offset in range(JOURNAL_HEADER.size, self.end, RECORD.size):
+                kind = data[offset]
+                if kind not in (KIND_ALBUM_PLAN, KIND_ALBUM_ADDED):
+                    continue
+                record = RECORD.unpack_from(data, offset)
+                if src_dest and record[3:5] != src_dest:
+                    continue
+                key = (record[3], record[4], record[5], record[9])
+                if kind == KIND_ALBUM_PLAN:
+                    planned[key] = None
+                else:
+                    planned.pop(key, None)
+        return planned
+
+    def _entries(self):
+        """Yield packed index entries for every photo in key order """
+        overlay = sorted(self.overlay.items())
+        i = 0
+        for n in range(self.index_count):
+            pos = INDEX_HEADER.size + n * INDEX_ENTRY.size
+            key = self.index[pos : pos + KEY_SIZE]
+            while i < len(overlay) and overlay[i][0] < key:
+                yield self._pack_entry(*overlay[i])
+                i += 1
+            if i < len(overlay) and overlay[i][0] == key:
+                yield self._pack_entry(*overlay[i])
+                i += 1
+            else:
+                yield self.index[pos : pos + INDEX_ENTRY.size]
+        for key, state in overlay[i:]:
+            yield self._pack_entry(key, state)
+
+    @staticmethod
+    def _pack_entry(key, state):
+        src, dest = struct.unpack(">II", key[:8])
+        return INDEX_ENTRY.pack(src, dest, key[8:], *state)
+
+    def _write_index(self, path, entries, generation, covered, superseded):
+        """Write index of packed entries to path; returns number of entries """
+        count = 0
+        with open(path, "wb") as fd:
+            fd.write(bytes(INDEX_HEADER.size))
+            for entry in entries:
+                fd.write(entry)
+                count += 1
+            fd.seek(0)
+            fd.write(
+                INDEX_HEADER.pack(INDEX_MAGIC, generation, covered, count, superseded)
+            )
+            fd.flush()
+            os.fsync(fd.fileno())
+        return count
+
+    def save_index(self):
+        """Write the index for the whole journal and mmap it """
+        if self.read_only or not self.overlay:
+            return
+        tmp = self.files["index"].with_name("index.tmp")
+        self._write_index(
+            tmp, self._entries(), self.generation, self.end, self.superseded
+        )
+        self._close_index()
+        os.replace(tmp, self.files["index"])
+        self.overlay = {}
+        self._load_index()
+
+    def _close_index(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        if self._index_fd is not None:
+            self._index_fd.close()
+            self._index_fd = None
+        self.index_count = 0
+
+    def should_compact(self):
+        return (
+            not self.read_only
+            and self.superseded >= self.compact_min
+            and self.superseded > self.live
+        )
+
+    def compact(self):
+        """Rewrite the journal with only the latest record of each photo and album
+        plans not yet added; returns number of records dropped """
+        if self.read_only:
+            return 0
+        records = (self.end - JOURNAL_HEADER.size) // RECORD.size
+        generation = self.generation + 1
+        journal_tmp = self.path / "journal.tmp"
+        index_tmp = self.path / "index.tmp"
+        snapshots_path = self.path / f"snapshots.{generation}"
+        albums = self.albums()
+        kept = 0
+        entries = []
+        with open(journal_tmp, "wb") as journal, open(
+            snapshots_path, "wb"
+        ) as snapshots:
+            journal.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, generation))
+            offset = JOURNAL_HEADER.size
+            for packed in self._entries():
+                src, dest, src_uuid, flags, inflight, record_offset = (
+                    INDEX_ENTRY.unpack(packed)
+                )
+                new_offset = -1
+                if record_offset >= 0:
+                    record = list(self.read(record_offset))
+                    if record[7]:
+                        data = self.snapshot(record[7]).encode()
+                        record[7] = snapshots.tell() + 1
+                        snapshots.write(LENGTH.pack(len(data)) + data)
+                    journal.write(RECORD.pack(*record))
+                    new_offset = offset
+                    offset += RECORD.size
+                    kept += 1
+                if inflight:
+                    journal.write(
+                        RECORD.pack(
+                            KIND_INFLIGHT,
+                            0,
+                            0,
+                            src,
+                            dest,
+                            0,
+                            inflight,
+                            0,
+                            src_uuid,
+                            NO_UUID,
+                        )
+                    )
+                    offset += RECORD.size
+                    kept += 1
+                entries.append(
+                    INDEX_ENTRY.pack(src, dest, src_uuid, flags, inflight, new_offset)
+                )
+            for src, dest, album, dest_uuid in albums:
+                journal.write(
+                    RECORD.pack(
+                        KIND_ALBUM_PLAN,
+                        0,
+                        0,
+                        src,
+                        dest,
+                        album,
+                        0,
+                        0,
+                        NO_UUID,
+                        dest_uuid,
+                    )
+                )
+                offset += RECORD.size
+                kept += 1
+            for fd in (journal, snapshots):
+                fd.flush()
+                os.fsync(fd.fileno())
+        self._write_index(index_tmp, entries, generation, offset, 0)
+
+        # the new index doesn't match the old journal so a crash before the journal is
+        # replaced just replays the old journal
+        self._close()
+        os.replace(index_tmp, self.files["index"])
+        os.replace(journal_tmp, self.files["journal"])
+        old_snapshots = self.path / f"snapshots.{self.generation}"
+        if old_snapshots.exists():
+            old_snapshots.unlink()
+        self.overlay = {}
+        self.live = 0
+        self.superseded = 0
+        self._open()
+        self.verbose(f"Compacted merge journal from {records} to {kept} records")
+        return records - kept
+
+    def _close(self):
+        self._close_index()
+        for fd in (self._journal, self._strings, self._snapshots):
+            if fd is not None:
+                fd.close()
+        self._journal = self._strings = self._snapshots = None
+
+    def close(self):
+        """Write the index and close the journal """
+        if self._journal is not None:
+            self.save_index()
+        self._close()
+
+
+class MergeJournal(MergeDB):
+    """Merge checkpoint stored as an append-only journal of fixed-width records;
+    a drop-in replacement for MergeDB for very large merges
+
+    Args:
+        dbpath: path to the journal directory
+        source_library: path to the source library
+        destination_library: path to the destination library
+        verbose: optional function to print verbose output
+        flush_count: append buffered records once this many are pending
+        flush_interval: append buffered records if this many seconds have passed
+            since the last append
+        metrics: optional Metrics to record time spent writing to the journal
+        snapshots: if True, also store the rest of each merge record (e.g. filenames,
+            staging and metadata) as a JSON snapshot; otherwise only the fields merge
+            reads back are kept
+        read_only: if True, nothing is written, e.g. for a dry run; changes are
+            discarded when flushed
+        compact_min: don't compact until at least this many records are superseded
+
+    Source and destination uuids must be UUIDs; they are returned upper case.
+    """
+
+    def __init__(
+        self,
+        dbpath,
+        source_library,
+        destination_library,
+        verbose=None,
+        flush_count=1,
+        flush_interval=None,
+        metrics=None,
+        snapshots=False,
+        read_only=False,
+        compact_min=None,
+    ):
+        self._snapshots = snapshots
+        self._read_only = read_only
+        self._compact_min = compact_min
+        super().__init__(
+            dbpath,
+            source_library,
+            destination_library,
+            verbose=verbose,
+            flush_count=flush_count,
+            flush_interval=flush_interval,
+            metrics=metrics,
+        )
+
+    def _open_db(self, dbpath):
+        self.verbose(f"Opening merge journal: '{dbpath}'")
+        return JournalStore(dbpath, self._read_only, self.verbose, self._compact_min)
+
+    def _create_db(self, dbpath):
+        self.verbose(f"Creating merge journal: '{dbpath}'")
+        return JournalStore(dbpath, self._read_only, self.verbose, self._compact_min)
+
+    def _intern(self, value):
+        string_id, nbytes = self._db.intern(value)
+        self.bytes_written += nbytes
+        return string_id
+
+    def _prefix(self):
+        return struct.pack(">II", self._intern(self._source), self._intern(self._dest))
+
+    def _select(self, uuid):
+        """Return (record number, record) for uuid or None if not found """
+        state = self._db.state(self._prefix() + pack_uuid(uuid))
+        if state is None:
+            return None
+        offset = state[2]
+        if offset < 0:
+            # only marked in-flight
+            record = {
+                "src_uuid": uuid,
+                "src": self._source,
+                "dest": self._dest,
+                "imported": False,
+            }
+            return 0, record
+        number = (offset - JOURNAL_HEADER.size) // RECORD.size + 1
+        return number, self._unpack(self._db.read(offset))
+
+    def _pack(self, record):
+        """Return record packed as a RECORD """
+        flags = 0
+        for field, bit in FLAGS.items():
+            if record.get(field):
+                flags |= bit
+        snapshot = {}
+        if self._snapshots:
+            snapshot = {k: v for k, v in record.items() if k not in FIXED_FIELDS}
+        dest_uuid = NO_UUID
+        for field in ("import_uuid", "existing_uuid"):
+            uuids = record.get(field) or []
+            if len(uuids) > 1:
+                snapshot[field] = uuids
+            if uuids and dest_uuid == NO_UUID:
+                dest_uuid = pack_uuid(uuids[0])
+                if field == "existing_uuid":
+                    flags |= FLAG_EXISTING
+        date = 0
+        if record.get("date"):
+            try:
+                delta = datetime.datetime.fromisoformat(record["date"]) - EPOCH
+                date = delta // datetime.timedelta(microseconds=1)
+            except (TypeError, ValueError):
+                # not an ISO date or has a time zone
+                snapshot["date"] = record["date"]
+        reference = 0
+        if snapshot:
+            reference, nbytes = self._db.add_snapshot(json.dumps(snapshot))
+            self.bytes_written += nbytes
+        self.bytes_written += RECORD.size
+        return RECORD.pack(
+            KIND_MERGE,
+            flags,
+            min(int(record.get("retries") or 0), 0xFFFF),
+            self._intern(self._source),
+            self._intern(self._dest),
+            self._intern(record.get("version") or ""),
+            date,
+            reference,
+            pack_uuid(record["src_uuid"]),
+            dest_uuid,
+        )
+
+    def _unpack(self, values):
+        """Return merge record dict for a RECORD tuple """
+        (
+            _,
+            flags,
+            retries,
+            src,
+            dest,
+            version,
+            date,
+            reference,
+            src_uuid,
+            dest_uuid,
+        ) = values
+        record = {
+            "src_uuid": unpack_uuid(src_uuid),
+            "src": self._db.strings[src],
+            "dest": self._db.strings[dest],
+        }
+        if version:
+            record["version"] = self._db.strings[version]
+        if date:
+            record["date"] = (EPOCH + datetime.timedelta(microseconds=date)).isoformat()
+        for field, bit in FLAGS.items():
+            if flags & bit or field in ("imported", "skipped"):
+                record[field] = bool(flags & bit)
+        if retries:
+            record["retries"] = retries
+        if dest_uuid != NO_UUID:
+            field = "existing_uuid" if flags & FLAG_EXISTING else "import_uuid"
+            record[field] = [unpack_uuid(dest_uuid)]
+        if reference:
+            record.update(json.loads(self._db.snapshot(reference)))
+        return record
+
+    def _pack_album(self, kind, folder, title, dest_uuid):
+        """Return album plan record for destination uuid dest_uuid in album title in
+        folder (JSON list of folder names) """
+        album = self._intern(f"[{folder},{json.dumps(title)}]")
+        self.bytes_written += RECORD.size
+        return RECORD.pack(
+            kind,
+            0,
+            0,
+            self._intern(self._source),
+            self._intern(self._dest),
+            album,
+            0,
+            0,
+            NO_UUID,
+            pack_uuid(dest_uuid),
+        )
+
+    def insert(self, record):
+        """Insert a record into the merge journal """
+        if not isinstance(record, dict):
+            raise ValueError("record must be a dict")
+        record["src"] = self._source
+        record["dest"] = self._dest
+        if self.get(record["src_uuid"]):
+            raise ValueError(f"record for {record['src_uuid']} already exists")
+        numbers = self._db.append([self._pack(record)])
+        return numbers[0] if numbers else None
+
+    def flush(self):
+        """Append all pending records and album plans to the journal and compact it
+        if due; returns list of record numbers written """
+        numbers = []
+        if (self._pending or self._pending_albums) and self._read_only:
+            self._pending = {}
+            self._pending_albums = []
+        elif self._pending or self._pending_albums:
+            start = time.perf_counter()
+            bytes_written = self.bytes_written
+            records = []
+            for uuid, record in self._pending.items():
+                found = self._select(uuid)
+                if found:
+                    existing = found[1]
+                    existing.update(record)
+                    record = existing
+                records.append(self._pack(record))
+            records += [
+                self._pack_album(KIND_ALBUM_PLAN, folder, title, uuid)
+                for folder, title, uuid in self._pending_albums
+            ]
+            numbers = self._db.append(records)[: len(self._pending)]
+            self._pending = {}
+            self._pending_albums = []
+            self.metrics.record(
+                "checkpoint",
+                time.perf_counter() - start,
+                self.bytes_written - bytes_written,
+            )
+            if self._db.should_compact():
+                with self.metrics.timer("checkpoint.compact"):
+                    self._db.compact()
+        self._last_flush = time.monotonic()
+        return numbers
+
+    def compact(self):
+        """Flush pending records and compact the journal; returns number of records
+        dropped """
+        self.flush()
+        return self._db.compact()
+
+    def mark_inflight(self, uuids):
+        """Durably mark source uuids as in-flight, i.e. about to be merged;
+        the mark is cleared when each photo's record is flushed """
+        now = int(time.time() * 1_000_000)
+        src, dest = self._intern(self._source), self._intern(self._dest)
+        records = [
+            RECORD.pack(
+                KIND_INFLIGHT, 0, 0, src, dest, 0, now, 0, pack_uuid(uuid), NO_UUID
+            )
+            for uuid in uuids
+        ]
+        nbytes = len(records) * RECORD.size
+        self.bytes_written += nbytes
+        with self.metrics.timer("checkpoint.inflight", nbytes):
+            self._db.append(records, durable=True)
+
+    def inflight_uuids(self):
+        """Return dict of source uuid: time marked for photos that were in-flight
+        when a previous merge was interrupted """
+        self.flush()
+        return {
+            unpack_uuid(key[8:]): inflight / 1_000_000
+            for key, _, inflight, _ in self._db.states(self._prefix())
+            if inflight
+        }
+
+    def album_plan(self):
+        """Return dict of (tuple of folder names, album title): list of destination uuids
+        planned for the album but not yet added """
+        self.flush()
+        plan = {}
+        for _, _, album, dest_uuid in self._db.albums(self._prefix()):
+            folder_names, title = json.loads(self._db.strings[album])
+            plan.setdefault((tuple(folder_names), title), []).append(
+                unpack_uuid(dest_uuid)
+            )
+        return plan
+
+    def mark_album_added(self, folder_names, title, dest_uuids):
+        """Record that destination photos dest_uuids were added to the album """
+        self.flush()
+        folder = json.dumps(list(folder_names or []))
+        if self._read_only:
+            return
+        self._db.append(
+            [
+                self._pack_album(KIND_ALBUM_ADDED, folder, title, uuid)
+                for uuid in dest_uuids
+            ]
+        )
+
+    def records(self):
+        self.flush()
+        for _, _, _, offset in self._db.states(self._prefix()):
+            # photos only marked in-flight have no record yet
+            if offset >= 0:
+                yield self._unpack(self._db.read(offset))
+
+    def set_source_state(self, fingerprint, photos):
+        self._db.set_source_state(
+            self._source, self._dest, fingerprint=fingerprint, photos=photos
+        )
+
+    def source_state(self):
+        state = self._db.source_state(self._source, self._dest)
+        return (
+            (state["fingerprint"], state["photos"]) if "fingerprint" in state else None
+        )
+
+    def set_high_water(self, modified):
+        self._db.set_source_state(self._source, self._dest, high_water=modified)
+
+    def high_water(self):
+        return self._db.source_state(self._source, self._dest).get("high_water")
+
+    def imported_uuids(self):
+        """Return set of source uuids already imported from source to destination """
+        self.flush()
+        imported = FLAGS["imported"]
+        return {
+            unpack_uuid(key[8:])
+            for key, flags, _, _ in self._db.states(self._prefix())
+            if flags & imported
+        }
@@ -1,19 +1,149 @@
 """Database to track merge progress"""
 
-# implemented as a JSON flat-file with TinyDB
+# implemented as a SQLite database with one row per (src, dest, src_uuid)
+# the full merge record is stored as JSON in the record column;
+# merge databases created by earlier versions with TinyDB are migrated on open
+# writes are buffered and committed in groups; photos being worked on are marked
+# "in-flight" so a crash can be reconciled on restart
+# album membership is planned in the album_plan table during import and
+# applied in bulk at the end of the merge
+# source_state holds a fingerprint of each source library's database taken when a
+# merge left nothing to do, so an unchanged source can be skipped without reading it;
+# high_water holds the latest time a photo in the source was added or modified as of
+# the last --update so the next one only reads photos changed since
 
+import copy
+import json
+import os
 import pathlib
+import sqlite3
+import time
 
-from tinydb import Query, TinyDB
-from tinydb.storages import MemoryStorage
+from .metrics import NULL_METRICS
+from .utils import noop
 
-from osxphotos.utils import noop
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS merge (
+    id INTEGER PRIMARY KEY,
+    src TEXT NOT NULL,
+    dest TEXT NOT NULL,
+    src_uuid TEXT NOT NULL,
+    imported INTEGER NOT NULL DEFAULT 0,
+    inflight REAL,
+    record TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_merge_src_dest_uuid ON merge (src, dest, src_uuid);
+CREATE TABLE IF NOT EXISTS album_plan (
+    id INTEGER PRIMARY KEY,
+    src TEXT NOT NULL,
+    dest TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    title TEXT NOT NULL,
+    dest_uuid TEXT NOT NULL,
+    added INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_album_plan ON album_plan (src, dest, folder, title, dest_uuid);
+CREATE TABLE IF NOT EXISTS source_state (
+    src TEXT NOT NULL,
+    dest TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    photos INTEGER,
+    updated REAL NOT NULL,
+    PRIMARY KEY (src, dest)
+);
+CREATE TABLE IF NOT EXISTS high_water (
+    src TEXT NOT NULL,
+    dest TEXT NOT NULL,
+    modified REAL NOT NULL,
+    PRIMARY KEY (src, dest)
+);
+"""
+
+# columns added to the merge table after the first SQLite release
+ADDED_COLUMNS = {"inflight": "REAL"}
+
+
+def is_sqlite_db(dbpath):
+    """Return True if dbpath is a SQLite database, False otherwise (e.g. TinyDB JSON file) """
+    with open(dbpath, "rb") as fd:
+        return fd.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def tinydb_backup(dbpath):
+    """Return path the TinyDB merge database at dbpath is kept at once migrated """
+    return dbpath.with_name(f"{dbpath.name}.tinydb.bak")
+
+
+def remove_sqlite_files(dbpath):
+    """Remove the SQLite database at dbpath with its write-ahead log and shared
+    memory files, if they exist """
+    for path in (dbpath, f"{dbpath}-wal", f"{dbpath}-shm"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def interrupted_migration(dbpath):
+    """Return True if a migration of the TinyDB merge database at dbpath was
+    interrupted: the TinyDB backup exists but dbpath is missing, empty or a SQLite
+    database without any merge records (as left by versions that created the SQLite
+    database in place before migrating the records) """
+    if not tinydb_backup(dbpath).exists():
+        return False
+    if not dbpath.exists() or not dbpath.stat().st_size:
+        return True
+    if not is_sqlite_db(dbpath):
+        return False
+    conn = sqlite3.connect(f"{dbpath.resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        return conn.execute("SELECT 1 FROM merge LIMIT 1").fetchone() is None
+    except sqlite3.OperationalError:
+        return True
+    finally:
+        conn.close()
+
+
+def read_tinydb_records(dbpath):
+    """Read all records from a TinyDB JSON file without requiring tinydb """
+    with open(dbpath, "r") as fd:
+        data = fd.read()
+    if not data.strip():
+        return []
+    tables = json.loads(data)
+    docs = tables.get("_default", {})
+    # TinyDB document IDs are strings of ints; preserve insertion order
+    return [docs[doc_id] for doc_id in sorted(docs, key=int)]
 
 
 class MergeDB:
-    """Database to checkpoint merge progress """
+    """Database to checkpoint merge progress
 
-    def __init__(self, dbpath, source_library, destination_library, verbose=None):
+    Args:
+        dbpath: path to the merge database
+        source_library: path to the source library
+        destination_library: path to the destination library
+        verbose: optional function to print verbose output
+        flush_count: commit buffered records once this many are pending
+        flush_interval: commit buffered records if this many seconds have passed since the last commit
+        metrics: optional Metrics to record time spent writing to the database
+
+    Attributes:
+        bytes_written: total size of the merge records written to the database
+    """
+
+    def __init__(
+        self,
+        dbpath,
+        source_library,
+        destination_library,
+        verbose=None,
+        flush_count=1,
+        flush_interval=None,
+        metrics=None,
+    ):
         if type(dbpath) != pathlib.Path:
             dbpath = pathlib.Path(dbpath)
         self._dbpath = dbpath
@@ -22,15 +152,120 @@ class MergeDB:
             raise ValueError("source_library and dest_library must be set")
         self._source = str(source_library)
         self._dest = str(destination_library)
-        self._db = self._open_db(dbpath) if dbpath.exists else self._create_db(dbpath)
+        self._flush_count = flush_count
+        self._flush_interval = flush_interval
+        self._pending = {}
+        self._pending_albums = []
+        self._last_flush = time.monotonic()
+        self.bytes_written = 0
+        self.metrics = metrics or NULL_METRICS
+        self._shared = False
+        self._db = (
+            self._open_db(dbpath)
+            if dbpath.exists() or tinydb_backup(dbpath).exists()
+            else self._create_db(dbpath)
+        )
 
     def _open_db(self, dbpath):
         self.verbose(f"Opening merge database: '{dbpath}'")
-        return TinyDB(dbpath)
+        if interrupted_migration(dbpath):
+            self.verbose("Resuming interrupted migration of TinyDB merge database")
+            return self._migrate_tinydb(dbpath, tinydb_backup(dbpath))
+        if is_sqlite_db(dbpath):
+            return self._connect(dbpath)
+        return self._migrate_tinydb(dbpath)
 
     def _create_db(self, dbpath):
         self.verbose(f"Creating merge database: '{dbpath}'")
-        return TinyDB(dbpath)
+        return self._connect(dbpath)
+
+    def _connect(self, dbpath):
+        """Connect to the SQLite database at dbpath and create schema if needed """
+        conn = sqlite3.connect(str(dbpath))
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(merge)")}
+        for column, column_type in ADDED_COLUMNS.items():
+            if column not in columns:
+                conn.execute(f"ALTER TABLE merge ADD COLUMN {column} {column_type}")
+        return conn
+
+    def _migrate_tinydb(self, dbpath, tinydb_path=None):
+        """One-way migration of the TinyDB merge database at tinydb_path (default
+        dbpath) to SQLite at dbpath; the original file is kept alongside as
+        dbpath.tinydb.bak
+
+        The SQLite database is built and committed next to dbpath and only then
+        moved onto it, so an interrupted migration never leaves an empty database
+        at dbpath and is resumed from the backup by the next open.
+        """
+        tinydb_path = tinydb_path or dbpath
+        backup = tinydb_backup(dbpath)
+        migrating = dbpath.with_name(f"{dbpath.name}.migrating")
+        self.verbose(f"Migrating TinyDB merge database '{tinydb_path}' to SQLite")
+        records = read_tinydb_records(tinydb_path)
+        remove_sqlite_files(migrating)
+        conn = self._connect(migrating)
+        try:
+            self._insert_records(conn, records)
+        finally:
+            # closing checkpoints the write-ahead log into the database file
+            conn.close()
+        if tinydb_path != backup:
+            os.replace(tinydb_path, backup)
+        # drop any database left at dbpath by an earlier interrupted migration
+        remove_sqlite_files(dbpath)
+        os.replace(migrating, dbpath)
+        self.verbose(f"Migrated {len(records)} records, backup saved to '{backup}'")
+        return self._connect(dbpath)
+
+    @staticmethod
+    def _insert_records(conn, records):
+        """Insert or replace records (dicts with src, dest, src_uuid) into conn """
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO merge (src, dest, src_uuid, imported, record) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        r["src"],
+                        r["dest"],
+                        r["src_uuid"],
+                        int(bool(r.get("imported"))),
+                        json.dumps(r),
+                    )
+                    for r in records
+                    if "src_uuid" in r and "src" in r and "dest" in r
+                ),
+            )
+
+    def _select(self, uuid):
+        """Return (id, record) for uuid or None if not found """
+        row = self._db.execute(
+            "SELECT id, record FROM merge WHERE src = ? AND dest = ? AND src_uuid = ?",
+            (self._source, self._dest, uuid),
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def _write(self, record):
+        """Insert or replace record and clear its in-flight mark; returns row id """
+        data = json.dumps(record)
+        self.bytes_written += len(data)
+        cursor = self._db.execute(
+            "INSERT INTO merge (src, dest, src_uuid, imported, record) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (src, dest, src_uuid) DO UPDATE SET "
+            "imported = excluded.imported, inflight = NULL, record = excluded.record",
+            (
+                self._source,
+                self._dest,
+                record["src_uuid"],
+                int(bool(record.get("imported"))),
+                data,
+            ),
+        )
+        return cursor.lastrowid
 
     def insert(self, record):
         """Insert a record into merge database """
@@ -38,61 +273,268 @@ class MergeDB:
             raise ValueError("record must be a dict")
         record["src"] = self._source
         record["dest"] = self._dest
-        self._db.insert(record)
+        if self.get(record["src_uuid"]):
+            raise ValueError(f"record for {record['src_uuid']} already exists")
+        with self._db:
+            return self._write(record)
 
     def update(self, record):
-        """Update record that matches record["src_uuid"] """
-        uuid = record["src_uuid"]
-        Record = Query()
-        return self._db.update(
-            record,
-            (Record.src_uuid == uuid)
-            & (Record.src == self._source)
-            & (Record.dest == self._dest),
-        )
+        """Update record that matches record["src_uuid"];
+        the write is buffered and may not be committed until the next flush """
+        if not self.get(record["src_uuid"]):
+            return []
+        return self._buffer(record)
 
     def upsert(self, record):
-        """Update or insert record that matches record["src_uuid"] """
-        uuid = record["src_uuid"]
+        """Update or insert record that matches record["src_uuid"];
+        the write is buffered and may not be committed until the next flush """
         record["src"] = self._source
         record["dest"] = self._dest
-        Record = Query()
-        return self._db.upsert(
-            record,
-            (Record.src_uuid == uuid)
-            & (Record.src == self._source)
-            & (Record.dest == self._dest),
-        )
+        return self._buffer(record)
+
+    def _buffer(self, record):
+        """Add record to the pending group and flush the group if it's due;
+        returns list of row ids written if flushed, otherwise empty list """
+        uuid = record["src_uuid"]
+        if uuid in self._pending:
+            self._pending[uuid].update(record)
+        else:
+            self._pending[uuid] = dict(record)
+        if len(self._pending) >= self._flush_count or (
+            self._flush_interval is not None
+            and time.monotonic() - self._last_flush >= self._flush_interval
+        ):
+            return self.flush()
+        return []
+
+    def flush(self):
+        """Commit all pending records and album plans in a single transaction;
+        returns list of row ids written """
+        row_ids = []
+        if self._pending or self._pending_albums:
+            start = time.perf_counter()
+            bytes_written = self.bytes_written
+            with self._db:
+                for uuid, record in self._pending.items():
+                    found = self._select(uuid)
+                    if found:
+                        existing = found[1]
+                        existing.update(record)
+                        self._write(existing)
+                        row_ids.append(found[0])
+                    else:
+                        row_ids.append(self._write(record))
+                # planning a photo already added to the album again (e.g. by repair)
+                # adds it again, as with the journal
+                self._db.executemany(
+                    "INSERT INTO album_plan (src, dest, folder, title, dest_uuid) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (src, dest, folder, title, dest_uuid) DO UPDATE SET added = 0",
+                    (
+                        (self._source, self._dest, folder, title, uuid)
+                        for folder, title, uuid in self._pending_albums
+                    ),
+                )
+            self._pending = {}
+            self._pending_albums = []
+            self.metrics.record(
+                "checkpoint",
+                time.perf_counter() - start,
+                self.bytes_written - bytes_written,
+            )
+        self._last_flush = time.monotonic()
+        return row_ids
 
     def get(self, uuid, imported=None):
-        """Get a record by source uuid """
-        Record = Query()
-        if imported is not None:
-            return self._db.search(
-                (Record.src_uuid == uuid)
-                & (Record.src == self._source)
-                & (Record.dest == self._dest)
-                & (Record.imported == imported)
+        """Get a record by source uuid, including records not yet flushed """
+        found = self._select(uuid)
+        record = found[1] if found else {}
+        record.update(self._pending.get(uuid, {}))
+        if not record:
+            return []
+        if imported is not None and bool(record.get("imported")) != imported:
+            return []
+        return [record]
+
+    def mark_inflight(self, uuids):
+        """Durably mark source uuids as in-flight, i.e. about to be merged;
+        the mark is cleared when each photo's record is flushed """
+        now = time.time()
+        rows = [
+            (
+                self._source,
+                self._dest,
+                uuid,
+                now,
+                json.dumps(
+                    {
+                        "src_uuid": uuid,
+                        "src": self._source,
+                        "dest": self._dest,
+                        "imported": False,
+                    }
+                ),
             )
-        else:
-            return self._db.search(
-                (Record.src_uuid == uuid)
-                & (Record.src == self._source)
-                & (Record.dest == self._dest)
+            for uuid in uuids
+        ]
+        nbytes = sum(len(row[-1]) for row in rows)
+        self.bytes_written += nbytes
+        with self.metrics.timer("checkpoint.inflight", nbytes), self._db:
+            self._db.executemany(
+                "INSERT INTO merge (src, dest, src_uuid, imported, inflight, record) "
+                "VALUES (?, ?, ?, 0, ?, ?) "
+                "ON CONFLICT (src, dest, src_uuid) DO UPDATE SET inflight = excluded.inflight",
+                rows,
+            )
+
+    def inflight_uuids(self):
+        """Return dict of source uuid: time marked for photos that were in-flight
+        when a previous merge was interrupted """
+        self.flush()
+        rows = self._db.execute(
+            "SELECT src_uuid, inflight FROM merge "
+            "WHERE src = ? AND dest = ? AND inflight IS NOT NULL",
+            (self._source, self._dest),
+        )
+        return {row[0]: row[1] for row in rows}
+
+    def plan_album(self, folder_names, title, dest_uuids):
+        """Record that destination photos dest_uuids should be added to album title
+        in folder path folder_names; the write is buffered until the next flush """
+        folder = json.dumps(list(folder_names or []))
+        self._pending_albums.extend((folder, title, uuid) for uuid in dest_uuids)
+
+    def album_plan(self):
+        """Return dict of (tuple of folder names, album title): list of destination uuids
+        planned for the album but not yet added """
+        self.flush()
+        rows = self._db.execute(
+            "SELECT folder, title, dest_uuid FROM album_plan "
+            "WHERE src = ? AND dest = ? AND added = 0 ORDER BY id",
+            (self._source, self._dest),
+        )
+        plan = {}
+        for folder, title, uuid in rows:
+            plan.setdefault((tuple(json.loads(folder)), title), []).append(uuid)
+        return plan
+
+    def mark_album_added(self, folder_names, title, dest_uuids):
+        """Record that destination photos dest_uuids were added to the album """
+        folder = json.dumps(list(folder_names or []))
+        with self._db:
+            self._db.executemany(
+                "UPDATE album_plan SET added = 1 WHERE src = ? AND dest = ? "
+                "AND folder = ? AND title = ? AND dest_uuid = ?",
+                (
+                    (self._source, self._dest, folder, title, uuid)
+                    for uuid in dest_uuids
+                ),
+            )
+
+    def imported_uuids(self):
+        """Return set of source uuids already imported from source to destination """
+        self.flush()
+        rows = self._db.execute(
+            "SELECT src_uuid FROM merge WHERE src = ? AND dest = ? AND imported = 1",
+            (self._source, self._dest),
+        )
+        return {row[0] for row in rows}
+
+    def records(self):
+        """Yield every merge record from source to destination, e.g. to check a merge
+        in bulk rather than with get() for each photo """
+        self.flush()
+        rows = self._db.execute(
+            "SELECT record FROM merge WHERE src = ? AND dest = ? ORDER BY id",
+            (self._source, self._dest),
+        )
+        for (record,) in rows:
+            yield json.loads(record)
+
+    def set_source_state(self, fingerprint, photos):
+        """Record that every photo of the source library was merged when its database
+        had fingerprint and photos photos (see source.library_fingerprint and
+        source.library_photo_count) """
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO source_state "
+                "(src, dest, fingerprint, photos, updated) VALUES (?, ?, ?, ?, ?)",
+                (self._source, self._dest, fingerprint, photos, time.time()),
+            )
+
+    def source_state(self):
+        """Return (fingerprint, photos) recorded by set_source_state() or None """
+        row = self._db.execute(
+            "SELECT fingerprint, photos FROM source_state WHERE src = ? AND dest = ?",
+            (self._source, self._dest),
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def set_high_water(self, modified):
+        """Record modified (seconds since the epoch) as the latest time a photo in the
+        source library was added or modified when it was last merged with --update """
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO high_water (src, dest, modified) VALUES (?, ?, ?)",
+                (self._source, self._dest, modified),
             )
 
+    def high_water(self):
+        """Return time recorded by set_high_water() or None """
+        row = self._db.execute(
+            "SELECT modified FROM high_water WHERE src = ? AND dest = ?",
+            (self._source, self._dest),
+        ).fetchone()
+        return row[0] if row else None
+
+    def for_source(self, source_library):
+        """Return a MergeDB for merging another source library into the same
+        destination library that shares this database connection; records, in-flight
+        marks and album plans are kept separately for each source
+
+        Only the MergeDB the view was created from closes the database connection.
+        """
+        if not source_library:
+            raise ValueError("source_library must be set")
+        view = copy.copy(self)
+        view._source = str(source_library)
+        view._pending = {}
+        view._pending_albums = []
+        view._last_flush = time.monotonic()
+        view.bytes_written = 0
+        view._shared = True
+        return view
+
+    def close(self):
+        """Flush pending records and close the database """
+        self.flush()
+        if not self._shared:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 
 class MergeDBInMemory(MergeDB):
     """Database to checkpoint merge progress, in memory only """
 
     def _open_db(self, dbpath):
         self.verbose(f"Opening merge database: '{dbpath}'")
-        # copy the existing database into memory
-        db = TinyDB(dbpath)
-        db_ram = TinyDB(storage=MemoryStorage)
-        db_ram.insert_multiple(db.all())
+        # copy the existing database into memory, leaving the file untouched
+        db_ram = self._connect(":memory:")
+        if interrupted_migration(dbpath):
+            self._insert_records(db_ram, read_tinydb_records(tinydb_backup(dbpath)))
+        elif is_sqlite_db(dbpath):
+            db_disk = sqlite3.connect(str(dbpath))
+            db_disk.backup(db_ram)
+            db_disk.close()
+        else:
+            self._insert_records(db_ram, read_tinydb_records(dbpath))
         return db_ram
 
     def _create_db(self, dbpath):
         self.verbose(f"Creating merge database: '{dbpath}'")
-        return TinyDB(storage=MemoryStorage)
+        return self._connect(":memory:")
@@ -0,0 +1,244 @@
+"""Write metadata to destination photos with as few calls to Photos as possible """
+
+# Each photo's metadata is written by a single AppleScript (or one script for a
+# batch of photos) which compares each property with the value already in Photos
+# and only sets the ones that differ. This skips no-op writes such as an empty
+# description or favorite=False on a freshly imported photo while still
+# overwriting any value Photos read from the file's own metadata on import.
+# Keywords are interned once for the whole merge by a KeywordTable: photos with the
+# same keywords share one tuple, each distinct list of keywords is declared once per
+# script and keywords are compared as sets, so a differently ordered list already on
+# the photo isn't rewritten.
+
+import sys
+
+from .source import UNKNOWN_PERSON
+
+METADATA_FIELDS = ("favorite", "title", "description", "keywords", "location")
+""" fields set on destination photos, in the order they're written """
+
+METADATA_DEFAULTS = {
+    "favorite": False,
+    "title": "",
+    "description": "",
+    "keywords": [],
+    "location": (None, None),
+}
+""" metadata of a photo imported from a file without any of these fields """
+
+PERSON_KEYWORD_FORMAT = "People/{}"
+""" keyword added for each person in a photo with --person-keyword """
+
+# Photos AppleScript property name and value used when the property is missing
+APPLESCRIPT_PROPERTIES = {
+    "favorite": ("favorite", "false"),
+    "title": ("name", '""'),
+    "description": ("description", '""'),
+    "keywords": ("keywords", "{}"),
+    "location": ("location", None),
+}
+
+
+class KeywordTable:
+    """Keyword and person names interned once for the whole merge
+
+    Args:
+        person_keyword: if True, photo_keywords() adds a keyword (PERSON_KEYWORD_FORMAT)
+            for each named person in the photo; unknown persons are left out
+
+    Attributes:
+        words: keyword vocabulary, every distinct keyword in the order first seen
+    """
+
+    def __init__(self, person_keyword=False):
+        self.person_keyword = person_keyword
+        self.words = []
+        self._ids = {}
+        self._lists = {}
+
+    def __len__(self):
+        return len(self.words)
+
+    def intern(self, value):
+        """Return the shared copy of string value """
+        return sys.intern(value)
+
+    def photo_keywords(self, src_photo):
+        """Return tuple of keywords to set on the destination photos for src_photo;
+        photos with the same keywords (and persons with person_keyword) share a tuple """
+        persons = tuple(src_photo.persons) if self.person_keyword else ()
+        key = (tuple(src_photo.keywords), persons)
+        keywords = self._lists.get(key)
+        if keywords is None:
+            values = [self.intern(k) for k in key[0]]
+            values += [
+                self.intern(PERSON_KEYWORD_FORMAT.format(p))
+                for p in persons
+                if p and p != UNKNOWN_PERSON
+            ]
+            keywords = self._lists[key] = tuple(dict.fromkeys(values))
+            for word in keywords:
+                if word not in self._ids:
+                    self._ids[word] = len(self.words)
+                    self.words.append(word)
+        return keywords
+
+
+def photo_metadata(src_photo, keywords=None):
+    """Return dict of metadata to set on the destination photos for src_photo;
+    location is only included if the source photo has one; keywords are interned in
+    KeywordTable keywords if given """
+    metadata = {
+        "favorite": bool(src_photo.favorite),
+        "title": src_photo.title or "",
+        "description": src_photo.description or "",
+        "keywords": (
+            keywords.photo_keywords(src_photo)
+            if keywords is not None
+            else list(src_photo.keywords)
+        ),
+    }
+    if src_photo.location[0]:
+        metadata["location"] = tuple(src_photo.location)
+    return metadata
+
+
+def same_value(field, value, current):
+    """Return True if value of metadata field is the same as current; keywords are
+    compared as sets as Photos doesn't keep their order """
+    if field == "keywords":
+        return set(value or ()) == set(current or ())
+    return value == current
+
+
+def metadata_delta(metadata, current=None):
+    """Return dict of the fields in metadata that differ from current (dict of
+    field: value); default is a photo imported without metadata """
+    current = METADATA_DEFAULTS if current is None else current
+    return {
+        field: value
+        for field, value in metadata.items()
+        if not same_value(field, value, current.get(field))
+    }
+
+
+class MetadataWriter:
+    """Buffer metadata writes for destination photos and send them in batches
+
+    Args:
+        apply: function called with a list of (photo, metadata dict) that writes the
+            metadata and returns a list with the names of the fields actually written
+            for each photo
+        batch_size: send buffered writes once this many photos are pending
+
+    Attributes:
+        batch_size: as above; may be changed between writes
+        counts: dict of field: {"written": count, "skipped": count}
+    """
+
+    def __init__(self, apply, batch_size=1):
+        self._apply = apply
+        self.batch_size = batch_size
+        self._pending = []
+        self.counts = {field: {"written": 0, "skipped": 0} for field in METADATA_FIELDS}
+
+    def write(self, photo, metadata):
+        """Queue metadata (dict of field: value) to be written to destination photo """
+        self._pending.append((photo, metadata))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send all pending writes """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        for (_, metadata), written in zip(pending, self._apply(pending)):
+            for field in metadata:
+                self.counts[field]["written" if field in written else "skipped"] += 1
+
+    def summary(self):
+        """Return one-line summary of fields written and skipped """
+        return ", ".join(
+            f"{field}: {count['written']} written, {count['skipped']} skipped"
+            for field, count in self.counts.items()
+        )
+
+
+def applescript_value(value):
+    """Return AppleScript literal for a Python bool, str, number, list or tuple """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, str):
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+        return f'"{escaped}"'
+    if isinstance(value, (list, tuple)):
+        return "{" + ", ".join(applescript_value(v) for v in value) + "}"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    raise ValueError(f"can't convert {value!r} to AppleScript")
+
+
+SAME_KEYWORDS_HANDLER = [
+    "on sameKeywords(a, b)",
+    "considering case",
+    "if (count of a) is not (count of b) then return false",
+    "repeat with k in b",
+    "if a does not contain {contents of k} then return false",
+    "end repeat",
+    "end considering",
+    "return true",
+    "end sameKeywords",
+]
+""" AppleScript handler comparing two lists of distinct keywords as sets """
+
+
+def metadata_applescript(items):
+    """Return AppleScript source that writes metadata to photos and returns, for each
+    photo, a list of the fields that were changed
+
+    Args:
+        items: list of (photo id, metadata dict)
+    """
+    # declare each distinct list of keywords once and refer to it by name
+    keyword_lists = {}
+    for _, metadata in items:
+        if "keywords" in metadata:
+            keywords = tuple(dict.fromkeys(metadata["keywords"]))
+            keyword_lists.setdefault(keywords, f"k{len(keyword_lists)}")
+    lines = ["on run", "set changed to {}"]
+    lines += [
+        f"set {name} to {applescript_value(keywords)}"
+        for keywords, name in keyword_lists.items()
+    ]
+    lines.append('tell application "Photos"')
+    for photo_id, metadata in items:
+        lines += [
+            f"set p to media item id {applescript_value(photo_id)}",
+            "set fields to {}",
+            "considering case",
+        ]
+        for field in METADATA_FIELDS:
+            if field not in metadata:
+                continue
+            prop, default = APPLESCRIPT_PROPERTIES[field]
+            lines.append(f"set v to {prop} of p")
+            if default is not None:
+                lines.append(f"if v is missing value then set v to {default}")
+            if field == "keywords":
+                value = keyword_lists[tuple(dict.fromkeys(metadata[field]))]
+                condition = f"not my sameKeywords(v, {value})"
+            else:
+                value = applescript_value(metadata[field])
+                condition = f"v is not {value}"
+            lines += [
+                f"if {condition} then",
+                f"set {prop} of p to {value}",
+                f'set end of fields to "{field}"',
+                "end if",
+            ]
+        lines += ["end considering", "set end of changed to fields"]
+    lines += ["end tell", "return changed", "end run"]
+    if keyword_lists:
+        lines += SAME_KEYWORDS_HANDLER
+    return "\n".join(lines)
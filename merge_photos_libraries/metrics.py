@@ -0,0 +1,273 @@
+"""Timers and counters for each stage of a merge """
+
+# Each stage (export, import, metadata, albums, checkpoint, and every call made to
+# the destination library) records how many times it ran, total and maximum time,
+# bytes processed and a latency histogram. A one-line summary can be printed
+# periodically and snapshots written to a JSON lines or CSV file.
+# When metrics are off, NULL_METRICS is used: its methods do nothing and its timer
+# is a shared no-op context manager so instrumented code pays only a method call.
+
+import bisect
+import contextlib
+import csv
+import json
+import threading
+import time
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+""" upper bounds (seconds) of the latency histogram buckets; the last bucket is unbounded """
+
+CSV_FIELDS = (
+    "elapsed",
+    "stage",
+    "count",
+    "seconds",
+    "bytes",
+    "bytes_per_sec",
+    "p50",
+    "p90",
+    "p99",
+    "max",
+)
+""" columns of the CSV metrics file, one row per stage per snapshot """
+
+
+class StageStats:
+    """Timings for one stage
+
+    Attributes:
+        count: number of times the stage ran
+        seconds: total time spent in the stage
+        bytes: total bytes processed by the stage
+        max: longest single run
+        buckets: histogram of run times; buckets[i] counts runs taking at most
+            LATENCY_BUCKETS[i] seconds, the last bucket counts longer runs
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds, nbytes=0):
+        self.count += 1
+        self.seconds += seconds
+        self.bytes += nbytes
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def percentile(self, fraction):
+        """Return upper bound of the histogram bucket holding the fraction percentile;
+        the maximum if it's in the unbounded bucket """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "seconds": round(self.seconds, 6),
+            "bytes": self.bytes,
+            "bytes_per_sec": (
+                round(self.bytes / self.seconds, 1) if self.seconds else 0.0
+            ),
+            "p50": round(self.percentile(0.5), 6),
+            "p90": round(self.percentile(0.9), 6),
+            "p99": round(self.percentile(0.99), 6),
+            "max": round(self.max, 6),
+            "histogram": dict(
+                zip([str(b) for b in LATENCY_BUCKETS] + ["inf"], self.buckets)
+            ),
+        }
+
+
+class Metrics:
+    """Collect per-stage timings and counters for a merge
+
+    Args:
+        path: optional file to write snapshots to; CSV if the name ends with .csv,
+            otherwise JSON lines
+        interval: write a snapshot (and call report) at most this often, in seconds
+        report: optional function called with a one-line summary with each snapshot
+
+    Timers and counters may be updated from several threads.
+    """
+
+    enabled = True
+
+    def __init__(self, path=None, interval=60, report=None):
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._interval = interval
+        self._next = self._start + interval
+        self._report = report
+        self.stages = {}
+        self.counters = {}
+        self._fd = open(path, "w", newline="") if path else None
+        self._csv = None
+        if self._fd and str(path).lower().endswith(".csv"):
+            self._csv = csv.DictWriter(self._fd, fieldnames=CSV_FIELDS)
+            self._csv.writeheader()
+
+    def record(self, stage, seconds, nbytes=0):
+        """Record one run of stage that took seconds and processed nbytes """
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats()
+            stats.add(seconds, nbytes)
+
+    @contextlib.contextmanager
+    def timer(self, stage, nbytes=0):
+        """Context manager recording the time spent in the block as a run of stage """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, nbytes)
+
+    def increment(self, counter, value=1):
+        """Add value to counter """
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def tick(self):
+        """Write a snapshot if interval has passed since the last one """
+        if time.monotonic() >= self._next:
+            self.snapshot()
+
+    def snapshot(self):
+        """Write a snapshot of all stages and counters and report the summary """
+        now = time.monotonic()
+        self._next = now + self._interval
+        elapsed = round(now - self._start, 3)
+        with self._lock:
+            stages = {name: stats.as_dict() for name, stats in self.stages.items()}
+            counters = dict(self.counters)
+        if self._csv:
+            for name, stats in stages.items():
+                row = {field: stats.get(field) for field in CSV_FIELDS}
+                self._csv.writerow(dict(row, elapsed=elapsed, stage=name))
+            for name, value in counters.items():
+                self._csv.writerow({"elapsed": elapsed, "stage": name, "count": value})
+        elif self._fd:
+            self._fd.write(
+                json.dumps({"elapsed": elapsed, "stages": stages, "counters": counters})
+                + "\n"
+            )
+        if self._fd:
+            self._fd.flush()
+        if self._report:
+            self._report(self.summary(elapsed))
+
+    def summary(self, elapsed=None):
+        """Return one-line summary of the stages and counters """
+        if elapsed is None:
+            elapsed = time.monotonic() - self._start
+        parts = []
+        with self._lock:
+            for name, stats in self.stages.items():
+                part = f"{name}: {stats.count} in {stats.seconds:.1f}s"
+                if stats.bytes and stats.seconds:
+                    part += f" {stats.bytes / stats.seconds / 1e6:.1f} MB/s"
+                part += f" p50 {stats.percentile(0.5):.3g}s p99 {stats.percentile(0.99):.3g}s"
+                parts.append(part)
+            parts += [f"{name}: {value}" for name, value in self.counters.items()]
+        return f"[{elapsed:.0f}s] " + ", ".join(parts)
+
+    def close(self):
+        """Write a final snapshot and close the metrics file """
+        self.snapshot()
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+
+
+class NullMetrics:
+    """Metrics that records nothing; used when metrics are off """
+
+    enabled = False
+    _timer = contextlib.nullcontext()
+
+    def record(self, stage, seconds, nbytes=0):
+        pass
+
+    def timer(self, stage, nbytes=0):
+        return self._timer
+
+    def increment(self, counter, value=1):
+        pass
+
+    def tick(self):
+        pass
+
+    def snapshot(self):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+""" shared NullMetrics instance """
+
+
+class TimedBackend:
+    """Wrap a PhotosBackend, recording every call made to the destination library as
+    stage "photos.<method>" in metrics
+
+    Args:
+        backend: PhotosBackend to wrap
+        metrics: Metrics to record calls in
+    """
+
+    TIMED_METHODS = (
+        "import_photos",
+        "folders",
+        "albums",
+        "album",
+        "make_folders",
+        "create_album",
+        "add",
+        "album_uuids",
+        "set_metadata",
+    )
+
+    def __init__(self, backend, metrics):
+        self._backend = backend
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if name not in self.TIMED_METHODS:
+            return attr
+
+        def timed(*args, **kwargs):
+            with self._metrics.timer(f"photos.{name}"):
+                return attr(*args, **kwargs)
+
+        return timed
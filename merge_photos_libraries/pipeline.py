@@ -0,0 +1,50 @@
+"""Run work for upcoming photos in a thread pool ahead of a serial consumer """
+
+import collections
+import concurrent.futures
+
+
+def prefetch(items, func, workers=1, depth=1):
+    """Yield (item, future) pairs in order while func(item) runs in a thread pool
+
+    Args:
+        items: iterable of items to process
+        func: function called with each item in a worker thread
+        workers: number of worker threads
+        depth: maximum number of items submitted ahead of the consumer;
+            provides back-pressure so the workers can't run away from the consumer
+
+    Yields:
+        (item, future) where future.result() is the return value of func(item)
+    """
+    if workers < 1 or depth < 1:
+        raise ValueError("workers and depth must be >= 1")
+    queue = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in items:
+                queue.append((item, executor.submit(func, item)))
+                if len(queue) > depth:
+                    yield queue.popleft()
+            while queue:
+                yield queue.popleft()
+        finally:
+            # consumer stopped early; don't start work that will never be used
+            for _, future in queue:
+                future.cancel()
+
+
+def interleave(iterables):
+    """Yield (index, item) taking one item from each iterable in turn until all are
+    exhausted; index is the position of the item's iterable in iterables """
+    iterators = [(index, iter(items)) for index, items in enumerate(iterables)]
+    while iterators:
+        remaining = []
+        for index, iterator in iterators:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                continue
+            remaining.append((index, iterator))
+            yield index, item
+        iterators = remaining
@@ -0,0 +1,239 @@
+"""Merge plan: the photos a merge will import, computed ahead of time """
+
+# A plan is written by the plan command and executed, optionally in shards, by the
+# execute command. It's stored column by column (one list per field, with albums
+# stored once and referenced by index) as gzip-compressed JSON so even plans for
+# very large libraries are small and quick to load. The fingerprint of each source
+# library is kept with the plan so execute can tell when a source changed since the
+# plan was made, and execute merges the photos, albums and metadata in the plan
+# rather than reading them from the source library again.
+
+import collections
+import datetime
+import gzip
+import json
+
+from .metadata import METADATA_DEFAULTS, METADATA_FIELDS
+from .source import AlbumIndex, library_fingerprint, library_photo_count
+
+PLAN_FORMAT = "merge-photos-libraries-plan"
+PLAN_VERSION = 2
+
+PLAN_COLUMNS = (
+    "source",
+    "uuid",
+    "filename",
+    "staging",
+    "bytes",
+    "albums",
+) + METADATA_FIELDS
+""" columns of a plan: index into sources, source uuid, filename the photo is
+imported as, expected staging strategy, estimated bytes staged, indexes into albums
+and the metadata fields to write (None if the field needn't be written) """
+
+PlannedSource = collections.namedtuple("PlannedSource", ["uuids", "albums", "metadata"])
+PlannedSource.__doc__ = """Photos to merge from one source library as planned: set of
+source uuids, AlbumIndex of the albums to add them to and dict of uuid: metadata to
+write (as returned by metadata.photo_metadata) """
+
+
+class MergePlan:
+    """Photos to import from one or more source libraries into a destination library
+
+    Args:
+        sources: list of paths to the source libraries
+        destination: path to the destination library
+
+    Attributes:
+        sources: list of source library paths (str)
+        destination: destination library path (str)
+        albums: list of (tuple of folder names, album title)
+        columns: dict of column name: list of values, one per photo
+        skipped: dict of reason: number of source photos left out of the plan
+        source_states: dict of source library path: (fingerprint, photo count) of the
+            source when it was planned (see source.library_fingerprint and
+            source.library_photo_count); missing for plans written by version 1
+    """
+
+    def __init__(self, sources, destination):
+        self.sources = [str(source) for source in sources]
+        self.destination = str(destination)
+        self.albums = []
+        self.columns = {column: [] for column in PLAN_COLUMNS}
+        self.skipped = {}
+        self.source_states = {}
+        self.created = datetime.datetime.now().isoformat()
+        self._album_index = {}
+
+    def __len__(self):
+        return len(self.columns["uuid"])
+
+    def add(self, source, uuid, filename, staging, nbytes, albums, metadata):
+        """Add a photo to the plan
+
+        Args:
+            source: index of the photo's library in sources
+            uuid: source uuid
+            filename: filename the photo will be imported as
+            staging: expected staging strategy (see staging.STRATEGIES)
+            nbytes: estimated number of bytes to stage
+            albums: list of (tuple of folder names, album title) to add the photo to
+            metadata: dict of metadata field: value for fields to write
+        """
+        album_indexes = []
+        for folder_names, title in albums:
+            key = (tuple(folder_names), title)
+            if key not in self._album_index:
+                self._album_index[key] = len(self.albums)
+                self.albums.append(key)
+            album_indexes.append(self._album_index[key])
+        row = {
+            "source": source,
+            "uuid": uuid,
+            "filename": filename,
+            "staging": staging,
+            "bytes": nbytes,
+            "albums": album_indexes,
+        }
+        for field in METADATA_FIELDS:
+            row[field] = metadata.get(field)
+        for column, values in self.columns.items():
+            values.append(row[column])
+
+    def set_source_state(self, source):
+        """Record the state of source library path source before it's read, so a
+        change made while planning is found by changed_sources() """
+        self.source_states[str(source)] = (
+            library_fingerprint(source),
+            library_photo_count(source),
+        )
+
+    def changed_sources(self, sources=None):
+        """Return list of the source libraries in sources (default all) that changed
+        since they were planned or whose state wasn't recorded """
+        return [
+            source
+            for source in (self.sources if sources is None else sources)
+            if self.source_states.get(source)
+            != (library_fingerprint(source), library_photo_count(source))
+        ]
+
+    def skip(self, reason):
+        """Count a source photo left out of the plan for reason """
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+    def row(self, index):
+        """Return dict of column: value for photo at index """
+        return {column: values[index] for column, values in self.columns.items()}
+
+    def shard(self, index, count):
+        """Return range of rows in shard index (1 to count) of count contiguous shards """
+        if not 1 <= index <= count:
+            raise ValueError(f"shard must be between 1 and {count}")
+        return range(len(self) * (index - 1) // count, len(self) * index // count)
+
+    def metadata(self, row):
+        """Return dict of metadata to write for photo at row, with the fields that
+        needn't be written set to their default like metadata.photo_metadata """
+        metadata = {}
+        for field in METADATA_FIELDS:
+            value = self.columns[field][row]
+            if field == "location":
+                if value is not None:
+                    metadata[field] = tuple(value)
+            elif field == "keywords":
+                metadata[field] = tuple(value or ())
+            else:
+                metadata[field] = METADATA_DEFAULTS[field] if value is None else value
+        return metadata
+
+    def planned_sources(self, rows):
+        """Return dict of source library path: PlannedSource for photos in rows """
+        planned = {}
+        for row in rows:
+            source = self.sources[self.columns["source"][row]]
+            if source not in planned:
+                planned[source] = PlannedSource(set(), AlbumIndex(), {})
+            uuids, albums, metadata = planned[source]
+            uuid = self.columns["uuid"][row]
+            uuids.add(uuid)
+            for album in self.columns["albums"][row]:
+                albums.add(uuid, albums.add_album(*self.albums[album]))
+            metadata[uuid] = self.metadata(row)
+        return planned
+
+    def uuids(self, rows):
+        """Return dict of source library path: set of uuids for photos in rows """
+        uuids = {}
+        for row in rows:
+            source = self.sources[self.columns["source"][row]]
+            uuids.setdefault(source, set()).add(self.columns["uuid"][row])
+        return uuids
+
+    def summary(self, rows=None):
+        """Return dict summarizing the photos in rows (default all) """
+        rows = range(len(self)) if rows is None else rows
+        staging = {}
+        albums = set()
+        writes = {field: 0 for field in METADATA_FIELDS}
+        nbytes = 0
+        for row in rows:
+            strategy = self.columns["staging"][row]
+            staging[strategy] = staging.get(strategy, 0) + 1
+            albums.update(self.columns["albums"][row])
+            nbytes += self.columns["bytes"][row]
+            for field in METADATA_FIELDS:
+                if self.columns[field][row] is not None:
+                    writes[field] += 1
+        return {
+            "photos": len(rows),
+            "bytes": nbytes,
+            "staging": staging,
+            "albums": len(albums),
+            "metadata": writes,
+            "skipped": dict(self.skipped),
+        }
+
+    def save(self, path):
+        """Write the plan to path """
+        data = {
+            "format": PLAN_FORMAT,
+            "version": PLAN_VERSION,
+            "created": self.created,
+            "sources": self.sources,
+            "destination": self.destination,
+            "albums": [[list(folders), title] for folders, title in self.albums],
+            "skipped": self.skipped,
+            "source_states": self.source_states,
+            "columns": self.columns,
+        }
+        with gzip.open(path, "wt", encoding="utf-8") as fd:
+            json.dump(data, fd, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path):
+        """Read a plan written by save()
+
+        Raises:
+            ValueError if path isn't a plan or was written by a newer version
+        """
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as fd:
+                data = json.load(fd)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"{path} is not a merge plan: {e}") from e
+        if not isinstance(data, dict) or data.get("format") != PLAN_FORMAT:
+            raise ValueError(f"{path} is not a merge plan")
+        if data["version"] > PLAN_VERSION:
+            raise ValueError(f"{path} was written by a newer version of merge")
+        plan = cls(data["sources"], data["destination"])
+        plan.created = data["created"]
+        plan.skipped = data["skipped"]
+        plan.source_states = {
+            source: tuple(state)
+            for source, state in data.get("source_states", {}).items()
+        }
+        plan.albums = [(tuple(folders), title) for folders, title in data["albums"]]
+        plan._album_index = {album: i for i, album in enumerate(plan.albums)}
+        plan.columns = {column: data["columns"][column] for column in PLAN_COLUMNS}
+        return plan
@@ -0,0 +1,190 @@
+"""Pre-flight check of the source photos to merge """
+
+# Missing or unreadable originals and files Photos can't import used to be found one
+# at a time by the import loop, possibly hours into a merge. The pre-flight check
+# looks at the files of every photo to merge in a thread pool before anything is
+# imported so bad photos can be reported and set aside up front, and estimates the
+# bytes that will be staged. Photos that pass are cached in a SQLite manifest next to
+# the merge database keyed by uuid and the size and mtime of the photo's file so a
+# later merge only reads files that changed; photos that fail are checked every time.
+
+import collections
+import os
+import pathlib
+import sqlite3
+
+from .pipeline import prefetch
+from .source import RAW_SUFFIXES
+
+PREFLIGHT_WORKERS = 8
+""" number of threads checking files; checks mostly wait on the disk """
+
+READ_CHECK_SIZE = 4096
+""" number of bytes read from the start of each file to check it can be read """
+
+IMPORTABLE_SUFFIXES = (
+    ".3gp",
+    ".avi",
+    ".bmp",
+    ".gif",
+    ".heic",
+    ".heif",
+    ".jpeg",
+    ".jpg",
+    ".m2ts",
+    ".m4v",
+    ".mov",
+    ".mp4",
+    ".mpg",
+    ".mts",
+    ".png",
+    ".psd",
+    ".tif",
+    ".tiff",
+    ".webp",
+) + RAW_SUFFIXES
+""" lower case suffixes of files Photos imports """
+
+PROBLEMS = ("missing", "missing companion", "empty", "unreadable", "unsupported")
+""" reasons a photo fails the pre-flight check """
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS preflight (
+    uuid TEXT PRIMARY KEY,
+    files TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+"""
+
+PreflightReport = collections.namedtuple(
+    "PreflightReport", ["problems", "bytes", "checked", "cached"]
+)
+PreflightReport.__doc__ = """Result of a pre-flight check: dict of uuid: problem (one
+of PROBLEMS) for photos that failed, estimated bytes staged for the photos that
+passed, number of photos checked and number of those found in the manifest """
+
+
+def check_files(files, cached=None):
+    """Check the files merged for a photo can be imported; run in a worker thread
+
+    Args:
+        files: list of paths of the files merged for the photo, the photo's own file
+            first followed by any RAW or Live Photo companions; empty if missing
+        cached: optional (files, size, mtime, bytes) the photo passed with before
+
+    Returns:
+        (problem or None, bytes, (size, mtime) of the first file or None, True if
+        the result is from cached)
+    """
+    if not files:
+        return "missing", 0, None, False
+    if pathlib.Path(files[0]).suffix.lower() not in IMPORTABLE_SUFFIXES:
+        return "unsupported", 0, None, False
+    try:
+        stat = os.stat(files[0])
+    except OSError:
+        return "missing", 0, None, False
+    key = (stat.st_size, stat.st_mtime_ns)
+    if cached is not None and cached[0] == "\n".join(files) and cached[1:3] == key:
+        return None, cached[3], key, True
+
+    nbytes = 0
+    for index, path in enumerate(files):
+        try:
+            size = stat.st_size if index == 0 else os.stat(path).st_size
+        except OSError:
+            return "missing companion", 0, None, False
+        if not size:
+            return "empty", 0, None, False
+        try:
+            with open(path, "rb") as fd:
+                fd.read(READ_CHECK_SIZE)
+        except OSError:
+            return "unreadable", 0, None, False
+        nbytes += size
+    return None, nbytes, key, False
+
+
+class PreflightManifest:
+    """Cache of the photos that passed the pre-flight check
+
+    Args:
+        dbpath: path to the SQLite database the manifest is stored in
+    """
+
+    def __init__(self, dbpath):
+        self._dbpath = pathlib.Path(dbpath)
+        self._conn = sqlite3.connect(str(self._dbpath))
+        self._conn.executescript(SCHEMA)
+
+    def get(self, uuid):
+        """Return (files, size, mtime, bytes) photo uuid passed with or None """
+        return self._conn.execute(
+            "SELECT files, size, mtime, bytes FROM preflight WHERE uuid = ?", (uuid,)
+        ).fetchone()
+
+    def put(self, rows):
+        """Record photos that passed, rows of (uuid, files, size, mtime, bytes) """
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO preflight VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def discard(self, uuids):
+        """Remove photos that no longer pass """
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM preflight WHERE uuid = ?", [(uuid,) for uuid in uuids]
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+def preflight(photos, manifest=None, workers=PREFLIGHT_WORKERS, report=None):
+    """Check the files of photos before they're merged
+
+    Args:
+        photos: iterable of (uuid, files) where files is the list of paths merged for
+            the photo (see check_files)
+        manifest: optional PreflightManifest; photos whose first file is unchanged
+            since they passed aren't read again and photos that pass are added
+        workers: number of threads checking files
+        report: optional function called with (uuid, problem) for each photo that fails
+
+    Returns:
+        PreflightReport
+    """
+    problems = {}
+    nbytes = checked = cached = 0
+    passed = []
+
+    def items():
+        for uuid, files in photos:
+            yield uuid, files, manifest.get(uuid) if manifest is not None else None
+
+    def check(item):
+        _, files, entry = item
+        return check_files(files, entry)
+
+    for (uuid, files, _), future in prefetch(
+        items(), check, workers=workers, depth=workers * 4
+    ):
+        problem, size, key, from_cache = future.result()
+        checked += 1
+        if problem:
+            problems[uuid] = problem
+            if report:
+                report(uuid, problem)
+            continue
+        nbytes += size
+        if from_cache:
+            cached += 1
+        else:
+            passed.append((uuid, "\n".join(files)) + key + (size,))
+    if manifest is not None:
+        manifest.discard(problems)
+        manifest.put(passed)
+    return PreflightReport(problems, nbytes, checked, cached)
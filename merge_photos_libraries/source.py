@@ -0,0 +1,886 @@
+"""Source libraries: Photos libraries read with osxphotos, streamed from the Photos
+database, or generated synthetic libraries """
+
+# merge reads the source library only through a PhotosSource so it can be run
+# against synthetic libraries of any size for reproducible scale testing
+# (e.g. on Linux, where there's no Photos library to read)
+# StreamingPhotosSource pages through the Photos database by primary key instead
+# of loading the whole library into memory like osxphotos.PhotosDB
+# osxphotos takes most of a second to import so it's imported only by
+# OsxPhotosSource; StreamingPhotosSource, library_fingerprint() and
+# library_photo_count() read the library without it so an up-to-date merge can be
+# detected right away
+
+import abc
+import json
+import pathlib
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unicodedata
+import uuid as uuidlib
+from types import SimpleNamespace
+
+SOURCE_PHOTO_ATTRIBUTES = (
+    "uuid",
+    "original_filename",
+    "path",
+    "path_edited",
+    "path_live_photo",
+    "path_raw",
+    "hasadjustments",
+    "favorite",
+    "title",
+    "description",
+    "keywords",
+    "location",
+    "persons",
+    "album_info",
+)
+""" PhotoInfo attributes merge reads from source photos; photos must also implement
+export(); merge reads album membership from PhotosSource.album_index() rather than
+album_info when it has the source """
+
+SYNTHETIC_MANIFEST = "photos.jsonl"
+""" name of the file listing every photo in a synthetic library, one JSON object per line """
+
+RAW_SUFFIXES = (
+    ".3fr",
+    ".arw",
+    ".cr2",
+    ".cr3",
+    ".crw",
+    ".dng",
+    ".erf",
+    ".nef",
+    ".orf",
+    ".pef",
+    ".raf",
+    ".raw",
+    ".rw2",
+    ".srw",
+)
+""" lower case suffixes of RAW companion files """
+
+# values in the Photos 5+ database read by StreamingPhotosSource
+ALBUM_KIND = 2
+FOLDER_KIND = 4000
+LIVE_PHOTO_SUBTYPE = 2
+RAW_DATASTORE_SUBTYPE = 17
+BURST_SELECTED_OR_KEY = 8 | 16  # burst photos that are selected or the key photo
+NO_LOCATION = -180.0
+COREDATA_EPOCH = 978307200  # Photos database times are seconds since 2001-01-01 UTC
+UNKNOWN_PERSON = "_UNKNOWN_"  # osxphotos name for a person who hasn't been named
+
+# asset table in Photos 5 and in Photos 6+ libraries
+ASSET_TABLES = ("ZGENERICASSET", "ZASSET")
+
+
+def photos_database(library_path):
+    """Return path of the Photos database in library_path """
+    return pathlib.Path(library_path) / "database" / "Photos.sqlite"
+
+
+def merged_photos_condition(asset):
+    """SQL condition on asset table for photos merged: not in the trash and not a
+    non-selected burst photo """
+    return (
+        f"{asset}.ZTRASHEDSTATE = 0 AND {asset}.ZKIND IN (0, 1) AND "
+        f"({asset}.ZAVALANCHEUUID IS NULL OR {asset}.ZAVALANCHEPICKTYPE = 0 "
+        f"OR {asset}.ZAVALANCHEPICKTYPE & {BURST_SELECTED_OR_KEY} != 0)"
+    )
+
+
+def normalize_unicode(value):
+    """Return str value in the Unicode normal form osxphotos uses (NFC); None if
+    value is None """
+    return None if value is None else unicodedata.normalize("NFC", value)
+
+
+def database_tables(conn):
+    """Return dict of the names of the tables and columns StreamingPhotosSource reads
+    that differ between versions of Photos, read from the schema of the Photos
+    database open in sqlite3 connection conn; None if it isn't a Photos 5+ database
+
+    The database is a Core Data store whose join tables and columns are named after
+    entity numbers that change with each version of Photos, so they're looked up in
+    the database itself rather than in a table of names for every version """
+
+    def columns(table):
+        return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+    def column(table, pattern):
+        return next(c for c in columns(table) if re.fullmatch(pattern, c))
+
+    tables = {
+        row[0]
+        for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    }
+    asset = next((t for t in ASSET_TABLES if t in tables), None)
+    if asset is None:
+        return None
+    entities = dict(conn.execute("SELECT Z_NAME, Z_ENT FROM Z_PRIMARYKEY"))
+    album_table = f"Z_{entities['Album']}ASSETS"
+    face_columns = columns("ZDETECTEDFACE")
+    face_fk = "FORFACE" if "ZASSETFORFACE" in face_columns else ""
+    adjustments = (
+        "ZADJUSTMENTSSTATE"
+        if "ZADJUSTMENTSSTATE" in columns(asset)
+        else "ZHASADJUSTMENTS"
+    )
+    return {
+        "ASSET": asset,
+        "HAS_ADJUSTMENTS": f"{asset}.{adjustments}",
+        "KEYWORD_JOIN": f"Z_1KEYWORDS.{column('Z_1KEYWORDS', r'Z_[0-9]+KEYWORDS')}",
+        "DETECTED_FACE_ASSET_FK": f"ZDETECTEDFACE.ZASSET{face_fk}",
+        "DETECTED_FACE_PERSON_FK": f"ZDETECTEDFACE.ZPERSON{face_fk}",
+        "ASSET_ALBUM_TABLE": album_table,
+        "ALBUM_JOIN": f"{album_table}.{column(album_table, r'Z_[0-9]+ASSETS')}",
+        "ASSET_ALBUM_JOIN": f"{album_table}.Z_{entities['Album']}ALBUMS",
+    }
+
+
+def library_fingerprint(library_path):
+    """Return string that changes whenever the Photos database in library_path is
+    written: the size and modification time of the database and its write-ahead log
+    (and of photos.db, the main database of Photos 4 and earlier libraries, and the
+    manifest of a synthetic library) """
+    parts = []
+    for name in (
+        "database/Photos.sqlite",
+        "database/Photos.sqlite-wal",
+        "database/photos.db",
+        "database/photos.db-wal",
+        SYNTHETIC_MANIFEST,
+    ):
+        try:
+            stat = (pathlib.Path(library_path) / name).stat()
+        except FileNotFoundError:
+            parts.append("-")
+            continue
+        parts.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+    return ";".join(parts)
+
+
+def library_photo_count(library_path):
+    """Return number of photos in library_path a merge reads, counted without a copy
+    of the database or osxphotos; None if it isn't a Photos 5+ library """
+    db_path = photos_database(library_path)
+    if not db_path.is_file():
+        return None
+    # immutable: read without taking locks while Photos has the database open;
+    # anything still only in the write-ahead log changes library_fingerprint()
+    conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?immutable=1", uri=True)
+    try:
+        tables = {
+            row[0]
+            for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        }
+        for asset in ASSET_TABLES:
+            if asset in tables:
+                return conn.execute(
+                    f"SELECT COUNT(*) FROM {asset} WHERE {merged_photos_condition(asset)}"
+                ).fetchone()[0]
+        return None
+    finally:
+        conn.close()
+
+
+def copy_export(files, dest, filename):
+    """Copy files to directory dest, each named with the stem of filename and its own
+    suffix, like PhotoInfo.export does for RAW and Live Photo companions;
+    returns list of exported paths """
+    stem = pathlib.Path(filename).stem
+    exported = []
+    for name in files:
+        path = pathlib.Path(dest) / f"{stem}{pathlib.Path(name).suffix}"
+        shutil.copyfile(name, path)
+        exported.append(str(path))
+    return exported
+
+
+def render_folder_album(album_info, template):
+    """Render template for a photo in albums album_info like PhotoInfo.render_template;
+    only "{folder_album,}" is supported """
+    if template != "{folder_album,}":
+        raise ValueError(f"unsupported template {template}")
+    values = ["/".join(list(a.folder_names) + [a.title]) for a in album_info]
+    return (values or [""], [])
+
+
+class AlbumIndex:
+    """Albums of a source library and the photos in each, read once up front so merge
+    needn't walk album_info or render "{folder_album}" for every photo
+
+    Albums with the same folder names and title are one album in the index as merge
+    adds their photos to the same destination album.
+
+    Attributes:
+        albums: list of (tuple of folder names, album title), indexed by album id
+        paths: list of album paths ("Folder/Subfolder/Album"), indexed by album id
+    """
+
+    def __init__(self):
+        self.albums = []
+        self.paths = []
+        self._ids = {}
+        self._members = {}
+
+    def __len__(self):
+        return len(self.albums)
+
+    def add_album(self, folder_names, title):
+        """Add album title in folders folder_names if not already in the index and
+        return its album id """
+        key = (tuple(folder_names), title)
+        album_id = self._ids.get(key)
+        if album_id is None:
+            album_id = self._ids[key] = len(self.albums)
+            self.albums.append(key)
+            self.paths.append("/".join(key[0] + (title or "",)))
+        return album_id
+
+    def add(self, uuid, album_id):
+        """Record that the photo with uuid is in album album_id """
+        members = self._members.setdefault(uuid, [])
+        if album_id not in members:
+            members.append(album_id)
+            members.sort(key=self.paths.__getitem__)
+
+    def photo_albums(self, uuid):
+        """Return list of (tuple of folder names, album title) for the albums the
+        photo with uuid is in, sorted by path """
+        return [self.albums[i] for i in self._members.get(uuid, ())]
+
+    def folder_albums(self, uuid):
+        """Return sorted list of paths of the albums the photo with uuid is in, like
+        render_template("{folder_album,}") """
+        return [self.paths[i] for i in self._members.get(uuid, ())]
+
+    @classmethod
+    def from_photos(cls, photos):
+        """Return AlbumIndex built from the album_info of each of photos """
+        index = cls()
+        for photo in photos:
+            for album in photo.album_info:
+                index.add(photo.uuid, index.add_album(album.folder_names, album.title))
+        return index
+
+
+class PhotosSource(abc.ABC):
+    """Interface to the source library used by merge; sources implement photos()
+    and may override the other methods with faster versions """
+
+    def __init__(self, library_path):
+        self.library_path = pathlib.Path(library_path)
+
+    @abc.abstractmethod
+    def photos(self, uuids=None):
+        """Return photos in the source library (a list or, for streaming sources,
+        an iterator); each photo has the attributes in SOURCE_PHOTO_ATTRIBUTES
+
+        Args:
+            uuids: optional collection of uuids to return photos for; default is all photos
+        """
+        raise NotImplementedError
+
+    def uuids(self):
+        """Return list of uuids of all photos in the order photos() returns them """
+        return [p.uuid for p in self.photos()]
+
+    def album_index(self):
+        """Return AlbumIndex of the albums in the source library """
+        return AlbumIndex.from_photos(self.photos())
+
+    def modification_dates(self, since=None):
+        """Return dict of uuid: time (seconds since the epoch) the photo was added or
+        last modified for photos added or modified after since (default all) """
+        dates = {}
+        for photo in self.photos():
+            modified = max(
+                (d.timestamp() for d in (photo.date_added, photo.date_modified) if d),
+                default=0.0,
+            )
+            if since is None or modified > since:
+                dates[photo.uuid] = modified
+        return dates
+
+    def close(self):
+        """Release any resources held by the source """
+
+
+class OsxPhotosSource(PhotosSource):
+    """Photos library read with osxphotos; photos are osxphotos.PhotoInfo objects """
+
+    def __init__(self, library_path):
+        import osxphotos
+
+        super().__init__(library_path)
+        self._photosdb = osxphotos.PhotosDB(dbfile=str(self.library_path))
+        self._photos = None
+
+    def photos(self, uuids=None):
+        if self._photos is None:
+            self._photos = self._photosdb.photos()
+        if uuids is None:
+            return self._photos
+        return [p for p in self._photos if p.uuid in uuids]
+
+    def modification_dates(self, since=None):
+        # osxphotos only reports when a photo was edited; read the time any change
+        # was made from the database of a Photos 5+ library
+        if self._photosdb.photos_version < 5:
+            return super().modification_dates(since)
+        src = StreamingPhotosSource(self.library_path)
+        try:
+            return src.modification_dates(since)
+        finally:
+            src.close()
+
+    def album_index(self):
+        # read membership from the album table osxphotos already loaded, which
+        # avoids creating a PhotoInfo for every photo in every album; it's private
+        # to osxphotos so fall back to AlbumInfo.photos if it's gone. Shared albums
+        # are only in Photos 5+ libraries
+        albums = list(self._photosdb.album_info)
+        if self._photosdb.photos_version >= 5:
+            albums += self._photosdb.album_info_shared
+        members = getattr(self._photosdb, "_dbalbums_album", None)
+        index = AlbumIndex()
+        for album in albums:
+            album_id = index.add_album(album.folder_names, album.title)
+            if members is not None:
+                uuids = [uuid for uuid, _ in members.get(album.uuid, ())]
+            else:
+                uuids = [photo.uuid for photo in album.photos]
+            for uuid in uuids:
+                index.add(uuid, album_id)
+        return index
+
+
+class SyntheticPhoto:
+    """Photo in a synthetic library with the PhotoInfo attributes merge uses
+
+    Args:
+        root: path to the synthetic library
+        record: dict for the photo read from the library's manifest
+    """
+
+    def __init__(self, root, record):
+        self._files = [str(root / name) for name in record["files"]]
+        self.uuid = record["uuid"]
+        self.original_filename = record["original_filename"]
+        self.path = self._files[0]
+        self.path_live_photo = None
+        self.path_raw = None
+        for companion in self._files[1:]:
+            if pathlib.Path(companion).suffix.lower() in RAW_SUFFIXES:
+                self.path_raw = companion
+            else:
+                self.path_live_photo = companion
+        self.path_edited = str(root / record["edited"]) if record["edited"] else None
+        self.hasadjustments = bool(record["edited"])
+        self.favorite = record["favorite"]
+        self.title = record["title"]
+        self.description = record["description"]
+        self.keywords = [sys.intern(k) for k in record["keywords"]]
+        self.persons = [sys.intern(p) for p in record["persons"]]
+        self.location = tuple(record["location"] or (None, None))
+        self.album_info = [
+            SimpleNamespace(folder_names=list(folder_names), title=title)
+            for folder_names, title in record["albums"]
+        ]
+
+    def render_template(self, template):
+        return render_folder_album(self.album_info, template)
+
+    def export(
+        self, dest, filename=None, edited=False, live_photo=False, raw_photo=False
+    ):
+        """Copy the photo to directory dest as filename, with any RAW or Live Photo
+        companion files sharing the stem of filename; returns list of exported paths """
+        if edited:
+            files = [self.path_edited]
+        else:
+            files = [self.path]
+            if live_photo and self.path_live_photo:
+                files.append(self.path_live_photo)
+            if raw_photo and self.path_raw:
+                files.append(self.path_raw)
+        return copy_export(files, dest, filename or self.original_filename)
+
+
+class SyntheticSource(PhotosSource):
+    """Synthetic library created by generate_synthetic_library """
+
+    def __init__(self, library_path):
+        super().__init__(library_path)
+        if not (self.library_path / SYNTHETIC_MANIFEST).is_file():
+            raise ValueError(f"{library_path} is not a synthetic library")
+
+    def photos(self, uuids=None):
+        with open(self.library_path / SYNTHETIC_MANIFEST, "r") as fd:
+            photos = [
+                SyntheticPhoto(self.library_path, json.loads(line)) for line in fd
+            ]
+        if uuids is None:
+            return photos
+        return [p for p in photos if p.uuid in uuids]
+
+    def modification_dates(self, since=None):
+        # photos are modified by rewriting their manifest record with a "modified" time
+        dates = {}
+        with open(self.library_path / SYNTHETIC_MANIFEST, "r") as fd:
+            for line in fd:
+                record = json.loads(line)
+                modified = record.get("modified", 0.0)
+                if since is None or modified > since:
+                    dates[record["uuid"]] = modified
+        return dates
+
+    def album_index(self):
+        index = AlbumIndex()
+        with open(self.library_path / SYNTHETIC_MANIFEST, "r") as fd:
+            for line in fd:
+                record = json.loads(line)
+                for folder_names, title in record["albums"]:
+                    index.add(record["uuid"], index.add_album(folder_names, title))
+        return index
+
+
+class StreamingPhoto:
+    """Lightweight record for a photo read by StreamingPhotosSource with the
+    PhotoInfo attributes merge uses; album_info is read from the database on first use
+    """
+
+    __slots__ = (
+        "_source",
+        "_pk",
+        "_album_info",
+        "uuid",
+        "original_filename",
+        "path",
+        "path_edited",
+        "path_live_photo",
+        "path_raw",
+        "hasadjustments",
+        "favorite",
+        "title",
+        "description",
+        "keywords",
+        "persons",
+        "location",
+    )
+
+    def __init__(self, source, pk):
+        self._source = source
+        self._pk = pk
+        self.path_live_photo = None
+        self.path_raw = None
+        self._album_info = None
+
+    @property
+    def album_info(self):
+        if self._album_info is None:
+            self._album_info = self._source.album_info(self._pk)
+        return self._album_info
+
+    def render_template(self, template):
+        return render_folder_album(self.album_info, template)
+
+    def export(
+        self, dest, filename=None, edited=False, live_photo=False, raw_photo=False
+    ):
+        """Copy the photo to directory dest as filename, with any RAW or Live Photo
+        companion files sharing the stem of filename; returns list of exported paths """
+        if edited:
+            files = [self.path_edited]
+        else:
+            files = [self.path]
+            if live_photo and self.path_live_photo:
+                files.append(self.path_live_photo)
+            if raw_photo and self.path_raw:
+                files.append(self.path_raw)
+        return copy_export(files, dest, filename or self.original_filename)
+
+
+class StreamingPhotosSource(PhotosSource):
+    """Photos 5+ library read page by page from a copy of the Photos database
+
+    Photos are read in pages of page_size ordered by primary key so memory use doesn't
+    grow with the size of the library and the first photo is available right away.
+    Keywords and persons are read for a whole page at a time and interned so photos
+    share a single copy of each name; albums are read for a
+    photo when its album_info is first used or for all photos at once by album_index().
+
+    Args:
+        library_path: path to the Photos library
+        page_size: number of photos read from the database at a time
+    """
+
+    def __init__(self, library_path, page_size=500):
+        super().__init__(library_path)
+        self._page_size = page_size
+        # read a copy of the database like osxphotos so the library is never modified
+        # and the database isn't locked while Photos is running
+        self._tmpdir = tempfile.TemporaryDirectory()
+        db_path = photos_database(self.library_path)
+        for suffix in ("", "-wal"):
+            if pathlib.Path(f"{db_path}{suffix}").exists():
+                shutil.copyfile(
+                    f"{db_path}{suffix}", f"{self._tmpdir.name}/Photos.sqlite{suffix}"
+                )
+        self._db = sqlite3.connect(f"{self._tmpdir.name}/Photos.sqlite")
+        self._tables = database_tables(self._db)
+        if self._tables is None:
+            self.close()
+            raise ValueError(
+                f"streaming requires a Photos 5 or later library, {library_path} isn't one"
+            )
+        self._albums = self._load_albums()
+        self._names = {}
+
+    def _load_albums(self):
+        """Return dict of album primary key: album (folder_names, title) for every
+        user album not in the trash """
+        rows = {
+            row[0]: row[1:]
+            for row in self._db.execute(
+                "SELECT Z_PK, ZTITLE, ZKIND, ZPARENTFOLDER, ZTRASHEDSTATE FROM ZGENERICALBUM"
+            )
+        }
+        albums = {}
+        for pk, (title, kind, parent, trashed) in rows.items():
+            if kind != ALBUM_KIND or trashed:
+                continue
+            folder_names = []
+            while parent in rows and rows[parent][1] == FOLDER_KIND:
+                folder_names.insert(0, normalize_unicode(rows[parent][0]))
+                parent = rows[parent][2]
+            albums[pk] = SimpleNamespace(
+                folder_names=folder_names, title=normalize_unicode(title)
+            )
+        return albums
+
+    def _where(self):
+        return merged_photos_condition(self._tables["ASSET"])
+
+    def uuids(self):
+        asset = self._tables["ASSET"]
+        return [
+            row[0]
+            for row in self._db.execute(
+                f"SELECT ZUUID FROM {asset} WHERE {self._where()} ORDER BY Z_PK"
+            )
+        ]
+
+    def photos(self, uuids=None):
+        if uuids is not None:
+            uuids = list(uuids)
+            for start in range(0, len(uuids), self._page_size):
+                chunk = uuids[start : start + self._page_size]
+                yield from self._read_page(
+                    f"ZUUID IN ({','.join('?' * len(chunk))})", chunk
+                )
+            return
+        last_pk = 0
+        while True:
+            page = self._read_page("Z_PK > ?", [last_pk], limit=self._page_size)
+            if not page:
+                return
+            yield from page
+            last_pk = page[-1]._pk
+
+    def _read_page(self, condition, params, limit=None):
+        """Return list of StreamingPhoto for photos matching SQL condition on the asset table """
+        asset = self._tables["ASSET"]
+        sql = (
+            f"SELECT {asset}.Z_PK, {asset}.ZUUID, ZADDITIONALASSETATTRIBUTES.ZORIGINALFILENAME, "
+            f"{asset}.ZDIRECTORY, {asset}.ZFILENAME, {self._tables['HAS_ADJUSTMENTS']}, "
+            f"{asset}.ZFAVORITE, ZADDITIONALASSETATTRIBUTES.ZTITLE, "
+            f"ZASSETDESCRIPTION.ZLONGDESCRIPTION, {asset}.ZLATITUDE, {asset}.ZLONGITUDE, "
+            f"{asset}.ZKIND, {asset}.ZUNIFORMTYPEIDENTIFIER, {asset}.ZKINDSUBTYPE "
+            f"FROM {asset} "
+            f"JOIN ZADDITIONALASSETATTRIBUTES ON ZADDITIONALASSETATTRIBUTES.ZASSET = {asset}.Z_PK "
+            "LEFT JOIN ZASSETDESCRIPTION "
+            "ON ZASSETDESCRIPTION.Z_PK = ZADDITIONALASSETATTRIBUTES.ZASSETDESCRIPTION "
+            f"WHERE {asset}.{condition} AND {self._where()} ORDER BY {asset}.Z_PK"
+        )
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        photos = [self._photo(row) for row in self._db.execute(sql, params)]
+        if not photos:
+            return photos
+
+        by_pk = {photo._pk: photo for photo in photos}
+        placeholders = ",".join("?" * len(by_pk))
+        keyword_join = self._tables["KEYWORD_JOIN"]
+        for pk, keyword in self._db.execute(
+            "SELECT ZADDITIONALASSETATTRIBUTES.ZASSET, ZKEYWORD.ZTITLE "
+            "FROM ZADDITIONALASSETATTRIBUTES "
+            "JOIN Z_1KEYWORDS ON Z_1KEYWORDS.Z_1ASSETATTRIBUTES = ZADDITIONALASSETATTRIBUTES.Z_PK "
+            f"JOIN ZKEYWORD ON ZKEYWORD.Z_PK = {keyword_join} "
+            f"WHERE ZADDITIONALASSETATTRIBUTES.ZASSET IN ({placeholders})",
+            list(by_pk),
+        ):
+            by_pk[pk].keywords.append(self._name(keyword))
+
+        asset_fk = self._tables["DETECTED_FACE_ASSET_FK"]
+        person_fk = self._tables["DETECTED_FACE_PERSON_FK"]
+        for pk, fullname in self._db.execute(
+            f"SELECT {asset_fk}, ZPERSON.ZFULLNAME FROM ZDETECTEDFACE "
+            f"JOIN ZPERSON ON ZPERSON.Z_PK = {person_fk} "
+            f"WHERE {asset_fk} IN ({placeholders})",
+            list(by_pk),
+        ):
+            by_pk[pk].persons.append(
+                self._name(fullname) if fullname else UNKNOWN_PERSON
+            )
+
+        for pk in self._db.execute(
+            "SELECT DISTINCT ZASSET FROM ZINTERNALRESOURCE "
+            f"WHERE ZDATASTORESUBTYPE = {RAW_DATASTORE_SUBTYPE} AND ZASSET IN ({placeholders})",
+            list(by_pk),
+        ):
+            photo = by_pk[pk[0]]
+            photo.path_raw = self._raw_path(photo)
+
+        for photo in photos:
+            photo.persons.sort()
+        return photos
+
+    def _name(self, value):
+        """Return keyword or person name value normalized and interned; memoized as
+        a few names are shared by most photos """
+        name = self._names.get(value)
+        if name is None:
+            name = self._names[value] = sys.intern(normalize_unicode(value))
+        return name
+
+    def _photo(self, row):
+        """Return StreamingPhoto for a row read by _read_page """
+        (
+            pk,
+            uuid,
+            original_filename,
+            directory,
+            filename,
+            hasadjustments,
+            favorite,
+            title,
+            description,
+            latitude,
+            longitude,
+            kind,
+            uti,
+            subtype,
+        ) = row
+        photo = StreamingPhoto(self, pk)
+        photo.uuid = uuid
+        photo.original_filename = normalize_unicode(original_filename)
+        photo.hasadjustments = bool(hasadjustments)
+        photo.favorite = bool(favorite)
+        photo.title = normalize_unicode(title)
+        photo.description = normalize_unicode(description)
+        photo.keywords = []
+        photo.persons = []
+        photo.location = (
+            (None, None)
+            if latitude == NO_LOCATION and longitude == NO_LOCATION
+            else (latitude, longitude)
+        )
+
+        path = None
+        if directory and filename:
+            if directory.startswith("/"):
+                path = pathlib.Path(directory) / filename
+            else:
+                path = self.library_path / "originals" / directory / filename
+        photo.path = str(path) if path and path.is_file() else None
+
+        photo.path_edited = None
+        if photo.hasadjustments:
+            if kind == 1:
+                edited = f"{uuid}_2_0_a.mov"
+            elif self._tables["ASSET"] == "ZASSET" and uti == "public.heic":
+                edited = f"{uuid}_1_201_a.heic"
+            else:
+                edited = f"{uuid}_1_201_a.jpeg"
+            edited = self.library_path / "resources" / "renders" / uuid[0] / edited
+            photo.path_edited = str(edited) if edited.is_file() else None
+
+        if subtype == LIVE_PHOTO_SUBTYPE and photo.path:
+            live = path.with_name(f"{path.stem}_3.mov")
+            photo.path_live_photo = str(live) if live.is_file() else None
+        return photo
+
+    def _raw_path(self, photo):
+        """Return path of the RAW image of a RAW+JPEG pair stored next to the original """
+        if not photo.path:
+            return None
+        path = pathlib.Path(photo.path)
+        for candidate in path.parent.glob(f"{path.stem}*"):
+            if candidate != path and candidate.suffix.lower() in RAW_SUFFIXES:
+                return str(candidate)
+        return None
+
+    def modification_dates(self, since=None):
+        asset = self._tables["ASSET"]
+        modified = f"MAX(COALESCE({asset}.ZMODIFICATIONDATE, 0), COALESCE({asset}.ZADDEDDATE, 0))"
+        sql = f"SELECT ZUUID, {modified} FROM {asset} WHERE {self._where()}"
+        params = []
+        if since is not None:
+            sql += f" AND {modified} > ?"
+            params.append(since - COREDATA_EPOCH)
+        return {
+            uuid: modified + COREDATA_EPOCH
+            for uuid, modified in self._db.execute(sql, params)
+        }
+
+    def album_info(self, pk):
+        """Return list of albums (sorted by title) the photo with primary key pk is in """
+        album_table = self._tables["ASSET_ALBUM_TABLE"]
+        album_join = self._tables["ALBUM_JOIN"]
+        asset_album_join = self._tables["ASSET_ALBUM_JOIN"]
+        albums = [
+            self._albums[row[0]]
+            for row in self._db.execute(
+                f"SELECT {asset_album_join} FROM {album_table} WHERE {album_join} = ?",
+                (pk,),
+            )
+            if row[0] in self._albums
+        ]
+        return sorted(albums, key=lambda album: album.title or "")
+
+    def album_index(self):
+        # one pass over the album membership table for every photo merged
+        asset = self._tables["ASSET"]
+        album_table = self._tables["ASSET_ALBUM_TABLE"]
+        album_join = self._tables["ALBUM_JOIN"]
+        asset_album_join = self._tables["ASSET_ALBUM_JOIN"]
+        index = AlbumIndex()
+        album_ids = {
+            pk: index.add_album(album.folder_names, album.title)
+            for pk, album in self._albums.items()
+        }
+        for uuid, album_pk in self._db.execute(
+            f"SELECT {asset}.ZUUID, {asset_album_join} FROM {album_table} "
+            f"JOIN {asset} ON {asset}.Z_PK = {album_join} "
+            f"WHERE {self._where()}"
+        ):
+            if album_pk in album_ids:
+                index.add(uuid, album_ids[album_pk])
+        return index
+
+    def close(self):
+        self._db.close()
+        self._tmpdir.cleanup()
+
+
+# (original suffix, companion suffix or None, weight) for the kinds of photo generated
+SYNTHETIC_KINDS = [
+    (".JPG", None, 78),
+    (".JPG", ".CR2", 5),
+    (".HEIC", ".MOV", 14),
+    (".MOV", None, 3),
+]
+
+# weights for the number of albums, keywords and persons on a photo
+ALBUMS_PER_PHOTO = [40, 35, 18, 7]
+KEYWORDS_PER_PHOTO = [45, 25, 15, 8, 5, 2]
+PERSONS_PER_PHOTO = [70, 20, 8, 2]
+
+
+def _zipf_cum_weights(count):
+    """Cumulative weights for choosing from count items with a Zipf distribution
+    so a few albums, keywords and persons are very common and most are rare """
+    total = 0
+    cum_weights = []
+    for rank in range(1, count + 1):
+        total += 1 / rank
+        cum_weights.append(total)
+    return cum_weights
+
+
+def _sample(rng, population, cum_weights, count):
+    """Return up to count distinct items from population chosen by cum_weights """
+    items = rng.choices(population, cum_weights=cum_weights, k=count)
+    return list(dict.fromkeys(items))
+
+
+def generate_synthetic_library(path, count, seed=0, file_size=1024):
+    """Create a synthetic source library of count photos at path
+
+    Photos have albums (in nested folders), keywords and persons with a Zipf
+    distribution, titles, descriptions, locations and favorites; some are RAW+JPEG
+    pairs, Live Photos, movies or edited. The same seed always generates the same
+    library. Files are filled with file_size random bytes.
+
+    Returns:
+        SyntheticSource for the library
+    """
+    path = pathlib.Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+
+    folders = [[]] + [[f"Folder {i}"] for i in range(5)]
+    folders += [[f"Folder {i}", f"Sub {j}"] for i in range(5) for j in range(3)]
+    albums = [
+        (tuple(rng.choice(folders)), f"Album {i}") for i in range(max(5, count // 250))
+    ]
+    keywords = [f"Keyword {i}" for i in range(max(20, min(2000, count // 50)))]
+    persons = [f"Person {i}" for i in range(max(5, count // 1000))]
+    album_weights = _zipf_cum_weights(len(albums))
+    keyword_weights = _zipf_cum_weights(len(keywords))
+    person_weights = _zipf_cum_weights(len(persons))
+    kinds = [kind[:2] for kind in SYNTHETIC_KINDS]
+    kind_weights = [kind[2] for kind in SYNTHETIC_KINDS]
+
+    def write_file(name):
+        filepath = path / name
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        filepath.write_bytes(
+            rng.getrandbits(file_size * 8).to_bytes(file_size, "little")
+        )
+        return name
+
+    with open(path / SYNTHETIC_MANIFEST, "w") as manifest:
+        for index in range(count):
+            uuid = str(uuidlib.UUID(int=rng.getrandbits(128), version=4)).upper()
+            suffix, companion = rng.choices(kinds, weights=kind_weights)[0]
+            stem = f"IMG_{index:07d}"
+            subdir = f"originals/{index // 1000:04d}"
+            files = [write_file(f"{subdir}/{stem}{suffix}")]
+            if companion:
+                files.append(write_file(f"{subdir}/{stem}{companion}"))
+            edited = None
+            if suffix != ".MOV" and rng.random() < 0.08:
+                edited = write_file(f"edited/{index // 1000:04d}/{uuid}_1_201_a.jpeg")
+            n_albums = rng.choices(range(4), weights=ALBUMS_PER_PHOTO)[0]
+            n_keywords = rng.choices(range(6), weights=KEYWORDS_PER_PHOTO)[0]
+            n_persons = rng.choices(range(4), weights=PERSONS_PER_PHOTO)[0]
+            record = {
+                "uuid": uuid,
+                "original_filename": f"{stem}{suffix}",
+                "files": files,
+                "edited": edited,
+                "favorite": rng.random() < 0.05,
+                "title": f"Title {index}" if rng.random() < 0.15 else None,
+                "description": f"Description {index}" if rng.random() < 0.08 else None,
+                "keywords": _sample(rng, keywords, keyword_weights, n_keywords),
+                "persons": _sample(rng, persons, person_weights, n_persons),
+                "location": (
+                    [
+                        round(rng.uniform(-90, 90), 6),
+                        round(rng.uniform(-180, 180), 6),
+                    ]
+                    if rng.random() < 0.6
+                    else None
+                ),
+                "albums": _sample(rng, albums, album_weights, n_albums),
+            }
+            manifest.write(json.dumps(record) + "\n")
+    return SyntheticSource(path)
@@ -0,0 +1,204 @@
+"""Stage source files for import into the destination library """
+
+# Unedited originals don't need to be exported: Photos copies the files on import
+# so they're linked into the staging directory under the photo's original filename
+# with the cheapest strategy that works: a hardlink, then a copy-on-write clone
+# (APFS clonefile or Linux FICLONE), then a plain copy.
+# Edited photos are still exported with PhotoInfo.export.
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+
+STRATEGIES = ("hardlink", "clone", "copy", "export")
+""" ways a file can be staged, cheapest first """
+
+FICLONE = 0x40049409
+""" Linux ioctl to reflink a file (btrfs, xfs, ...) """
+
+# errors meaning the filesystem can't link or clone so the next strategy should be tried
+UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EACCES,
+    errno.EMLINK,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+}
+
+_libc = None
+
+
+def _clonefile(src, dest):
+    """Clone src to dest with MacOS clonefile(2); dest must not exist """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if _libc.clonefile(os.fsencode(src), os.fsencode(dest), 0) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), str(dest))
+
+
+def _ficlone(src, dest):
+    """Reflink src to dest with the Linux FICLONE ioctl; dest must not exist """
+    fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        with open(src, "rb") as fsrc:
+            fcntl.ioctl(fd, FICLONE, fsrc.fileno())
+    except OSError:
+        os.close(fd)
+        os.unlink(dest)
+        raise
+    os.close(fd)
+
+
+def clone_file(src, dest):
+    """Make a copy-on-write clone of src at dest; raises OSError if not supported """
+    if sys.platform == "darwin":
+        _clonefile(src, dest)
+    elif sys.platform.startswith("linux"):
+        _ficlone(src, dest)
+    else:
+        raise OSError(errno.ENOTSUP, "cloning files not supported", str(dest))
+
+
+def stage_file(src, dest):
+    """Create dest with the contents of src using the cheapest strategy that works
+
+    Raises:
+        FileExistsError if dest already exists
+
+    Returns:
+        name of the strategy used: "hardlink", "clone" or "copy"
+    """
+    try:
+        os.link(src, dest)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS:
+            raise
+    try:
+        clone_file(src, dest)
+        return "clone"
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS:
+            raise
+    fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    os.close(fd)
+    shutil.copyfile(src, dest)
+    return "copy"
+
+
+def predict_strategy(src, directory=None):
+    """Return the strategy stage_file will most likely use to stage src in directory
+    (default the temporary directory) without staging it: "hardlink" if both are on
+    the same filesystem, otherwise "copy" """
+    directory = directory or tempfile.gettempdir()
+    try:
+        same_device = os.stat(src).st_dev == os.stat(directory).st_dev
+    except OSError:
+        return "copy"
+    return "hardlink" if same_device else "copy"
+
+
+class StagedPhoto:
+    """Files staged for a single source photo
+
+    Attributes:
+        files: list of paths of the staged files
+        strategies: dict of staged file name: strategy used to stage it
+        existing: uuids of destination photos with the same content if the photo
+            wasn't staged because it's already in the destination library
+    """
+
+    def __init__(self, files, strategies, tmpdir=None, existing=None):
+        self.files = files
+        self.strategies = strategies
+        self.existing = existing
+        self._tmpdir = tmpdir
+
+    def cleanup(self):
+        """Remove the staged files """
+        if self._tmpdir:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            return
+        for path in self.files:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+class StagingArea:
+    """Long-lived directory source photos are staged in for import
+
+    Files are staged directly in the directory under the photo's original filename;
+    if a photo with the same filename is already staged (e.g. IMG_0001.JPG from two
+    cameras) its files go into a new subdirectory instead.
+
+    Args:
+        path: optional directory to stage in; default is a new temporary directory
+            removed by cleanup()
+    """
+
+    def __init__(self, path=None):
+        self._tmpdir = None if path else tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(path or self._tmpdir.name)
+
+    def link(self, files, filename):
+        """Stage original files (the original plus any RAW or Live Photo companions)
+        named with the stem of filename and each file's own suffix
+
+        Returns:
+            StagedPhoto
+        """
+        stem = pathlib.Path(filename).stem
+        names = [f"{stem}{pathlib.Path(f).suffix}" for f in files]
+        try:
+            return self._link(files, names, self.path)
+        except FileExistsError:
+            tmpdir = tempfile.mkdtemp(dir=self.path)
+            staged = self._link(files, names, pathlib.Path(tmpdir))
+            staged._tmpdir = tmpdir
+            return staged
+
+    @staticmethod
+    def _link(files, names, directory):
+        staged = StagedPhoto([], {})
+        try:
+            for src, name in zip(files, names):
+                dest = directory / name
+                staged.strategies[name] = stage_file(src, dest)
+                staged.files.append(str(dest))
+        except OSError:
+            staged.cleanup()
+            raise
+        return staged
+
+    def export(self, src_photo, filename, **kwargs):
+        """Export src_photo with PhotoInfo.export into a new subdirectory
+
+        Returns:
+            StagedPhoto
+        """
+        tmpdir = tempfile.mkdtemp(dir=self.path)
+        exported = src_photo.export(tmpdir, filename, **kwargs)
+        return StagedPhoto(
+            exported,
+            {pathlib.Path(f).name: "export" for f in exported},
+            tmpdir=tmpdir,
+        )
+
+    def cleanup(self):
+        """Remove the staging directory if it's a temporary directory """
+        if self._tmpdir:
+            self._tmpdir.cleanup()
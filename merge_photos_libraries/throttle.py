@@ -0,0 +1,125 @@
+"""Retry and throttle calls to the destination library """
+
+# Photos slows down under sustained import load and may time out.
+# ThrottledBackend retries calls that fail with PhotosBusyError after a jittered
+# exponential backoff and feeds the latency of each import and metadata call to a
+# Throttle, which shrinks the batch size (multiplicative decrease) when calls take
+# longer than the target latency and grows it again one photo at a time
+# (additive increase) while they're faster.
+
+import random
+import time
+
+from .backend import PhotosBusyError
+
+THROTTLED_METHODS = ("import_photos", "set_metadata")
+""" calls whose latency depends on the batch size """
+
+
+class Throttle:
+    """Adapt batch size to hold the latency of calls to Photos near a target
+
+    Args:
+        target_latency: target seconds per call
+        max_batch_size: largest batch size; also the initial batch size
+        min_batch_size: smallest batch size
+        smoothing: weight of the newest call in the rolling (exponentially weighted)
+            latency
+
+    Attributes:
+        batch_size: current batch size
+        latency: dict of method: rolling latency in seconds
+    """
+
+    def __init__(self, target_latency, max_batch_size, min_batch_size=1, smoothing=0.3):
+        if target_latency <= 0:
+            raise ValueError("target_latency must be > 0")
+        self.target_latency = target_latency
+        self.max_batch_size = max_batch_size
+        self.min_batch_size = min(min_batch_size, max_batch_size)
+        self.batch_size = max_batch_size
+        self.latency = {}
+        self._smoothing = smoothing
+
+    def observe(self, method, seconds):
+        """Update the rolling latency of method with a call that took seconds and
+        adjust the batch size """
+        rolling = self.latency.get(method)
+        rolling = (
+            seconds
+            if rolling is None
+            else self._smoothing * seconds + (1 - self._smoothing) * rolling
+        )
+        self.latency[method] = rolling
+        if rolling > self.target_latency:
+            self.decrease()
+        elif self.batch_size < self.max_batch_size:
+            self.batch_size += 1
+
+    def decrease(self):
+        """Halve the batch size, e.g. because Photos is busy """
+        self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+
+
+class ThrottledBackend:
+    """Wrap a PhotosBackend, retrying calls that fail with PhotosBusyError
+
+    Args:
+        backend: PhotosBackend to wrap
+        throttle: optional Throttle fed with the latency of import and metadata calls
+        retries: maximum number of times a call is retried
+        backoff: delay before the first retry, in seconds; doubled for each retry
+            and randomized ("full jitter") so retries don't fall in step
+        max_backoff: maximum delay before a retry, in seconds
+        sleep: function to sleep for a number of seconds; default time.sleep
+
+    Attributes:
+        retry_count: total number of retries made
+    """
+
+    def __init__(
+        self,
+        backend,
+        throttle=None,
+        retries=3,
+        backoff=1.0,
+        max_backoff=60.0,
+        sleep=None,
+    ):
+        self._backend = backend
+        self._throttle = throttle
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._sleep = sleep or time.sleep
+        self.retry_count = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if name == "photo" or name.startswith("_") or not callable(attr):
+            return attr
+
+        def throttled(*args, **kwargs):
+            return self._call(name, attr, *args, **kwargs)
+
+        return throttled
+
+    def _call(self, name, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except PhotosBusyError:
+                if attempt >= self._retries:
+                    raise
+                if self._throttle:
+                    self._throttle.decrease()
+                delay = min(self._max_backoff, self._backoff * 2**attempt)
+                self._sleep(random.uniform(0, delay))
+                attempt += 1
+                self.retry_count += 1
+                continue
+            if self._throttle and name in THROTTLED_METHODS:
+                self._throttle.observe(name, time.perf_counter() - start)
+            return result
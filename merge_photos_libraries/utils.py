@@ -0,0 +1,7 @@
+"""Utility functions shared by the merge modules """
+
+# kept free of osxphotos so modules that only need these don't pay for importing it
+
+
+def noop(*args, **kwargs):
+    """Do nothing; default for optional verbose functions """
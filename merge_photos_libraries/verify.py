@@ -0,0 +1,266 @@
+"""Verify a merge by comparing the source and destination libraries """
+
+# verify reads the source and destination libraries through PhotosSource (reading a
+# copy of each Photos database, so neither library is touched and Photos isn't
+# needed) and joins them on the import_uuid recorded for each photo in the merge
+# database. Each side is reduced to a table of (destination uuid, field, value) rows,
+# the source's translated through the merge records, and the tables are compared with
+# set operations rather than photo by photo. Every mismatch found is written to a JSON
+# report naming the stage of the merge that has to run again to fix it, so the report
+# can drive a targeted repair.
+
+import datetime
+import json
+
+from .metadata import KeywordTable, photo_metadata
+from .utils import noop
+
+REPORT_FORMAT = "merge-photos-libraries-verify"
+REPORT_VERSION = 1
+
+MISMATCH_STAGES = {
+    "not_merged": "import",
+    "failed": "import",
+    "missing": "import",
+    "metadata": "metadata",
+    "album": "albums",
+}
+""" kinds of mismatch: source photo with no complete merge record, photo whose
+export or import failed, destination photo recorded but not in the destination
+library, metadata field that differs and album the destination photo isn't in;
+with the stage of the merge that fixes each """
+
+LOCATION_DIGITS = 6
+""" latitude and longitude are compared rounded to this many decimal places """
+
+
+def metadata_rows(uuid, metadata):
+    """Return list of (uuid, field, value) rows for dict metadata (see
+    metadata.photo_metadata); keywords have a row each as their order doesn't matter """
+    rows = []
+    for field, value in metadata.items():
+        if field == "keywords":
+            rows.extend((uuid, field, keyword) for keyword in value)
+        elif field == "location":
+            rows.append((uuid, field, tuple(round(v, LOCATION_DIGITS) for v in value)))
+        else:
+            rows.append((uuid, field, value))
+    return rows
+
+
+def _json_value(field, value):
+    if field == "keywords":
+        return sorted(value or ())
+    if field == "location":
+        return list(value) if value else None
+    return value
+
+
+class VerifyReport:
+    """Mismatches found by verifying a merge
+
+    Args:
+        sources: list of paths to the source libraries
+        destination: path to the destination library
+
+    Attributes:
+        sources: list of source library paths (str)
+        destination: destination library path (str)
+        checked: dict of counts of what was compared
+        mismatches: list of dicts with the kind (see MISMATCH_STAGES) and stage of
+            each mismatch, source library path, source uuid, destination uuid (None
+            if the photo wasn't imported) and details of the mismatch
+    """
+
+    def __init__(self, sources, destination):
+        self.sources = [str(source) for source in sources]
+        self.destination = str(destination)
+        self.created = datetime.datetime.now().isoformat()
+        self.checked = {"source_photos": 0, "destination_photos": 0}
+        self.mismatches = []
+
+    def __len__(self):
+        return len(self.mismatches)
+
+    def add(self, kind, source, src_uuid, dest_uuid=None, **details):
+        """Add a mismatch of kind for source photo src_uuid from source library path
+        source and destination photo dest_uuid """
+        mismatch = {
+            "kind": kind,
+            "stage": MISMATCH_STAGES[kind],
+            "source": str(source),
+            "src_uuid": src_uuid,
+            "dest_uuid": dest_uuid,
+        }
+        mismatch.update(details)
+        self.mismatches.append(mismatch)
+
+    def summary(self):
+        """Return dict of counts of what was checked and mismatches by kind """
+        kinds = {}
+        for mismatch in self.mismatches:
+            kinds[mismatch["kind"]] = kinds.get(mismatch["kind"], 0) + 1
+        return dict(self.checked, mismatches=kinds)
+
+    def uuids(self, stage=None):
+        """Return dict of source library path: set of source uuids with mismatches
+        fixed by stage (default any stage) """
+        uuids = {}
+        for mismatch in self.mismatches:
+            if stage is None or mismatch["stage"] == stage:
+                uuids.setdefault(mismatch["source"], set()).add(mismatch["src_uuid"])
+        return uuids
+
+    def save(self, path):
+        """Write the report to path as JSON """
+        data = {
+            "format": REPORT_FORMAT,
+            "version": REPORT_VERSION,
+            "created": self.created,
+            "sources": self.sources,
+            "destination": self.destination,
+            "summary": self.summary(),
+            "mismatches": self.mismatches,
+        }
+        with open(path, "w", encoding="utf-8") as fd:
+            json.dump(data, fd, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        """Read a report written by save()
+
+        Raises:
+            ValueError if path isn't a verify report or was written by a newer version
+        """
+        try:
+            with open(path, "r", encoding="utf-8") as fd:
+                data = json.load(fd)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"{path} is not a verify report: {e}") from e
+        if not isinstance(data, dict) or data.get("format") != REPORT_FORMAT:
+            raise ValueError(f"{path} is not a verify report")
+        if data["version"] > REPORT_VERSION:
+            raise ValueError(f"{path} was written by a newer version of merge")
+        report = cls(data["sources"], data["destination"])
+        report.created = data["created"]
+        report.checked = {k: v for k, v in data["summary"].items() if k != "mismatches"}
+        report.mismatches = data["mismatches"]
+        return report
+
+
+def verify_merge(sources, dest, report, person_keyword=False, verbose=None):
+    """Compare the source libraries with the destination library they were merged
+    into and add each mismatch to report
+
+    Args:
+        sources: list of (PhotosSource, MergeDB) for each source library in the
+            order of report.sources
+        dest: PhotosSource for the destination library
+        report: VerifyReport to add mismatches to
+        person_keyword: if True, expect a keyword for each named person as added by
+            merge --person-keyword
+        verbose: optional function to print verbose output
+
+    Returns:
+        report
+    """
+    verbose = verbose or noop
+    keywords = KeywordTable(person_keyword)
+    # destination uuid: (source library path, source uuid, metadata)
+    expected = {}
+    expected_rows = set()
+    expected_albums = set()
+    for library, (src, mergedb) in zip(report.sources, sources):
+        verbose(f"Reading merge records for {library}")
+        import_uuids = {}
+        done = set()
+        for record in mergedb.records():
+            uuid = record["src_uuid"]
+            if record.get("imported") and record.get("import_uuid"):
+                # an error recorded for an imported photo is from a failed --update,
+                # which the next --update retries
+                import_uuids[uuid] = record["import_uuid"]
+                done.add(uuid)
+            elif record.get("skipped"):
+                done.add(uuid)
+            elif record.get("export_error") or record.get("import_error"):
+                report.add(
+                    "failed",
+                    library,
+                    uuid,
+                    export_error=bool(record.get("export_error")),
+                    import_error=bool(record.get("import_error")),
+                )
+                done.add(uuid)
+
+        verbose(f"Reading source library {library}")
+        albums = src.album_index()
+        for src_photo in src.photos():
+            report.checked["source_photos"] += 1
+            if src_photo.uuid not in done:
+                report.add("not_merged", library, src_photo.uuid)
+                continue
+            if src_photo.uuid not in import_uuids:
+                continue
+            metadata = photo_metadata(src_photo, keywords)
+            photo_albums = albums.photo_albums(src_photo.uuid)
+            for dest_uuid in import_uuids[src_photo.uuid]:
+                expected[dest_uuid] = (library, src_photo.uuid, metadata)
+                expected_rows.update(metadata_rows(dest_uuid, metadata))
+                expected_albums.update(
+                    (dest_uuid, tuple(folder_names), title)
+                    for folder_names, title in photo_albums
+                )
+
+    verbose(f"Reading destination library {report.destination}")
+    actual = {}
+    actual_rows = set()
+    for dest_photo in dest.photos(uuids=set(expected)):
+        metadata = photo_metadata(dest_photo)
+        actual[dest_photo.uuid] = metadata
+        actual_rows.update(metadata_rows(dest_photo.uuid, metadata))
+    actual_albums = set()
+    dest_albums = dest.album_index()
+    for dest_uuid in actual:
+        actual_albums.update(
+            (dest_uuid, tuple(folder_names), title)
+            for folder_names, title in dest_albums.photo_albums(dest_uuid)
+        )
+    report.checked["destination_photos"] = len(actual)
+
+    verbose("Comparing libraries")
+    for dest_uuid in sorted(set(expected) - set(actual)):
+        library, src_uuid, _ = expected[dest_uuid]
+        report.add("missing", library, src_uuid, dest_uuid)
+
+    # fields merge writes on each destination photo found; a row in only one of the
+    # tables is a field that differs
+    checked = {
+        (dest_uuid, field) for dest_uuid in actual for field in expected[dest_uuid][2]
+    }
+    differing = {(u, f) for u, f, _ in expected_rows ^ actual_rows} & checked
+    for dest_uuid, field in sorted(differing):
+        library, src_uuid, metadata = expected[dest_uuid]
+        report.add(
+            "metadata",
+            library,
+            src_uuid,
+            dest_uuid,
+            field=field,
+            expected=_json_value(field, metadata[field]),
+            actual=_json_value(field, actual[dest_uuid].get(field)),
+        )
+
+    for dest_uuid, folder_names, title in sorted(expected_albums - actual_albums):
+        if dest_uuid not in actual:
+            continue
+        library, src_uuid, _ = expected[dest_uuid]
+        report.add(
+            "album",
+            library,
+            src_uuid,
+            dest_uuid,
+            folder_names=list(folder_names),
+            title=title,
+        )
+    return report
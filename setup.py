@@ -60,7 +60,6 @@ setup(
     install_requires=[
         "photoscript>=0.1.1",
         "osxphotos>=0.40.3",
-        "tinydb==4.3.0",
     ],
     entry_points={"console_scripts": ["merge_photos=merge_photos_libraries.__main__:cli"]},
     include_package_data=True,
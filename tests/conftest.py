@@ -1,21 +1,20 @@
-"""Configure tests for test_merge.py """
+"""Configure tests for merge_photos_libraries """
 
 import os
 import pathlib
 import platform
 import time
 
-import photoscript
 import pytest
-from applescript import AppleScript
-
-from osxphotos.fileutil import FileUtil
 
 
 def get_os_version():
 
     # returns tuple containing OS version
     # e.g. 10.13.6 = (10, 13, 6)
+    # returns (None, None, None) if not running on MacOS
+    if not platform.mac_ver()[0]:
+        return (None, None, None)
     version = platform.mac_ver()[0].split(".")
     if len(version) == 2:
         (ver, major) = version
@@ -40,11 +39,17 @@ else:
     TEST_LIBRARY_SOURCE = None
     TEST_LIBRARY_TARGET = None
     TEST_DATA = None
-    pytest.exit("This test suite currently only runs on MacOS Catalina ")
+
+requires_catalina = pytest.mark.skipif(
+    TEST_DATA is None, reason="This test currently only runs on MacOS Catalina"
+)
 
 
 def copy_photos_library(photos_library, destination=None):
     """ copy the test library, returns path to copied library """
+    import photoscript
+    from osxphotos.fileutil import FileUtil
+
     photoslib = photoscript.PhotosLibrary()
     photoslib.quit()
     picture_folder = (
@@ -60,6 +65,8 @@ def copy_photos_library(photos_library, destination=None):
 
 def open_photos_library(photoslibrary, delay=10):
     """ open a Photos library """
+    from applescript import AppleScript
+
     photoslibrary = str(photoslibrary)
     script = AppleScript(
         f"""
@@ -0,0 +1,96 @@
+"""Test album and folder registry against the fake destination backend """
+
+from merge_photos_libraries.albums import AlbumRegistry, add_planned_albums
+from merge_photos_libraries.backend import FakePhotosBackend
+from merge_photos_libraries.mergedb import MergeDB
+
+
+def make_dest(uuids=()):
+    """Return FakePhotosBackend holding photos with uuids """
+    dest = FakePhotosBackend()
+    for uuid in uuids:
+        dest.photos[uuid] = dict(FakePhotosBackend.METADATA_DEFAULTS)
+    return dest
+
+
+def test_album_registry_existing():
+    """existing albums are found without creating new ones """
+    dest = make_dest()
+    top = dest.create_album("Trips")
+    nested = dest.create_album("People", dest.make_folders(["Folder", "SubFolder"]))
+    dest.calls.clear()
+
+    albums = AlbumRegistry(dest)
+    assert albums.album([], "Trips") is top
+    assert albums.album(["Folder", "SubFolder"], "People") is nested
+    assert len(albums) == 2
+    assert "create_album" not in dest.calls
+    assert "make_folders" not in dest.calls
+
+
+def test_album_registry_creates_once():
+    """albums and folders are created once then served from the cache """
+    dest = make_dest()
+    albums = AlbumRegistry(dest)
+    first = albums.album(["Folder", "SubFolder"], "People")
+    calls = sum(dest.calls.values())
+    for _ in range(10):
+        assert albums.album(["Folder", "SubFolder"], "People") is first
+    assert sum(dest.calls.values()) == calls
+    assert dest.calls["create_album"] == 1
+    assert dest.calls["make_folders"] == 1
+
+
+def test_album_registry_same_title_different_folder():
+    """albums with the same title in different folders are distinct """
+    dest = make_dest()
+    albums = AlbumRegistry(dest)
+    top = albums.album([], "People")
+    nested = albums.album(["Folder"], "People")
+    assert top is not nested
+    assert albums.album(None, "People") is top
+
+
+def test_add_planned_albums(tmp_path):
+    """planned album membership is added in chunks and marked added """
+    mergedb = MergeDB(tmp_path / "merge.db", "source", "dest")
+    uuids = [f"UUID-{i}" for i in range(25)]
+    mergedb.plan_album(["Folder"], "Big", uuids)
+    mergedb.plan_album([], "Small", uuids[:2])
+
+    dest = make_dest(uuids)
+    albums = AlbumRegistry(dest)
+    failed = add_planned_albums(dest, albums, mergedb, chunk_size=10)
+    assert not failed
+    big = albums.album(["Folder"], "Big")
+    assert big.uuids == uuids
+    assert dest.calls["add"] == 4
+    assert albums.album([], "Small").uuids == uuids[:2]
+    assert mergedb.album_plan() == {}
+
+
+def test_add_planned_albums_resume(tmp_path):
+    """album phase resumes from the plan saved in the merge database """
+    dbpath = tmp_path / "merge.db"
+    mergedb = MergeDB(dbpath, "source", "dest")
+    mergedb.plan_album([], "Album", ["A", "B"])
+    mergedb.close()
+
+    mergedb = MergeDB(dbpath, "source", "dest")
+    assert mergedb.album_plan() == {((), "Album"): ["A", "B"]}
+    dest = make_dest(["A", "B"])
+    add_planned_albums(dest, AlbumRegistry(dest), mergedb)
+    assert mergedb.album_plan() == {}
+
+
+def test_add_planned_albums_failed(tmp_path):
+    """photos that can't be added are reported and left in the plan """
+
+    mergedb = MergeDB(tmp_path / "merge.db", "source", "dest")
+    mergedb.plan_album([], "Album", ["A", "B"])
+    # photo B isn't in the destination library so can't be added
+    dest = make_dest(["A"])
+    failed = add_planned_albums(dest, AlbumRegistry(dest), mergedb)
+    assert dest.calls["add"] == 2
+    assert failed == {((), "Album"): ["B"]}
+    assert mergedb.album_plan() == {((), "Album"): ["B"]}
@@ -0,0 +1,56 @@
+"""Test the fake destination backend used by tests and benchmarks """
+
+import pytest
+
+from merge_photos_libraries.backend import FakePhotosBackend, PhotosBackend
+
+
+def test_backend_is_abstract():
+    """a backend missing any method of the interface can't be created """
+
+    class PartialBackend(PhotosBackend):
+        def open(self, library_path):
+            pass
+
+    with pytest.raises(TypeError):
+        PhotosBackend()
+    with pytest.raises(TypeError):
+        PartialBackend()
+
+
+def test_fake_import_groups_by_stem():
+    """RAW+JPEG pairs and Live Photos import as one photo """
+    dest = FakePhotosBackend()
+    imported = dest.import_photos(
+        [
+            "/tmp/a/IMG_1.JPG",
+            "/tmp/a/IMG_1.cr2",
+            "/tmp/b/IMG_2.HEIC",
+            "/tmp/b/IMG_2.mov",
+        ]
+    )
+    assert [p.filename for p in imported] == ["IMG_1.JPG", "IMG_2.HEIC"]
+    assert set(dest.photos) == {p.uuid for p in imported}
+    assert dest.photo(imported[0].uuid).id == imported[0].id
+    assert dest.calls["import_photos"] == 1
+
+
+def test_fake_set_metadata_writes_changed_fields():
+    dest = FakePhotosBackend()
+    photo = dest.import_photos(["IMG_1.jpg"])[0]
+    written = dest.set_metadata(
+        [(photo, {"favorite": True, "title": "", "keywords": ["Travel"]})]
+    )
+    assert written == [["favorite", "keywords"]]
+    assert dest.set_metadata([(photo, {"favorite": True})]) == [[]]
+    assert dest.photos[photo.uuid]["keywords"] == ["Travel"]
+    assert dest.calls["set_metadata"] == 2
+
+
+def test_fake_latency():
+    """latency can be set per method """
+    dest = FakePhotosBackend(latency={"add": 0.01})
+    album = dest.create_album("Album")
+    dest.add(album, [])
+    assert dest.calls["add"] == 1
+    assert dest.album_uuids(album) == []
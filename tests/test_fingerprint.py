@@ -0,0 +1,101 @@
+"""Test the destination library content fingerprint index """
+
+import concurrent.futures
+import os
+
+from merge_photos_libraries.backend import FakePhotosBackend
+from merge_photos_libraries.cli import merge_photos
+from merge_photos_libraries.fingerprint import (
+    PARTIAL_HASH_SIZE,
+    FingerprintIndex,
+    file_hash,
+)
+from merge_photos_libraries.mergedb import MergeDB
+from merge_photos_libraries.source import generate_synthetic_library
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_find_uses_full_hash(tmp_path):
+    """files matching on size and partial hash are only found if their content matches """
+    head = b"h" * PARTIAL_HASH_SIZE
+    tail = b"t" * PARTIAL_HASH_SIZE
+    dest = write(tmp_path / "dest.jpg", head + b"middle" + tail)
+    index = FingerprintIndex(tmp_path / "index.db", workers=1)
+    assert index.update([("DEST", dest)]) == 1
+
+    same = write(tmp_path / "same.jpg", head + b"middle" + tail)
+    other = write(tmp_path / "other.jpg", head + b"MIDDLE" + tail)
+    assert file_hash(other) == file_hash(dest)
+    assert index.find(same) == ["DEST"]
+    assert index.find(other) == []
+    assert index.find(write(tmp_path / "small.jpg", b"small")) == []
+    index.close()
+
+
+def test_index_updated_incrementally(tmp_path):
+    """the cached index only hashes new or changed files and drops removed ones """
+    first = write(tmp_path / "1.jpg", b"first")
+    second = write(tmp_path / "2.jpg", b"second")
+    index = FingerprintIndex(tmp_path / "index.db", workers=1)
+    assert index.update([("1", first), ("2", second)]) == 2
+    assert index.find(first) == ["1"]
+    index.close()
+
+    index = FingerprintIndex(tmp_path / "index.db", workers=2)
+    third = write(tmp_path / "3.jpg", b"third")
+    assert index.update([("1", first), ("3", third)]) == 1
+    assert len(index) == 2
+    assert index.find(write(tmp_path / "copy.jpg", b"third")) == ["3"]
+    assert index.find(second) == []
+    index.close()
+
+
+def test_find_from_threads(tmp_path):
+    """find() from several threads while add() grows the index finds every match
+    and records the right full hash for each file """
+    head = b"h" * PARTIAL_HASH_SIZE
+    tail = b"t" * PARTIAL_HASH_SIZE
+    dests = [
+        write(tmp_path / f"dest{i}.jpg", head + b"%03d" % i + tail) for i in range(20)
+    ]
+    index = FingerprintIndex(tmp_path / "index.db", workers=1)
+    index.update([(f"DEST-{i}", path) for i, path in enumerate(dests[:10])])
+    copies = [
+        write(tmp_path / f"copy{i}.jpg", head + b"%03d" % i + tail) for i in range(10)
+    ]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        found = executor.map(index.find, copies * 4)
+        for i, path in enumerate(dests[10:], 10):
+            index.add(f"DEST-{i}", path)
+        found = list(found)
+    assert found == [[f"DEST-{i}"] for i in range(10)] * 4
+    for path, full in index._full_hashes.items():
+        assert full == file_hash(path, full=True)
+    index.close()
+
+
+def test_merge_skips_existing(tmp_path):
+    """photos already in the destination library are skipped and recorded """
+    src_photos = generate_synthetic_library(tmp_path / "lib", 20, file_size=16).photos()
+    existing = src_photos[:5]
+    index = FingerprintIndex(tmp_path / "index.db", workers=1)
+    index.update(
+        (f"DEST-{i}", p.path_edited if p.hasadjustments else p.path)
+        for i, p in enumerate(existing)
+    )
+
+    dest = FakePhotosBackend()
+    mergedb = MergeDB(tmp_path / "merge.db", "source", "dest")
+    with open(os.devnull, "w") as fp:
+        merge_photos(src_photos, dest, mergedb, existing=index, progress_file=fp)
+    index.close()
+    assert len(dest.photos) == 15
+    for i, photo in enumerate(existing):
+        record = mergedb.get(photo.uuid)[0]
+        assert record["skipped"]
+        assert record["existing_uuid"] == [f"DEST-{i}"]
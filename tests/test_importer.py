@@ -0,0 +1,106 @@
+"""Test batch import against a fake photoscript backend """
+
+import pathlib
+import uuid
+
+import pytest
+
+from merge_photos_libraries.importer import ImportBatch
+
+
+class FakePhoto:
+    """Fake photoscript.Photo """
+
+    def __init__(self, filename):
+        self.uuid = str(uuid.uuid4()).upper()
+        self.filename = filename
+
+
+class FakePhotosLibrary:
+    """Fake photoscript.PhotosLibrary that imports each group of files sharing
+    a stem (RAW+JPEG, Live Photo) as a single photo like Photos does """
+
+    def __init__(self):
+        self.import_calls = []
+
+    def import_photos(self, photo_paths, album=None, skip_duplicate_check=False):
+        self.import_calls.append(list(photo_paths))
+        photos = {}
+        for path in photo_paths:
+            path = pathlib.Path(path)
+            photos.setdefault(path.stem, FakePhoto(path.name))
+        return list(photos.values())
+
+
+def test_import_batch_single_call():
+    """batch of photos is imported with one call and mapped back to source uuids """
+    dest = FakePhotosLibrary()
+    batch = ImportBatch(3)
+    batch.add("A", ["/tmp/a/IMG_0001.jpeg"], "item_a")
+    batch.add("B", ["/tmp/b/IMG_0002.heic", "/tmp/b/IMG_0002.mov"], "item_b")
+    batch.add("C", ["/tmp/c/IMG_0003.JPG", "/tmp/c/IMG_0003.cr2"], "item_c")
+    assert batch.full
+
+    imported, unmatched = batch.import_photos(dest)
+    assert len(dest.import_calls) == 1
+    assert len(dest.import_calls[0]) == 5
+    assert not unmatched
+    assert [(key, item) for key, item, _ in imported] == [
+        ("A", "item_a"),
+        ("B", "item_b"),
+        ("C", "item_c"),
+    ]
+    filenames = {key: [p.filename for p in photos] for key, _, photos in imported}
+    assert filenames == {
+        "A": ["IMG_0001.jpeg"],
+        "B": ["IMG_0002.heic"],
+        "C": ["IMG_0003.JPG"],
+    }
+
+
+def test_import_batch_unique_uuids():
+    """each source photo gets its own destination uuids """
+    dest = FakePhotosLibrary()
+    batch = ImportBatch(2)
+    batch.add("A", ["/tmp/a/IMG_0001.jpeg"])
+    batch.add("B", ["/tmp/b/IMG_0002.jpeg"])
+    imported, _ = batch.import_photos(dest)
+    uuids = [p.uuid for _, _, photos in imported for p in photos]
+    assert len(uuids) == len(set(uuids)) == 2
+
+
+def test_import_batch_rejects_filename_collision():
+    """photos with the same filename stem can't share a batch """
+    batch = ImportBatch(10)
+    batch.add("A", ["/tmp/a/IMG_0001.jpeg"])
+    assert not batch.accepts(["/tmp/b/img_0001.heic"])
+    with pytest.raises(ValueError):
+        batch.add("B", ["/tmp/b/img_0001.heic"])
+    assert batch.accepts(["/tmp/b/IMG_0002.heic"])
+
+
+def test_import_batch_failed_import():
+    """photos missing from the import result are returned with no destination photos """
+
+    class FailingPhotosLibrary(FakePhotosLibrary):
+        def import_photos(self, photo_paths, album=None, skip_duplicate_check=False):
+            photos = super().import_photos(photo_paths, album, skip_duplicate_check)
+            return [p for p in photos if not p.filename.startswith("IMG_0002")]
+
+    batch = ImportBatch(2)
+    batch.add("A", ["/tmp/a/IMG_0001.jpeg"])
+    batch.add("B", ["/tmp/b/IMG_0002.jpeg"])
+    imported, unmatched = batch.import_photos(FailingPhotosLibrary())
+    assert not unmatched
+    assert [len(photos) for _, _, photos in imported] == [1, 0]
+
+
+def test_import_batch_clear():
+    """clear empties the batch so it can be reused """
+    batch = ImportBatch(1)
+    batch.add("A", ["/tmp/a/IMG_0001.jpeg"])
+    assert batch.full
+    batch.clear()
+    assert not batch.full
+    assert len(batch) == 0
+    assert batch.accepts(["/tmp/a/IMG_0001.jpeg"])
@@ -0,0 +1,149 @@
+"""Test the append-only merge journal """
+
+import os
+import uuid as uuidlib
+
+from merge_photos_libraries.backend import FakePhotosBackend
+from merge_photos_libraries.cli import merge_photos
+from merge_photos_libraries.journal import RECORD, MergeJournal
+from merge_photos_libraries.source import generate_synthetic_library
+
+
+def make_uuids(count):
+    return [str(uuidlib.uuid4()).upper() for _ in range(count)]
+
+
+def test_journal_round_trip(tmp_path):
+    """records are read back after reopening from the index without a replay """
+    src_uuids = make_uuids(20)
+    dest_uuids = make_uuids(20)
+    journal = MergeJournal(tmp_path / "journal", "source", "dest", snapshots=True)
+    for src_uuid, dest_uuid in zip(src_uuids, dest_uuids):
+        journal.upsert(
+            {
+                "src_uuid": src_uuid,
+                "version": "0.0.1",
+                "date": "2021-01-02T03:04:05.678901",
+                "imported": True,
+                "skipped": False,
+                "import_uuid": [dest_uuid],
+                "metadata": {"keywords": ["Travel"]},
+            }
+        )
+    journal.upsert({"src_uuid": src_uuids[0], "retries": 2})
+    journal.close()
+
+    journal = MergeJournal(tmp_path / "journal", "source", "dest")
+    assert not journal._db.overlay
+    assert journal.imported_uuids() == set(src_uuids)
+    record = journal.get(src_uuids[0])[0]
+    assert record["import_uuid"] == [dest_uuids[0]]
+    assert record["date"] == "2021-01-02T03:04:05.678901"
+    assert record["retries"] == 2
+    assert record["metadata"] == {"keywords": ["Travel"]}
+    assert journal.for_source("other").imported_uuids() == set()
+    assert {r["src_uuid"] for r in journal.records()} == set(src_uuids)
+    journal.close()
+
+
+def test_journal_inflight_and_albums(tmp_path):
+    """in-flight marks are cleared by records and added albums leave the plan """
+    src_uuids = make_uuids(3)
+    dest_uuids = make_uuids(3)
+    journal = MergeJournal(tmp_path / "journal", "source", "dest")
+    journal.mark_inflight(src_uuids)
+    journal.upsert({"src_uuid": src_uuids[0], "imported": True})
+    assert set(journal.inflight_uuids()) == set(src_uuids[1:])
+    journal.plan_album(["Folder"], "Album", dest_uuids)
+    journal.plan_album([], "Top", dest_uuids[:1])
+    journal.mark_album_added(["Folder"], "Album", dest_uuids[:2])
+    assert journal.album_plan() == {
+        (("Folder",), "Album"): dest_uuids[2:],
+        ((), "Top"): dest_uuids[:1],
+    }
+    journal.close()
+
+
+def test_journal_source_state(tmp_path):
+    """source state is kept for each source library and survives compaction """
+    journal = MergeJournal(tmp_path / "journal", "source", "dest")
+    other = journal.for_source("other")
+    assert journal.source_state() is None
+    journal.set_source_state("1:2;-", 10)
+    other.set_source_state("3:4;-", None)
+    journal.upsert({"src_uuid": make_uuids(1)[0], "imported": True})
+    journal.compact()
+    journal.close()
+
+    journal = MergeJournal(tmp_path / "journal", "source", "dest", read_only=True)
+    assert journal.source_state() == ("1:2;-", 10)
+    assert journal.for_source("other").source_state() == ("3:4;-", None)
+    journal.close()
+
+
+def test_journal_compaction(tmp_path):
+    """compaction drops superseded records and keeps the latest state """
+    src_uuids = make_uuids(10)
+    dest_uuids = make_uuids(10)
+    journal = MergeJournal(
+        tmp_path / "journal", "source", "dest", snapshots=True, compact_min=1000
+    )
+    for attempt in range(5):
+        for src_uuid in src_uuids:
+            journal.upsert({"src_uuid": src_uuid, "retries": attempt})
+    journal.flush()
+    journal.plan_album([], "Album", dest_uuids)
+    journal.mark_album_added([], "Album", dest_uuids[:5])
+    journal.mark_inflight(src_uuids[:1])
+    # 50 records, 10 album plans, 5 added and 1 in-flight mark; the latest record for
+    # each photo, the in-flight mark and the 5 albums not added are kept
+    assert journal.compact() == 66 - 16
+    assert journal.get(src_uuids[3])[0]["retries"] == 4
+    assert list(journal.inflight_uuids()) == src_uuids[:1]
+    assert journal.album_plan() == {((), "Album"): dest_uuids[5:]}
+    journal.close()
+
+    # compaction is automatic once superseded records outnumber live ones
+    journal = MergeJournal(tmp_path / "journal", "source", "dest", compact_min=5)
+    for _ in range(2):
+        for src_uuid in src_uuids:
+            journal.upsert({"src_uuid": src_uuid, "imported": True})
+    assert journal._db.superseded < journal._db.live
+    assert len(journal.imported_uuids()) == 10
+    journal.close()
+
+
+def test_journal_recovers_interrupted_write(tmp_path):
+    """a partly written record is dropped and records after the index are replayed """
+    src_uuids = make_uuids(4)
+    journal = MergeJournal(tmp_path / "journal", "source", "dest")
+    journal.upsert({"src_uuid": src_uuids[0], "imported": True})
+    journal.close()
+    journal = MergeJournal(tmp_path / "journal", "source", "dest")
+    for src_uuid in src_uuids[1:]:
+        journal.upsert({"src_uuid": src_uuid, "imported": True})
+    # simulate a crash: no index written and the last record cut short
+    journal._db._journal.close()
+    path = tmp_path / "journal" / "journal"
+    os.truncate(path, os.path.getsize(path) - RECORD.size // 2)
+
+    journal = MergeJournal(tmp_path / "journal", "source", "dest")
+    assert journal.imported_uuids() == set(src_uuids[:3])
+    journal.close()
+
+
+def test_merge_with_journal(tmp_path):
+    """merge checkpoints to a journal and a second merge skips every photo """
+    src_photos = generate_synthetic_library(tmp_path / "lib", 50, file_size=16).photos()
+    dest = FakePhotosBackend()
+    journal = MergeJournal(tmp_path / "journal", "source", "dest", flush_count=10)
+    with open(os.devnull, "w") as fp:
+        merge_photos(src_photos, dest, journal, import_batch_size=10, progress_file=fp)
+    journal.close()
+    assert len(dest.photos) == 50
+
+    journal = MergeJournal(tmp_path / "journal", "source", "dest")
+    assert journal.imported_uuids() == {p.uuid for p in src_photos}
+    assert journal.album_plan() == {}
+    assert journal.get(src_photos[0].uuid)[0]["import_uuid"][0] in dest.photos
+    journal.close()
@@ -4,7 +4,6 @@ import json
 import os
 import pathlib
 
-import photoscript
 import pytest
 from click.testing import CliRunner
 from tests.conftest import (
@@ -12,6 +11,7 @@ from tests.conftest import (
     TEST_LIBRARY_SOURCE,
     TEST_LIBRARY_TARGET,
     open_photos_library,
+    requires_catalina,
     suspend_capture,
 )
 
@@ -19,6 +19,7 @@ from osxphotos import PhotosDB
 from osxphotos.utils import get_last_library_path
 
 
+@requires_catalina
 def test_merge(suspend_capture):
     from merge_photos_libraries.cli import merge
 
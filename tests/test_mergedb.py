@@ -0,0 +1,283 @@
+"""Test the SQLite merge database """
+
+import datetime
+import json
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import osxphotos
+import pytest
+
+from merge_photos_libraries import cli
+from merge_photos_libraries.backend import FakePhotosBackend
+from merge_photos_libraries.mergedb import (
+    SCHEMA,
+    MergeDB,
+    MergeDBInMemory,
+    is_sqlite_db,
+)
+from merge_photos_libraries.source import SyntheticSource, generate_synthetic_library
+
+# merge database written by the TinyDB versions of merge
+TINYDB_RECORDS = {
+    "_default": {
+        "1": {
+            "src": "source",
+            "dest": "dest",
+            "src_uuid": "A",
+            "imported": True,
+            "import_uuid": ["X"],
+        },
+        "2": {"src": "source", "dest": "dest", "src_uuid": "B", "imported": False},
+        "10": {
+            "src": "other",
+            "dest": "dest",
+            "src_uuid": "A",
+            "imported": True,
+            "import_uuid": ["Y"],
+        },
+    }
+}
+
+
+def test_migrate_tinydb(tmp_path):
+    """a TinyDB merge database is migrated to SQLite and kept as a backup """
+    dbpath = tmp_path / "merge.db"
+    dbpath.write_text(json.dumps(TINYDB_RECORDS))
+    mergedb = MergeDB(dbpath, "source", "dest")
+    assert is_sqlite_db(dbpath)
+    backup = tmp_path / "merge.db.tinydb.bak"
+    assert json.loads(backup.read_text()) == TINYDB_RECORDS
+    assert mergedb.get("A")[0]["import_uuid"] == ["X"]
+    assert mergedb.imported_uuids() == {"A"}
+    assert mergedb.for_source("other").get("A")[0]["import_uuid"] == ["Y"]
+    mergedb.close()
+
+    # the migrated database opens as SQLite without migrating again
+    mergedb = MergeDB(dbpath, "source", "dest")
+    assert mergedb.get("B") == [
+        {"src": "source", "dest": "dest", "src_uuid": "B", "imported": False}
+    ]
+    mergedb.close()
+    assert json.loads(backup.read_text()) == TINYDB_RECORDS
+
+
+def test_migrate_tinydb_interrupted(tmp_path, monkeypatch):
+    """a migration interrupted before the records are committed leaves the TinyDB
+    database in place and an interrupted migration is resumed from the backup """
+    dbpath = tmp_path / "merge.db"
+    dbpath.write_text(json.dumps(TINYDB_RECORDS))
+
+    def fail(conn, records):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as patch:
+        patch.setattr(MergeDB, "_insert_records", staticmethod(fail))
+        with pytest.raises(KeyboardInterrupt):
+            MergeDB(dbpath, "source", "dest")
+    assert json.loads(dbpath.read_text()) == TINYDB_RECORDS
+    mergedb = MergeDB(dbpath, "source", "dest")
+    assert mergedb.imported_uuids() == {"A"}
+    assert mergedb.get("B")[0]["imported"] is False
+    mergedb.close()
+
+    # interrupted after the TinyDB file was moved to the backup
+    dbpath.unlink()
+    dry_run = MergeDBInMemory(dbpath, "source", "dest")
+    assert dry_run.imported_uuids() == {"A"}
+    dry_run.close()
+    assert not dbpath.exists()
+    mergedb = MergeDB(dbpath, "source", "dest")
+    assert mergedb.imported_uuids() == {"A"}
+    assert mergedb.for_source("other").imported_uuids() == {"A"}
+    mergedb.close()
+
+    # an empty database left in place by an earlier version is migrated again
+    dbpath.unlink()
+    conn = sqlite3.connect(str(dbpath))
+    conn.executescript(SCHEMA)
+    conn.close()
+    mergedb = MergeDB(dbpath, "source", "dest")
+    assert mergedb.imported_uuids() == {"A"}
+    mergedb.close()
+    assert not (tmp_path / "merge.db.migrating").exists()
+
+
+def test_in_memory_leaves_file_untouched(tmp_path):
+    """a dry run works on a copy of the database in memory """
+    dbpath = tmp_path / "merge.db"
+    mergedb = MergeDB(dbpath, "source", "dest")
+    mergedb.insert({"src_uuid": "A", "imported": True})
+    mergedb.close()
+    data = dbpath.read_bytes()
+
+    dry_run = MergeDBInMemory(dbpath, "source", "dest")
+    assert dry_run.imported_uuids() == {"A"}
+    dry_run.upsert({"src_uuid": "A", "imported": False})
+    dry_run.upsert({"src_uuid": "B", "imported": True})
+    dry_run.close()
+    assert dbpath.read_bytes() == data
+    mergedb = MergeDB(dbpath, "source", "dest")
+    assert mergedb.imported_uuids() == {"A"}
+    mergedb.close()
+
+    # a TinyDB database is read without migrating it
+    tinydb = tmp_path / "tinydb.db"
+    tinydb.write_text(json.dumps(TINYDB_RECORDS))
+    dry_run = MergeDBInMemory(tinydb, "source", "dest")
+    assert dry_run.imported_uuids() == {"A"}
+    dry_run.close()
+    assert json.loads(tinydb.read_text()) == TINYDB_RECORDS
+    assert not (tmp_path / "tinydb.db.tinydb.bak").exists()
+
+    # and a new database is never created on disk
+    MergeDBInMemory(tmp_path / "new.db", "source", "dest").close()
+    assert not (tmp_path / "new.db").exists()
+
+
+def test_unique_records(tmp_path):
+    """there's one record for each (src, dest, src_uuid) """
+    dbpath = tmp_path / "merge.db"
+    mergedb = MergeDB(dbpath, "source", "dest")
+    mergedb.insert({"src_uuid": "A", "imported": False})
+    with pytest.raises(ValueError):
+        mergedb.insert({"src_uuid": "A", "imported": True})
+    # the same uuid from another source library is a different photo
+    mergedb.for_source("other").insert({"src_uuid": "A", "imported": True})
+    mergedb.close()
+
+    conn = sqlite3.connect(str(dbpath))
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute(
+            "INSERT INTO merge (src, dest, src_uuid, record) VALUES (?, ?, ?, ?)",
+            ("source", "dest", "A", "{}"),
+        )
+    assert conn.execute("SELECT COUNT(*) FROM merge").fetchone()[0] == 2
+    conn.close()
+
+
+def test_get_update_upsert(tmp_path):
+    """update only changes existing records, upsert merges into the stored record and
+    get filters on imported """
+    mergedb = MergeDB(tmp_path / "merge.db", "source", "dest")
+    assert mergedb.get("A") == []
+    assert mergedb.update({"src_uuid": "A", "imported": True}) == []
+    assert mergedb.get("A") == []
+
+    mergedb.upsert({"src_uuid": "A", "imported": False, "export_error": True})
+    mergedb.upsert({"src_uuid": "A", "imported": True, "import_uuid": ["X"]})
+    record = mergedb.get("A")[0]
+    assert record["export_error"] and record["imported"]
+    assert record["src"] == "source" and record["dest"] == "dest"
+    assert mergedb.get("A", imported=True) == [record]
+    assert mergedb.get("A", imported=False) == []
+
+    mergedb.update({"src_uuid": "A", "title": "Title"})
+    assert mergedb.get("A")[0]["import_uuid"] == ["X"]
+    assert mergedb.get("A")[0]["title"] == "Title"
+    mergedb.upsert({"src_uuid": "B", "imported": False})
+    assert mergedb.imported_uuids() == {"A"}
+    assert mergedb.for_source("other").imported_uuids() == set()
+    assert [r["src_uuid"] for r in mergedb.records()] == ["A", "B"]
+    mergedb.close()
+
+
+def committed(dbpath):
+    """Return set of source uuids committed to the merge database at dbpath, read
+    with a connection of its own """
+    conn = sqlite3.connect(str(dbpath))
+    try:
+        return {row[0] for row in conn.execute("SELECT src_uuid FROM merge")}
+    finally:
+        conn.close()
+
+
+def test_buffered_writes(tmp_path):
+    """records are committed once flush_count are pending, once flush_interval has
+    passed and when the database is closed """
+    dbpath = tmp_path / "merge.db"
+    mergedb = MergeDB(dbpath, "source", "dest", flush_count=3)
+    mergedb.upsert({"src_uuid": "A", "imported": True})
+    mergedb.upsert({"src_uuid": "B", "imported": True})
+    mergedb.upsert({"src_uuid": "A", "import_uuid": ["X"]})
+    assert committed(dbpath) == set()
+    assert mergedb.get("A")[0]["import_uuid"] == ["X"]
+    mergedb.upsert({"src_uuid": "C", "imported": True})
+    assert committed(dbpath) == {"A", "B", "C"}
+    mergedb.upsert({"src_uuid": "D", "imported": True})
+    mergedb.close()
+    assert committed(dbpath) == {"A", "B", "C", "D"}
+
+    mergedb = MergeDB(dbpath, "source", "dest", flush_count=100, flush_interval=0.05)
+    mergedb.upsert({"src_uuid": "E", "imported": True})
+    assert committed(dbpath) == {"A", "B", "C", "D"}
+    time.sleep(0.06)
+    mergedb.upsert({"src_uuid": "F", "imported": True})
+    assert committed(dbpath) == {"A", "B", "C", "D", "E", "F"}
+    mergedb.close()
+
+
+def test_inflight_survives_crash(tmp_path):
+    """in-flight marks are committed right away; records still buffered are lost in
+    a crash and the photos are found in-flight when the database is opened again """
+    dbpath = tmp_path / "merge.db"
+    mergedb = MergeDB(dbpath, "source", "dest", flush_count=100)
+    mergedb.mark_inflight(["A", "B", "C"])
+    assert committed(dbpath) == {"A", "B", "C"}
+    mergedb.upsert({"src_uuid": "A", "imported": True})
+    mergedb.flush()
+    mergedb.upsert({"src_uuid": "B", "imported": True})
+    # crash: the connection goes away without a flush
+    mergedb._db.close()
+
+    mergedb = MergeDB(dbpath, "source", "dest")
+    assert set(mergedb.inflight_uuids()) == {"B", "C"}
+    assert mergedb.imported_uuids() == {"A"}
+    mergedb.close()
+
+
+def test_merge_resumes_inflight(tmp_path, monkeypatch):
+    """photos in-flight when a merge crashed are reconciled with the destination
+    photo imported for them before the crash or else imported again """
+    lib = generate_synthetic_library(tmp_path / "lib", 10, file_size=16)
+    photos = [p for p in lib.photos() if not p.hasadjustments]
+    dest_library = tmp_path / "Dest.photoslibrary"
+    dest = FakePhotosBackend()
+    monkeypatch.setattr(cli, "PhotoscriptBackend", lambda: dest)
+    monkeypatch.setattr(cli, "open_source", lambda path, stream: SyntheticSource(path))
+
+    # the merge crashed after Photos imported photos[0] but before its record was
+    # written; the destination already had a photo named like photos[1]
+    old = datetime.datetime(2020, 1, 1)
+    decoy = dest.import_photos([cli.export_filename(photos[1])])[0]
+    dest.photos[decoy.uuid]["date_added"] = old
+    mergedb = cli.open_mergedb(lib.library_path, dest_library)
+    mergedb.mark_inflight([photos[0].uuid, photos[1].uuid])
+    mergedb.close()
+    imported = dest.import_photos([cli.export_filename(photos[0])])[0]
+
+    def photosdb(dbfile):
+        now = datetime.datetime.now()
+        return SimpleNamespace(
+            photos=lambda: [
+                SimpleNamespace(
+                    uuid=uuid,
+                    original_filename=photo["filename"],
+                    date_added=photo.get("date_added", now),
+                )
+                for uuid, photo in dest.photos.items()
+            ]
+        )
+
+    monkeypatch.setattr(osxphotos, "PhotosDB", photosdb)
+    cli.run_merge([lib.library_path], dest_library)
+    # photos[0] isn't imported again, every other photo is
+    assert len(dest.photos) == 2 + len(lib.uuids()) - 1
+    mergedb = cli.open_mergedb(lib.library_path, dest_library)
+    record = mergedb.get(photos[0].uuid)[0]
+    assert record["reconciled"] and record["import_uuid"] == [imported.uuid]
+    assert mergedb.get(photos[1].uuid)[0]["import_uuid"] != [decoy.uuid]
+    assert mergedb.imported_uuids() == set(lib.uuids())
+    assert mergedb.inflight_uuids() == {}
+    mergedb.close()
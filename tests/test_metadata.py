@@ -0,0 +1,137 @@
+"""Test coalesced metadata writes """
+
+from types import SimpleNamespace
+
+import pytest
+
+from merge_photos_libraries.metadata import (
+    KeywordTable,
+    MetadataWriter,
+    applescript_value,
+    metadata_applescript,
+    metadata_delta,
+    photo_metadata,
+)
+
+
+def make_src_photo(**kwargs):
+    values = dict(
+        favorite=False,
+        title=None,
+        description=None,
+        keywords=[],
+        persons=[],
+        location=(None, None),
+    )
+    values.update(kwargs)
+    return SimpleNamespace(**values)
+
+
+def test_photo_metadata_defaults():
+    """None values are written as empty strings and missing location is omitted """
+    metadata = photo_metadata(make_src_photo())
+    assert metadata == {
+        "favorite": False,
+        "title": "",
+        "description": "",
+        "keywords": [],
+    }
+
+
+def test_photo_metadata_location():
+    metadata = photo_metadata(
+        make_src_photo(favorite=1, keywords=["Travel"], location=(33.8, -116.5))
+    )
+    assert metadata["favorite"] is True
+    assert metadata["keywords"] == ["Travel"]
+    assert metadata["location"] == (33.8, -116.5)
+
+
+def test_metadata_writer_batches_and_counts():
+    """writes are sent in batches and written/skipped fields are counted """
+    calls = []
+
+    def apply(items):
+        calls.append(len(items))
+        # pretend only non-default values needed writing
+        return [[f for f, v in metadata.items() if v] for _, metadata in items]
+
+    writer = MetadataWriter(apply, batch_size=2)
+    writer.write("photo1", {"favorite": True, "title": "", "keywords": ["a"]})
+    assert calls == []
+    writer.write("photo2", {"favorite": False, "title": "Title", "keywords": []})
+    assert calls == [2]
+    writer.write("photo3", {"favorite": False})
+    writer.flush()
+    writer.flush()
+    assert calls == [2, 1]
+    assert writer.counts["favorite"] == {"written": 1, "skipped": 2}
+    assert writer.counts["title"] == {"written": 1, "skipped": 1}
+    assert writer.counts["keywords"] == {"written": 1, "skipped": 1}
+    assert writer.counts["location"] == {"written": 0, "skipped": 0}
+    assert "favorite: 1 written, 2 skipped" in writer.summary()
+
+
+def test_applescript_value():
+    assert applescript_value(True) == "true"
+    assert applescript_value('say "hi" \\o/') == '"say \\"hi\\" \\\\o/"'
+    assert applescript_value(["a", "b"]) == '{"a", "b"}'
+    assert applescript_value((1.5, -2.0)) == "{1.5, -2.0}"
+    with pytest.raises(ValueError):
+        applescript_value(None)
+
+
+def test_metadata_applescript():
+    """one script sets all photos and only includes fields present """
+    script = metadata_applescript(
+        [
+            ("UUID1/L0/001", {"favorite": True, "title": "Title"}),
+            ("UUID2/L0/001", {"location": (1.0, 2.0)}),
+        ]
+    )
+    assert script.count("media item id") == 2
+    assert 'media item id "UUID1/L0/001"' in script
+    assert 'set name of p to "Title"' in script
+    assert "set favorite of p to true" in script
+    assert "set location of p to {1.0, 2.0}" in script
+    assert "description" not in script
+    assert "considering case" in script
+
+
+def test_keyword_table():
+    """photos with the same keywords share a tuple; persons become keywords if asked """
+    keywords = KeywordTable()
+    first = photo_metadata(make_src_photo(keywords=["a", "b"]), keywords)
+    second = photo_metadata(make_src_photo(keywords=["a", "b"]), keywords)
+    assert first["keywords"] == ("a", "b")
+    assert first["keywords"] is second["keywords"]
+    photo = make_src_photo(keywords=["a"], persons=["Jane", "_UNKNOWN_", "Jane"])
+    assert keywords.photo_keywords(photo) == ("a",)
+    assert keywords.words == ["a", "b"]
+
+    keywords = KeywordTable(person_keyword=True)
+    assert keywords.photo_keywords(photo) == ("a", "People/Jane")
+    assert len(keywords) == 2
+
+
+def test_keywords_compared_as_sets():
+    """keywords already on a photo in a different order aren't rewritten """
+    assert metadata_delta({"keywords": ("b", "a")}, {"keywords": ["a", "b"]}) == {}
+    assert metadata_delta({"keywords": ()}) == {}
+    assert metadata_delta({"keywords": ("a",)}) == {"keywords": ("a",)}
+
+
+def test_metadata_applescript_keyword_lists():
+    """each distinct list of keywords is declared once per script """
+    script = metadata_applescript(
+        [
+            ("UUID1/L0/001", {"keywords": ("Travel", "Beach")}),
+            ("UUID2/L0/001", {"keywords": ("Travel", "Beach")}),
+            ("UUID3/L0/001", {"keywords": ("Travel",)}),
+        ]
+    )
+    assert script.count('"Beach"') == 1
+    assert 'set k0 to {"Travel", "Beach"}' in script
+    assert script.count("set keywords of p to k0") == 2
+    assert "set keywords of p to k1" in script
+    assert "on sameKeywords(a, b)" in script
@@ -0,0 +1,73 @@
+"""Test merge stage metrics """
+
+import csv
+import json
+import os
+
+from merge_photos_libraries.backend import FakePhotosBackend
+from merge_photos_libraries.cli import merge_photos
+from merge_photos_libraries.mergedb import MergeDB
+from merge_photos_libraries.metrics import NULL_METRICS, Metrics, StageStats
+from merge_photos_libraries.source import generate_synthetic_library
+
+
+def test_stage_stats_percentiles():
+    """percentiles are the upper bound of the histogram bucket they fall in """
+    stats = StageStats()
+    for seconds in [0.002] * 90 + [0.3] * 9 + [100]:
+        stats.add(seconds, nbytes=10)
+    assert stats.count == 100
+    assert stats.bytes == 1000
+    assert stats.percentile(0.5) == 0.0025
+    assert stats.percentile(0.95) == 0.5
+    assert stats.percentile(1.0) == 100
+    assert sum(stats.buckets) == 100
+
+
+def test_null_metrics():
+    """metrics that are off record nothing """
+    with NULL_METRICS.timer("stage"):
+        NULL_METRICS.increment("counter")
+    assert not NULL_METRICS.enabled
+
+
+def test_merge_metrics_json(tmp_path):
+    """a merge with metrics writes stage timings as JSON lines """
+    src_photos = generate_synthetic_library(tmp_path / "lib", 40, file_size=16).photos()
+    lines = []
+    metrics = Metrics(tmp_path / "metrics.jsonl", interval=3600, report=lines.append)
+    mergedb = MergeDB(tmp_path / "merge.db", "source", "dest", metrics=metrics)
+    with open(os.devnull, "w") as fp:
+        merge_photos(
+            src_photos,
+            FakePhotosBackend(),
+            mergedb,
+            import_batch_size=10,
+            progress_file=fp,
+            metrics=metrics,
+        )
+    mergedb.close()
+    metrics.close()
+
+    snapshot = json.loads(open(tmp_path / "metrics.jsonl").read().splitlines()[-1])
+    stages = snapshot["stages"]
+    for stage in ("export", "import", "metadata", "albums", "checkpoint"):
+        assert stages[stage]["count"]
+    assert stages["photos.import_photos"]["count"] == 4
+    assert stages["export"]["bytes"] >= 16 * 40
+    assert snapshot["counters"]["imported"] == 40
+    assert len(lines) == 1 and "photos.import_photos: 4" in lines[0]
+
+
+def test_metrics_csv(tmp_path):
+    """CSV metrics have a row per stage and counter """
+    metrics = Metrics(tmp_path / "metrics.csv")
+    metrics.record("export", 0.5, nbytes=100)
+    metrics.increment("imported", 2)
+    metrics.close()
+    rows = list(csv.DictReader(open(tmp_path / "metrics.csv")))
+    assert [(r["stage"], r["count"]) for r in rows] == [
+        ("export", "1"),
+        ("imported", "2"),
+    ]
+    assert rows[0]["bytes_per_sec"] == "200.0"
@@ -0,0 +1,81 @@
+"""Test running work ahead of a serial consumer """
+
+import threading
+import time
+
+import pytest
+
+from merge_photos_libraries.pipeline import interleave, prefetch
+
+
+def test_prefetch_order():
+    """items are yielded in order however long each takes """
+
+    def work(item):
+        time.sleep((10 - item) * 0.002)
+        return item * 2
+
+    results = [
+        (item, future.result())
+        for item, future in prefetch(range(10), work, workers=4, depth=4)
+    ]
+    assert results == [(item, item * 2) for item in range(10)]
+
+
+def test_prefetch_back_pressure():
+    """no more than depth items are submitted ahead of the item being consumed """
+    pulled = []
+
+    def items():
+        for item in range(20):
+            pulled.append(item)
+            yield item
+
+    for item, future in prefetch(items(), lambda item: item, workers=2, depth=3):
+        assert len(pulled) <= item + 1 + 3
+        future.result()
+        time.sleep(0.001)
+    assert len(pulled) == 20
+
+
+def test_prefetch_cancels_on_close():
+    """work not yet started is cancelled when the consumer stops early """
+    started = []
+    release = threading.Event()
+
+    def work(item):
+        started.append(item)
+        release.wait()
+        return item
+
+    pipeline = prefetch(range(10), work, workers=1, depth=5)
+    item, future = next(pipeline)
+    assert item == 0
+    # the worker is busy with the first item until the pipeline has been closed
+    timer = threading.Timer(0.1, release.set)
+    timer.start()
+    pipeline.close()
+    timer.join()
+    assert future.result() == 0
+    assert started == [0]
+
+
+def test_prefetch_arguments():
+    with pytest.raises(ValueError):
+        list(prefetch([1], str, workers=0))
+    with pytest.raises(ValueError):
+        list(prefetch([1], str, depth=0))
+
+
+def test_interleave():
+    """one item is taken from each iterable in turn, skipping exhausted ones """
+    iterables = [[1, 2, 3], [], ["a"], iter("xy")]
+    assert list(interleave(iterables)) == [
+        (0, 1),
+        (2, "a"),
+        (3, "x"),
+        (0, 2),
+        (3, "y"),
+        (0, 3),
+    ]
+    assert list(interleave([])) == []
@@ -0,0 +1,156 @@
+"""Test planning a merge and executing the plan """
+
+import json
+import os
+import pathlib
+import shutil
+
+from click.testing import CliRunner
+
+from merge_photos_libraries import cli as cli_module
+from merge_photos_libraries.backend import FakePhotosBackend
+from merge_photos_libraries.cli import cli, plan_photo
+from merge_photos_libraries.metadata import KeywordTable, photo_metadata
+from merge_photos_libraries.plan import MergePlan
+from merge_photos_libraries.source import (
+    SYNTHETIC_MANIFEST,
+    SyntheticSource,
+    generate_synthetic_library,
+)
+
+TEST_LIBRARY = (
+    pathlib.Path(__file__).parent
+    / "test_libraries"
+    / "TestSource-10.15.7.photoslibrary"
+)
+
+
+def test_plan_save_load_shards(tmp_path):
+    """a plan survives a round trip and its shards cover every photo once """
+    src = generate_synthetic_library(tmp_path / "lib", 50, file_size=16)
+    src_photos = src.photos()
+    albums = src.album_index()
+    merge_plan = MergePlan([tmp_path / "lib"], tmp_path / "Dest.photoslibrary")
+    imported = {src_photos[0].uuid}
+    for photo in src_photos:
+        plan_photo(merge_plan, 0, photo, imported, None, albums, KeywordTable())
+    assert len(merge_plan) == 49
+    assert merge_plan.skipped == {"imported": 1}
+    merge_plan.set_source_state(tmp_path / "lib")
+    merge_plan.save(tmp_path / "plan.gz")
+
+    loaded = MergePlan.load(tmp_path / "plan.gz")
+    assert loaded.columns == json.loads(json.dumps(merge_plan.columns))
+    assert loaded.albums == merge_plan.albums
+    assert loaded.summary() == merge_plan.summary()
+    row = loaded.row(0)
+    assert row["uuid"] == src_photos[1].uuid
+    assert row["staging"] in ("hardlink", "copy", "export")
+    assert {loaded.albums[i] for i in row["albums"]} == {
+        (tuple(a.folder_names), a.title) for a in src_photos[1].album_info
+    }
+
+    assert loaded.source_states == merge_plan.source_states
+    assert loaded.changed_sources() == []
+    planned = loaded.planned_sources(range(len(loaded)))[str(tmp_path / "lib")]
+    assert len(planned.uuids) == 49
+    for photo in src_photos[1:]:
+        assert planned.metadata[photo.uuid] == photo_metadata(photo, KeywordTable())
+        assert planned.albums.photo_albums(photo.uuid) == albums.photo_albums(
+            photo.uuid
+        )
+
+    shards = [loaded.shard(i, 3) for i in (1, 2, 3)]
+    assert [r for shard in shards for r in shard] == list(range(49))
+    uuids = loaded.uuids(shards[0])
+    assert list(uuids) == [str(tmp_path / "lib")]
+    assert len(uuids[str(tmp_path / "lib")]) == len(shards[0])
+
+
+def test_plan_command_and_dry_run(tmp_path):
+    """plan writes a plan for the source library that execute --dry-run summarizes """
+    library = tmp_path / "Source.photoslibrary"
+    shutil.copytree(TEST_LIBRARY, library)
+    dest = tmp_path / "Dest.photoslibrary"
+    dest.mkdir()
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["plan", str(library), str(dest), "--plan", str(tmp_path / "plan.gz")]
+    )
+    assert result.exit_code == 0, result.output
+    merge_plan = MergePlan.load(tmp_path / "plan.gz")
+    assert merge_plan.destination == str(dest)
+    assert len(merge_plan)
+
+    result = runner.invoke(
+        cli,
+        ["execute", "--plan", str(tmp_path / "plan.gz"), "--shard", "2/2", "--dry-run"],
+    )
+    assert result.exit_code == 0, result.output
+    summary = json.loads(result.output)
+    assert summary["photos"] == len(merge_plan.shard(2, 2))
+
+    result = runner.invoke(cli, ["execute", "--plan", str(library), "--dry-run"])
+    assert result.exit_code == 2
+
+
+def test_execute_from_plan(tmp_path, monkeypatch):
+    """execute reads only the planned photos from the source, gives them the planned
+    albums and metadata and refuses to run once the source changed """
+    lib = generate_synthetic_library(tmp_path / "lib", 40, file_size=16)
+    dest_library = tmp_path / "Dest.photoslibrary"
+    dest_library.mkdir()
+    plan_file = tmp_path / "plan.gz"
+    dest = FakePhotosBackend()
+    monkeypatch.setattr(cli_module, "PhotoscriptBackend", lambda: dest)
+    monkeypatch.setattr(
+        cli_module, "open_source", lambda path, stream: SyntheticSource(path)
+    )
+    runner = CliRunner()
+    args = ["plan", str(lib.library_path), str(dest_library), "--plan"]
+    result = runner.invoke(cli, args + [str(plan_file)])
+    assert result.exit_code == 0, result.output
+    merge_plan = MergePlan.load(plan_file)
+    assert not merge_plan.changed_sources()
+    merge_plan.columns["title"][0] = "Planned title"
+    merge_plan.save(plan_file)
+
+    reads = []
+
+    class PlannedOnlySource(SyntheticSource):
+        def photos(self, uuids=None):
+            reads.append(None if uuids is None else set(uuids))
+            return super().photos(uuids)
+
+        def album_index(self):
+            raise AssertionError("albums are read from the plan")
+
+    monkeypatch.setattr(
+        cli_module, "open_source", lambda path, stream: PlannedOnlySource(path)
+    )
+    result = runner.invoke(cli, ["execute", "--plan", str(plan_file), "--shard", "1/2"])
+    assert result.exit_code == 0, result.output
+    shard = merge_plan.shard(1, 2)
+    planned = merge_plan.uuids(shard)[str(lib.library_path)]
+    assert reads and all(uuids is not None and uuids <= planned for uuids in reads)
+    assert len(dest.photos) == len(shard)
+    assert [p["title"] for p in dest.photos.values()].count("Planned title") == 1
+    planned_albums = {
+        merge_plan.albums[a] for r in shard for a in merge_plan.row(r)["albums"]
+    }
+    assert {
+        key for key, album in dest.albums().items() if album.uuids
+    } == planned_albums
+
+    # any change to the source means the plan may be out of date
+    manifest = lib.library_path / SYNTHETIC_MANIFEST
+    stat = manifest.stat()
+    os.utime(manifest, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    args = ["execute", "--plan", str(plan_file), "--shard", "2/2"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert "changed since it was planned" in result.output
+    assert len(dest.photos) == len(shard)
+    result = runner.invoke(cli, args + ["--force"])
+    assert result.exit_code == 0, result.output
+    assert len(dest.photos) == len(merge_plan)
@@ -0,0 +1,77 @@
+"""Test the pre-flight check of source photos """
+
+import os
+import pathlib
+
+from merge_photos_libraries import cli
+from merge_photos_libraries.backend import FakePhotosBackend
+from merge_photos_libraries.preflight import PreflightManifest, check_files, preflight
+from merge_photos_libraries.source import SyntheticSource, generate_synthetic_library
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_check_files(tmp_path):
+    """each kind of bad photo is found and good photos report their size """
+    jpeg = write(tmp_path / "IMG_0001.JPG", b"jpeg")
+    raw = write(tmp_path / "IMG_0001.CR2", b"raw data")
+    assert check_files([jpeg, raw])[:2] == (None, 12)
+    assert check_files([])[0] == "missing"
+    assert check_files([str(tmp_path / "IMG_0002.JPG")])[0] == "missing"
+    assert check_files([jpeg, str(tmp_path / "IMG_0001.MOV")])[0] == "missing companion"
+    assert check_files([write(tmp_path / "IMG_0003.JPG", b"")])[0] == "empty"
+    assert check_files([write(tmp_path / "notes.txt", b"text")])[0] == "unsupported"
+
+
+def test_preflight_manifest(tmp_path):
+    """photos that passed are only read again once their file changes and photos that
+    fail are dropped from the manifest """
+    good = write(tmp_path / "good.jpg", b"good")
+    other = write(tmp_path / "other.jpg", b"other")
+    manifest = PreflightManifest(tmp_path / "preflight.db")
+    report = preflight([("1", [good]), ("2", [other])], manifest=manifest, workers=2)
+    assert report.problems == {}
+    assert (report.bytes, report.checked, report.cached) == (9, 2, 0)
+    manifest.close()
+
+    manifest = PreflightManifest(tmp_path / "preflight.db")
+    os.truncate(other, 0)
+    report = preflight([("1", [good]), ("2", [other])], manifest=manifest)
+    assert report.problems == {"2": "empty"}
+    assert (report.bytes, report.cached) == (4, 1)
+    assert manifest.get("2") is None
+    manifest.close()
+
+
+def test_merge_sets_aside_bad_photos(tmp_path, monkeypatch):
+    """photos that fail the pre-flight check are recorded as export errors before
+    anything is imported and merged once they're fixed """
+    lib = generate_synthetic_library(tmp_path / "lib", 20, file_size=16)
+    photos = lib.photos()
+    bad = [p for p in photos if not p.hasadjustments][:2]
+    os.truncate(bad[0].path, 0)
+    moved = pathlib.Path(bad[1].path).with_suffix(".bak")
+    os.rename(bad[1].path, moved)
+
+    dest = FakePhotosBackend()
+    monkeypatch.setattr(cli, "PhotoscriptBackend", lambda: dest)
+    monkeypatch.setattr(cli, "open_source", lambda path, stream: SyntheticSource(path))
+    dest_library = tmp_path / "Dest.photoslibrary"
+    cli.run_merge([lib.library_path], dest_library)
+    assert len(dest.photos) == 18
+    assert dest.calls["import_photos"] == 18
+
+    mergedb = cli.open_mergedb(lib.library_path, dest_library)
+    records = {p.uuid: mergedb.get(p.uuid)[0] for p in bad}
+    mergedb.close()
+    assert records[bad[0].uuid]["preflight"] == "empty"
+    assert records[bad[1].uuid]["preflight"] == "missing"
+    assert all(r["export_error"] and not r["imported"] for r in records.values())
+
+    write(pathlib.Path(bad[0].path), b"fixed")
+    os.rename(moved, bad[1].path)
+    cli.run_merge([lib.library_path], dest_library)
+    assert len(dest.photos) == 20
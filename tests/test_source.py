@@ -0,0 +1,279 @@
+"""Test the source library interface and its implementations """
+
+import json
+import os
+import pathlib
+import shutil
+import sqlite3
+import time
+
+import osxphotos
+import pytest
+
+from merge_photos_libraries.backend import FakePhotosBackend
+from merge_photos_libraries import cli
+from merge_photos_libraries.cli import MergeSource, merge_photos, merge_sources
+from merge_photos_libraries.mergedb import MergeDB
+from merge_photos_libraries.source import (
+    SOURCE_PHOTO_ATTRIBUTES,
+    OsxPhotosSource,
+    PhotosSource,
+    StreamingPhotosSource,
+    SyntheticSource,
+    database_tables,
+    generate_synthetic_library,
+    library_fingerprint,
+    library_photo_count,
+)
+
+TEST_LIBRARY = (
+    pathlib.Path(__file__).parent
+    / "test_libraries"
+    / "TestSource-10.15.7.photoslibrary"
+)
+
+
+def test_generate_synthetic_library_reproducible(tmp_path):
+    """the same seed generates the same library """
+    first = generate_synthetic_library(tmp_path / "a", 50, seed=1, file_size=16)
+    second = generate_synthetic_library(tmp_path / "b", 50, seed=1, file_size=16)
+    assert [p.uuid for p in first.photos()] == [p.uuid for p in second.photos()]
+    photo = SyntheticSource(tmp_path / "a").photos()[0]
+    for attribute in SOURCE_PHOTO_ATTRIBUTES:
+        assert hasattr(photo, attribute)
+    assert os.path.getsize(photo.path) == 16
+
+
+def test_source_defaults(tmp_path):
+    """PhotosSource can't be created without photos() and a source with only photos()
+    gets the other methods from it """
+
+    class ListSource(PhotosSource):
+        def photos(self, uuids=None):
+            return [p for p in lib.photos() if uuids is None or p.uuid in uuids]
+
+    with pytest.raises(TypeError):
+        PhotosSource(tmp_path)
+    lib = generate_synthetic_library(tmp_path / "lib", 20, file_size=16)
+    src = ListSource(lib.library_path)
+    assert src.uuids() == lib.uuids()
+    albums = lib.album_index()
+    assert all(
+        src.album_index().photo_albums(u) == albums.photo_albums(u) for u in lib.uuids()
+    )
+
+
+def test_synthetic_export_companions(tmp_path):
+    """RAW and Live Photo companions are exported with the stem of filename """
+    src = generate_synthetic_library(tmp_path / "lib", 200, file_size=16)
+    pairs = [p for p in src.photos() if len(p._files) == 2 and not p.hasadjustments]
+    assert pairs
+    exported = pairs[0].export(
+        tmp_path, "Export.JPG", edited=False, live_photo=True, raw_photo=True
+    )
+    assert len(exported) == 2
+    assert {os.path.basename(f).split(".")[0] for f in exported} == {"Export"}
+    assert len(pairs[0].export(tmp_path, "Single.JPG")) == 1
+
+
+def test_merge_synthetic_library(tmp_path):
+    """merge a synthetic library into the fake destination"""
+    src_photos = generate_synthetic_library(
+        tmp_path / "lib", 100, file_size=16
+    ).photos()
+    dest = FakePhotosBackend()
+    mergedb = MergeDB(tmp_path / "merge.db", "source", "dest")
+    with open(os.devnull, "w") as fp:
+        merge_photos(src_photos, dest, mergedb, import_batch_size=10, progress_file=fp)
+    assert len(dest.photos) == 100
+    assert mergedb.imported_uuids() == {p.uuid for p in src_photos}
+    assert mergedb.album_plan() == {}
+    titles = {p.title for p in src_photos if p.title}
+    assert titles == {p["title"] for p in dest.photos.values() if p["title"]}
+
+
+def test_merge_multiple_sources(tmp_path):
+    """several sources merge in one pass with separate checkpoints and shared albums """
+    libraries = [
+        generate_synthetic_library(tmp_path / f"lib{seed}", 60, seed=seed, file_size=16)
+        for seed in (1, 2)
+    ]
+    mergedb = MergeDB(tmp_path / "merge.db", "source1", "dest")
+    mergedbs = [mergedb, mergedb.for_source("source2")]
+    sources = [
+        MergeSource(lib.photos(), db, {}, 60) for lib, db in zip(libraries, mergedbs)
+    ]
+    dest = FakePhotosBackend()
+    with open(os.devnull, "w") as fp:
+        merge_sources(sources, dest, import_batch_size=10, progress_file=fp)
+    assert len(dest.photos) == 120
+    for lib, db in zip(libraries, mergedbs):
+        assert db.imported_uuids() == {p.uuid for p in lib.photos()}
+    assert dest.calls["albums"] == 1
+    album_keys = {
+        (tuple(a.folder_names), a.title)
+        for lib in libraries
+        for p in lib.photos()
+        for a in p.album_info
+    }
+    assert len(dest.albums()) == len(album_keys)
+    mergedbs[1].close()
+    mergedb.close()
+
+
+def test_streaming_source_matches_osxphotos(tmp_path):
+    """photos streamed from the database match those read by osxphotos """
+    # work on a copy as reading a library can touch its database files
+    library = tmp_path / "Source.photoslibrary"
+    shutil.copytree(TEST_LIBRARY, library)
+    expected = {p.uuid: p for p in osxphotos.PhotosDB(dbfile=str(library)).photos()}
+
+    src = StreamingPhotosSource(library, page_size=2)
+    photos = list(src.photos())
+    assert [p.uuid for p in photos] == src.uuids()
+    assert {p.uuid for p in photos} == set(expected)
+    for photo in photos:
+        photoinfo = expected[photo.uuid]
+        for attribute in SOURCE_PHOTO_ATTRIBUTES:
+            if attribute == "album_info":
+                assert [(a.folder_names, a.title) for a in photo.album_info] == [
+                    (a.folder_names, a.title) for a in photoinfo.album_info
+                ]
+            elif attribute == "keywords":
+                assert sorted(photo.keywords) == sorted(photoinfo.keywords)
+            else:
+                assert getattr(photo, attribute) == getattr(photoinfo, attribute)
+        assert photo.render_template("{folder_album,}") == photoinfo.render_template(
+            "{folder_album,}"
+        )
+    assert [p.uuid for p in src.photos(uuids=[photos[1].uuid])] == [photos[1].uuid]
+    src.close()
+
+
+def test_database_tables(tmp_path):
+    """the version dependent names are read from the schema of the database """
+    library = tmp_path / "Source.photoslibrary"
+    shutil.copytree(TEST_LIBRARY, library)
+    conn = sqlite3.connect(str(library / "database" / "Photos.sqlite"))
+    assert database_tables(conn) == {
+        "ASSET": "ZGENERICASSET",
+        "HAS_ADJUSTMENTS": "ZGENERICASSET.ZHASADJUSTMENTS",
+        "KEYWORD_JOIN": "Z_1KEYWORDS.Z_37KEYWORDS",
+        "DETECTED_FACE_ASSET_FK": "ZDETECTEDFACE.ZASSET",
+        "DETECTED_FACE_PERSON_FK": "ZDETECTEDFACE.ZPERSON",
+        "ASSET_ALBUM_TABLE": "Z_26ASSETS",
+        "ALBUM_JOIN": "Z_26ASSETS.Z_34ASSETS",
+        "ASSET_ALBUM_JOIN": "Z_26ASSETS.Z_26ALBUMS",
+    }
+    conn.close()
+    with pytest.raises(ValueError):
+        StreamingPhotosSource(tmp_path)
+
+
+def test_album_index_matches_album_info(tmp_path):
+    """the album index of each kind of source matches each photo's album_info """
+    library = tmp_path / "Source.photoslibrary"
+    shutil.copytree(TEST_LIBRARY, library)
+
+    class PublicPhotosDB:
+        """PhotosDB without its private attributes """
+
+        def __init__(self, photosdb):
+            self._photosdb = photosdb
+
+        def __getattr__(self, name):
+            if name.startswith("_"):
+                raise AttributeError(name)
+            return getattr(self._photosdb, name)
+
+    # without the album table osxphotos keeps privately, OsxPhotosSource reads
+    # AlbumInfo.photos
+    public_only = OsxPhotosSource(library)
+    public_only._photosdb = PublicPhotosDB(public_only._photosdb)
+    sources = [
+        OsxPhotosSource(library),
+        public_only,
+        StreamingPhotosSource(library),
+        generate_synthetic_library(tmp_path / "lib", 100, file_size=16),
+    ]
+    for src in sources:
+        index = src.album_index()
+        for photo in src.photos():
+            expected = photo.render_template("{folder_album,}")[0]
+            assert index.folder_albums(photo.uuid) == sorted(e for e in expected if e)
+            assert set(index.photo_albums(photo.uuid)) == {
+                (tuple(a.folder_names), a.title) for a in photo.album_info
+            }
+        assert len(index)
+        src.close()
+
+
+def test_merge_skips_unchanged_source(tmp_path, monkeypatch):
+    """a merge of a source unchanged since a complete merge exits before opening
+    the destination library """
+    library = tmp_path / "Source.photoslibrary"
+    shutil.copytree(TEST_LIBRARY, library)
+    src = StreamingPhotosSource(library)
+    assert library_photo_count(library) == len(src.uuids())
+    src.close()
+
+    dest_library = tmp_path / "Dest.photoslibrary"
+    dests = []
+
+    def backend():
+        dests.append(FakePhotosBackend())
+        return dests[-1]
+
+    monkeypatch.setattr(cli, "PhotoscriptBackend", backend)
+    cli.run_merge([library], dest_library)
+    fingerprint = library_fingerprint(library)
+    cli.run_merge([library], dest_library)
+    assert len(dests) == 1
+    assert len(dests[0].photos) == library_photo_count(library)
+
+    # any write to the source database means it has to be read again
+    db_path = library / "database" / "Photos.sqlite"
+    stat = db_path.stat()
+    os.utime(db_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert library_fingerprint(library) != fingerprint
+    cli.run_merge([library], dest_library)
+    assert len(dests) == 2
+    assert not dests[1].photos
+
+
+def test_update_changed_photos(tmp_path, monkeypatch):
+    """--update writes the metadata of photos changed since the last update and
+    re-imports those whose pixels changed """
+    lib = generate_synthetic_library(tmp_path / "lib", 30, file_size=16)
+    dest = FakePhotosBackend()
+    monkeypatch.setattr(cli, "PhotoscriptBackend", lambda: dest)
+    monkeypatch.setattr(cli, "open_source", lambda path, stream: SyntheticSource(path))
+    dest_library = tmp_path / "Dest.photoslibrary"
+    assert cli.run_merge([lib.library_path], dest_library, update=True)
+    assert len(dest.photos) == 30
+    assert not cli.run_merge([lib.library_path], dest_library, update=True)
+
+    manifest = lib.library_path / "photos.jsonl"
+    records = [json.loads(line) for line in manifest.read_text().splitlines()]
+    retitled, edited = [r for r in records if not r["edited"]][:2]
+    retitled.update(title="New title", keywords=["New"], modified=time.time())
+    (lib.library_path / "new_edit.jpeg").write_bytes(b"edited")
+    edited.update(edited="new_edit.jpeg", modified=time.time())
+    manifest.write_text("".join(json.dumps(r) + "\n" for r in records))
+
+    mergedb = MergeDB(cli.mergedb_path(dest_library), lib.library_path, dest_library)
+    old_uuid = mergedb.get(edited["uuid"])[0]["import_uuid"][0]
+    retitled_uuid = mergedb.get(retitled["uuid"])[0]["import_uuid"][0]
+    calls = dest.calls["import_photos"]
+    assert cli.run_merge([lib.library_path], dest_library, update=True)
+
+    assert dest.calls["import_photos"] == calls + 1
+    assert len(dest.photos) == 31
+    assert dest.photos[retitled_uuid]["title"] == "New title"
+    assert list(dest.photos[retitled_uuid]["keywords"]) == ["New"]
+    record = mergedb.get(edited["uuid"])[0]
+    assert record["replaced_uuid"] == [old_uuid]
+    assert dest.photos[record["import_uuid"][0]]["filename"].endswith(".jpeg")
+    assert dest.album(cli.REPLACED_ALBUM).uuids == [old_uuid]
+    assert not cli.run_merge([lib.library_path], dest_library, update=True)
+    mergedb.close()
@@ -0,0 +1,56 @@
+"""Test staging source files for import """
+
+import os
+
+from merge_photos_libraries.backend import FakePhotosBackend
+from merge_photos_libraries.cli import merge_photos
+from merge_photos_libraries.mergedb import MergeDB
+from merge_photos_libraries.source import generate_synthetic_library
+from merge_photos_libraries.staging import STRATEGIES, StagingArea, stage_file
+
+
+def test_stage_file_hardlink(tmp_path):
+    """files on the same filesystem are hardlinked, not copied """
+    src = tmp_path / "src.jpg"
+    src.write_bytes(b"photo")
+    assert stage_file(src, tmp_path / "dest.jpg") == "hardlink"
+    assert os.stat(src).st_ino == os.stat(tmp_path / "dest.jpg").st_ino
+
+
+def test_staging_area_name_collision(tmp_path):
+    """photos with the same original filename are staged in a subdirectory """
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    for name in ("a/IMG_0001.JPG", "a/IMG_0001.CR2", "b/IMG_0001.JPG"):
+        (tmp_path / name).write_bytes(name.encode())
+    staging = StagingArea(tmp_path / "staging")
+    (tmp_path / "staging").mkdir()
+
+    first = staging.link(
+        [tmp_path / "a/IMG_0001.JPG", tmp_path / "a/IMG_0001.CR2"], "IMG_0001.JPG"
+    )
+    second = staging.link([tmp_path / "b/IMG_0001.JPG"], "IMG_0001.JPG")
+    assert [os.path.dirname(f) for f in first.files] == [str(tmp_path / "staging")] * 2
+    assert os.path.dirname(second.files[0]) != str(tmp_path / "staging")
+    assert open(second.files[0], "rb").read() == b"b/IMG_0001.JPG"
+    assert set(first.strategies) == {"IMG_0001.JPG", "IMG_0001.CR2"}
+
+    first.cleanup()
+    second.cleanup()
+    assert os.listdir(tmp_path / "staging") == []
+    assert (tmp_path / "a/IMG_0001.JPG").exists()
+
+
+def test_merge_records_staging_strategy(tmp_path):
+    """merge records which strategy staged each file """
+    src_photos = generate_synthetic_library(tmp_path / "lib", 50, file_size=16).photos()
+    dest = FakePhotosBackend()
+    mergedb = MergeDB(tmp_path / "merge.db", "source", "dest")
+    with open(os.devnull, "w") as fp:
+        merge_photos(src_photos, dest, mergedb, import_batch_size=10, progress_file=fp)
+    assert len(dest.photos) == 50
+    for photo in src_photos:
+        strategies = mergedb.get(photo.uuid)[0]["staging"]
+        expected = "export" if photo.hasadjustments else "hardlink"
+        assert set(strategies.values()) == {expected}
+        assert all(s in STRATEGIES for s in strategies.values())
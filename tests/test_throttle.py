@@ -0,0 +1,67 @@
+"""Test retrying and throttling calls to the destination library """
+
+import os
+import time
+
+import pytest
+
+from merge_photos_libraries.backend import FakePhotosBackend, PhotosBusyError
+from merge_photos_libraries.cli import merge_photos
+from merge_photos_libraries.mergedb import MergeDB
+from merge_photos_libraries.source import generate_synthetic_library
+from merge_photos_libraries.throttle import Throttle, ThrottledBackend
+
+
+def test_throttle_aimd():
+    """batch size halves when calls are slow and grows by one when they're fast """
+    throttle = Throttle(1.0, max_batch_size=16, smoothing=1.0)
+    throttle.observe("import_photos", 2.0)
+    assert throttle.batch_size == 8
+    throttle.observe("import_photos", 3.0)
+    assert throttle.batch_size == 4
+    for _ in range(20):
+        throttle.observe("import_photos", 0.1)
+    assert throttle.batch_size == 16
+    for _ in range(10):
+        throttle.decrease()
+    assert throttle.batch_size == 1
+
+
+def test_throttled_backend_retries():
+    """busy calls are retried with a growing, jittered backoff """
+    delays = []
+    dest = FakePhotosBackend(failures={"import_photos": 2})
+    throttle = Throttle(10, max_batch_size=8)
+    throttled = ThrottledBackend(
+        dest, throttle=throttle, retries=3, backoff=1, sleep=delays.append
+    )
+    assert len(throttled.import_photos(["IMG_0001.JPG"])) == 1
+    assert throttled.retry_count == 2
+    assert 0 <= delays[0] <= 1 and 0 <= delays[1] <= 2
+    assert throttle.batch_size == 3
+    assert "import_photos" in throttle.latency
+
+    dest = FakePhotosBackend(failures={"add": 5})
+    throttled = ThrottledBackend(dest, retries=2, sleep=delays.append)
+    with pytest.raises(PhotosBusyError):
+        throttled.add(dest.create_album("Album"), [])
+
+
+def test_merge_records_retries(tmp_path, monkeypatch):
+    """merge records how many calls were retried for each photo """
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    src_photos = generate_synthetic_library(tmp_path / "lib", 20, file_size=16).photos()
+    dest = FakePhotosBackend(failures={"import_photos": 1, "set_metadata": 1})
+    mergedb = MergeDB(tmp_path / "merge.db", "source", "dest")
+    with open(os.devnull, "w") as fp:
+        merge_photos(
+            src_photos,
+            dest,
+            mergedb,
+            import_batch_size=10,
+            progress_file=fp,
+            target_latency=5,
+        )
+    assert len(dest.photos) == 20
+    retries = [mergedb.get(p.uuid)[0].get("retries", 0) for p in src_photos]
+    assert retries == [2] * 10 + [0] * 10
@@ -0,0 +1,145 @@
+"""Test verification of a merge """
+
+import json
+from types import SimpleNamespace
+
+from click.testing import CliRunner
+
+from merge_photos_libraries import cli
+from merge_photos_libraries.backend import FakePhotosBackend
+from merge_photos_libraries.source import (
+    AlbumIndex,
+    PhotosSource,
+    SyntheticSource,
+    generate_synthetic_library,
+)
+from merge_photos_libraries.verify import VerifyReport
+
+
+class FakeDestinationSource(PhotosSource):
+    """FakePhotosBackend read back as a PhotosSource, as verify reads the
+    destination library """
+
+    def __init__(self, library_path, backend):
+        super().__init__(library_path)
+        self._backend = backend
+
+    def photos(self, uuids=None):
+        return [
+            SimpleNamespace(
+                uuid=uuid,
+                favorite=photo["favorite"],
+                title=photo["title"],
+                description=photo["description"],
+                keywords=list(photo["keywords"]),
+                location=tuple(photo["location"]),
+                persons=[],
+            )
+            for uuid, photo in self._backend.photos.items()
+            if uuids is None or uuid in uuids
+        ]
+
+    def album_index(self):
+        index = AlbumIndex()
+        for (folder_names, title), album in self._backend.albums().items():
+            album_id = index.add_album(folder_names, title)
+            for uuid in album.uuids:
+                index.add(uuid, album_id)
+        return index
+
+
+def merge_synthetic(tmp_path, monkeypatch, dest, count=40):
+    """Merge a synthetic library of count photos into FakePhotosBackend dest, which
+    verify reads back; returns (source library, destination library path) """
+    lib = generate_synthetic_library(tmp_path / "lib", count, file_size=16)
+    dest_library = tmp_path / "Dest.photoslibrary"
+    dest_library.mkdir()
+
+    def open_source(path, stream):
+        if path == dest_library:
+            return FakeDestinationSource(path, dest)
+        return SyntheticSource(path)
+
+    monkeypatch.setattr(cli, "PhotoscriptBackend", lambda: dest)
+    monkeypatch.setattr(cli, "open_source", open_source)
+    cli.run_merge([lib.library_path], dest_library)
+    return lib, dest_library
+
+
+def test_verify_merge(tmp_path, monkeypatch):
+    """a complete merge verifies cleanly and each kind of damage is reported with
+    the stage that fixes it; repair with the report fixes it all """
+    dest = FakePhotosBackend()
+    lib, dest_library = merge_synthetic(tmp_path, monkeypatch, dest)
+    report_file = tmp_path / "report.json"
+    args = ["verify", str(lib.library_path), str(dest_library), "--report"]
+    result = CliRunner().invoke(cli.cli, args + [str(report_file)])
+    assert result.exit_code == 0, result.output
+    assert VerifyReport.load(report_file).summary() == {
+        "source_photos": 40,
+        "destination_photos": 40,
+        "mismatches": {},
+    }
+
+    mergedb = cli.open_mergedb(lib.library_path, dest_library)
+    photos = lib.photos()
+    dest_uuids = [mergedb.get(p.uuid)[0]["import_uuid"][0] for p in photos]
+    dest.photos[dest_uuids[0]]["title"] = "Changed"
+    dest.photos[dest_uuids[1]]["keywords"] = ["Extra"]
+    del dest.photos[dest_uuids[2]]
+    in_album = next(i for i, p in enumerate(photos) if i > 4 and p.album_info)
+    for album in dest.albums().values():
+        if dest_uuids[in_album] in album.uuids:
+            album.uuids.remove(dest_uuids[in_album])
+    mergedb.upsert({"src_uuid": photos[3].uuid, "imported": False})
+    mergedb.upsert(
+        {"src_uuid": photos[4].uuid, "imported": False, "import_error": True}
+    )
+    mergedb.close()
+
+    result = CliRunner().invoke(cli.cli, args + [str(report_file)])
+    assert result.exit_code == 1
+    report = json.loads(report_file.read_text())
+    found = {(m["kind"], m["src_uuid"], m.get("field")) for m in report["mismatches"]}
+    assert ("metadata", photos[0].uuid, "title") in found
+    assert ("metadata", photos[1].uuid, "keywords") in found
+    assert ("missing", photos[2].uuid, None) in found
+    assert ("album", photos[in_album].uuid, None) in found
+    assert ("not_merged", photos[3].uuid, None) in found
+    assert ("failed", photos[4].uuid, None) in found
+    stages = VerifyReport.load(report_file).uuids(stage="import")
+    assert stages == {
+        str(lib.library_path): {photos[2].uuid, photos[3].uuid, photos[4].uuid}
+    }
+
+    calls = dict(dest.calls)
+    repair = ["repair", str(lib.library_path), str(dest_library), "--report"]
+    result = CliRunner().invoke(cli.cli, repair + [str(report_file)])
+    assert result.exit_code == 0, result.output
+    # only the missing, unmerged and failed photos are imported again
+    assert dest.calls["import_photos"] - calls["import_photos"] == 3
+    result = CliRunner().invoke(cli.cli, args + [str(report_file)])
+    assert result.exit_code == 0, result.output
+
+
+def test_repair_failed_imports(tmp_path, monkeypatch):
+    """repair imports the photos whose import failed according to the merge database """
+    dest = FakePhotosBackend()
+    lib, dest_library = merge_synthetic(tmp_path, monkeypatch, dest, count=10)
+    mergedb = cli.open_mergedb(lib.library_path, dest_library)
+    for photo in lib.photos()[:3]:
+        del dest.photos[mergedb.get(photo.uuid)[0]["import_uuid"][0]]
+        mergedb.upsert(
+            {"src_uuid": photo.uuid, "imported": False, "import_error": True}
+        )
+    mergedb.close()
+
+    args = [str(lib.library_path), str(dest_library)]
+    result = CliRunner().invoke(cli.cli, ["repair"] + args + ["--dry-run"])
+    assert "3 photos to import" in result.output
+    assert len(dest.photos) == 7
+    result = CliRunner().invoke(cli.cli, ["repair"] + args)
+    assert result.exit_code == 0, result.output
+    assert len(dest.photos) == 10
+    result = CliRunner().invoke(cli.cli, ["repair"] + args)
+    assert "Nothing to repair" in result.output